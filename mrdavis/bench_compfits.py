@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+"""
+Benchmarks for compfits.py.
+
+Generates a corpus of synthetic pairs of fits files, varying the number of
+extensions, image size, data type, table rows, header size and where the
+first difference is, then times each phase of CompareFits.run_all_comps()
+on every pair. Wall time, bytes read and peak RSS are recorded for each
+phase and written to a JSON results file that can be compared with the
+results of an earlier run.
+
+Each case runs in its own process so peak RSS is measured per case. Bytes
+read come from /proc/self/io and are None where that isn't available. Peak
+RSS is ru_maxrss, which is in kilobytes on Linux but bytes on OS X.
+
+Usage: bench_compfits.py [--quick] [-o results.json] [--compare old.json]
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import numpy as np
+
+import pyfits
+
+import compfits
+
+# phases of CompareFits.run_all_comps(), in the order it runs them
+PHASES = ['compare_length',
+          'compare_names',
+          'compare_size',
+          'compare_raw_data',
+          'compare_all_headers',
+          'compare_data']
+
+# where the first difference goes, as a fraction of the way through the data
+# of the last image extension. 'header' puts it in the last header instead and
+# None makes the files identical.
+DIFF_POSITIONS = {'start': 0., 'middle': 0.5, 'end': 1.}
+
+# benchmark cases. anything not given takes its value from DEFAULT_CASE.
+DEFAULT_CASE = {'n_hdus': 3,
+                'shape': [1024,1024],
+                'dtype': 'float32',
+                'table_rows': 0,
+                'header_cards': 50,
+                'diff_at': None}
+
+CASES = [{},
+         {'diff_at': 'start'},
+         {'diff_at': 'middle'},
+         {'diff_at': 'end'},
+         {'diff_at': 'header'},
+         {'n_hdus': 20,'shape': [256,256]},
+         {'shape': [4096,4096]},
+         {'shape': [4096,4096],'diff_at': 'end'},
+         {'dtype': 'int16'},
+         {'dtype': 'float64'},
+         {'dtype': 'uint16'},
+         {'header_cards': 2000},
+         {'table_rows': 1000000,'shape': [16,16]},
+         {'table_rows': 1000000,'shape': [16,16],'diff_at': 'end'}]
+
+QUICK_CASES = [{'shape': [256,256]},
+               {'shape': [256,256],'diff_at': 'end'},
+               {'shape': [16,16],'table_rows': 10000}]
+
+
+def case_name(case):
+  """
+  Short name for a case, made from the parameters that differ from
+  DEFAULT_CASE.
+
+  """
+  parts = []
+
+  for key in sorted(DEFAULT_CASE):
+    if case[key] != DEFAULT_CASE[key]:
+      value = case[key]
+      if isinstance(value,list):
+        value = 'x'.join(str(v) for v in value)
+      parts.append('{}={}'.format(key,value))
+
+  return ','.join(parts) or 'default'
+
+
+def make_hdus(case,modified):
+  """
+  Make the HDUList for one side of a case. The second file of a pair is made
+  with modified=True, which puts the difference given by case['diff_at'] in
+  place.
+
+  """
+  rng = np.random.RandomState(0)
+
+  primary = pyfits.PrimaryHDU()
+  for i in range(case['header_cards']):
+    primary.header['KEY{}'.format(i)] = (i,'synthetic keyword')
+
+  hdus = [primary]
+
+  for i in range(1,case['n_hdus']):
+    data = (rng.rand(*case['shape']) * 1000).astype(case['dtype'])
+    hdus.append(pyfits.ImageHDU(data,name='SCI'))
+
+  if case['table_rows'] > 0:
+    n = case['table_rows']
+    cols = [pyfits.Column('index','K',array=np.arange(n)),
+            pyfits.Column('value','E',array=rng.rand(n).astype('float32')),
+            pyfits.Column('name','8A',array=np.array(['row'] * n))]
+    hdus.append(pyfits.BinTableHDU.from_columns(cols,name='TAB'))
+
+  if modified and case['diff_at'] == 'header':
+    hdus[-1].header['BENCHMOD'] = True
+  elif modified and case['diff_at'] is not None:
+    last = hdus[-1]
+    if last.data.dtype.names:
+      column = last.data.field('value')
+      column[int(DIFF_POSITIONS[case['diff_at']] * (len(column) - 1))] += 1
+    else:
+      flat = last.data.reshape(-1)
+      flat[int(DIFF_POSITIONS[case['diff_at']] * (flat.size - 1))] += 1
+
+  return pyfits.HDUList(hdus)
+
+
+def make_pair(case,corpus):
+  """
+  Write the pair of files for a case to the corpus directory, unless they are
+  already there, and return their names.
+
+  """
+  name = case_name(case).replace('=','-').replace(',','_')
+  fits1 = os.path.join(corpus,name + '_1.fits')
+  fits2 = os.path.join(corpus,name + '_2.fits')
+
+  if not os.path.exists(fits1):
+    make_hdus(case,False).writeto(fits1)
+  if not os.path.exists(fits2):
+    make_hdus(case,True).writeto(fits2)
+
+  return fits1,fits2
+
+
+def bytes_read():
+  """
+  Bytes read by this process so far according to /proc/self/io, or None.
+
+  """
+  try:
+    with open('/proc/self/io') as f:
+      for line in f:
+        if line.startswith('rchar:'):
+          return int(line.split()[1])
+  except EnvironmentError:
+    pass
+
+  return None
+
+
+def peak_rss():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_case(args):
+  """
+  Time each phase of the comparison for one pair of files. Runs in a worker
+  process. Stops after the first phase that raises a FitsError.
+
+  """
+  case,fits1,fits2 = args
+
+  phases = []
+
+  start_read = bytes_read()
+  start = timeit.default_timer()
+  comp = compfits.CompareFits(fits1,fits2)
+  open_time = timeit.default_timer() - start
+
+  result = {'case': case_name(case),
+            'params': case,
+            'file_bytes': os.path.getsize(fits1) + os.path.getsize(fits2),
+            'open_time': open_time,
+            'phases': phases,
+            'raised': None}
+
+  try:
+    for phase in PHASES:
+      read_before = bytes_read()
+      start = timeit.default_timer()
+      try:
+        getattr(comp,phase)()
+      except compfits.FitsError as e:
+        result['raised'] = type(e).__name__
+      wall = timeit.default_timer() - start
+      read_after = bytes_read()
+
+      phases.append({'phase': phase,
+                     'wall_time': wall,
+                     'bytes_read': (None if read_before is None
+                                    else read_after - read_before),
+                     'peak_rss': peak_rss()})
+
+      if result['raised'] is not None:
+        break
+  finally:
+    comp.close_fits()
+
+  result['total_time'] = open_time + sum(p['wall_time'] for p in phases)
+  if start_read is not None:
+    result['total_bytes_read'] = bytes_read() - start_read
+  else:
+    result['total_bytes_read'] = None
+  result['peak_rss'] = peak_rss()
+
+  return result
+
+
+def run_benchmarks(cases,corpus):
+  """
+  Make the corpus for cases and benchmark each one in a fresh process.
+  Returns the results dictionary that gets written to the results file.
+
+  """
+  jobs = []
+  for params in cases:
+    case = dict(DEFAULT_CASE)
+    case.update(params)
+    fits1,fits2 = make_pair(case,corpus)
+    jobs.append((case,fits1,fits2))
+
+  pool = multiprocessing.Pool(1,maxtasksperchild=1)
+  try:
+    results = []
+    for result in pool.imap(run_case,jobs):
+      print('{:<50}{:>10.4f} s{:>14}'.format(result['case'],
+                                              result['total_time'],
+                                              result['raised'] or 'same'))
+      results.append(result)
+  finally:
+    pool.close()
+    pool.join()
+
+  return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+          'python': sys.version.split()[0],
+          'numpy': np.__version__,
+          'platform': platform.platform(),
+          'results': results}
+
+
+def compare_results(old,new):
+  """
+  Print the ratio of new to old wall time for each case and phase found in
+  both results dictionaries.
+
+  """
+  old_cases = dict((r['case'],r) for r in old['results'])
+
+  print('')
+  print('{:<50}{:<22}{:>10}{:>10}{:>8}'.format('case','phase','old','new',
+                                               'ratio'))
+
+  for result in new['results']:
+    if result['case'] not in old_cases:
+      continue
+
+    old_phases = dict((p['phase'],p['wall_time'])
+                      for p in old_cases[result['case']]['phases'])
+
+    for phase in result['phases']:
+      if phase['phase'] not in old_phases:
+        continue
+      old_time = old_phases[phase['phase']]
+      ratio = phase['wall_time'] / old_time if old_time > 0 else float('nan')
+      print('{:<50}{:<22}{:>10.4f}{:>10.4f}{:>8.2f}'.format(
+            result['case'],phase['phase'],old_time,phase['wall_time'],ratio))
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description=
+                                   'Benchmark compfits.py on synthetic '
+                                   'fits files.')
+
+  parser.add_argument('-o', '--output', type=str,
+                      default='bench_compfits.json',
+                      help='Results file. Defaults to bench_compfits.json.')
+
+  parser.add_argument('--corpus', type=str, default=None,
+                      help='Directory for the synthetic fits files. Files '
+                           'already there are reused. Defaults to a '
+                           'temporary directory that is removed afterwards.')
+
+  parser.add_argument('--quick', action='store_true',
+                      help='Run a few small cases only.')
+
+  parser.add_argument('--compare', type=str, default=None,
+                      help='Earlier results file to compare against.')
+
+  return parser.parse_args()
+
+
+def main():
+  args = parse_args()
+
+  cases = QUICK_CASES if args.quick else CASES
+
+  if args.corpus is None:
+    corpus = tempfile.mkdtemp(prefix='bench_compfits')
+  else:
+    corpus = args.corpus
+    if not os.path.isdir(corpus):
+      os.makedirs(corpus)
+
+  try:
+    results = run_benchmarks(cases,corpus)
+  finally:
+    if args.corpus is None:
+      shutil.rmtree(corpus)
+
+  with open(args.output,'w') as f:
+    json.dump(results,f,indent=2,sort_keys=True)
+
+  print('Results written to ' + args.output)
+
+  if args.compare is not None:
+    with open(args.compare) as f:
+      compare_results(json.load(f),results)
+
+
+if __name__ == '__main__':
+  raise SystemExit(main())
@@ -1,11 +1,71 @@
 #!/usr/bin/env python
+"""
+Check an IMPHTTAB for internal consistency. Type checkimpht.py -h for help.
 
-import sys
+Extensions are independent so with -j/--jobs they are checked at the same
+time by a pool of worker processes. Output is the same as a serial run.
+
+Any number of tables can be checked in one run. With --cache the findings
+for each file and each extension are kept in an sqlite database keyed by a
+hash of their contents, so unchanged tables and extensions aren't checked
+again.
+
+With --stream ROWS extension data is never read whole. Rows are read from a
+memory map of the file ROWS at a time and variable length array cells are
+looked up in the heap as they're needed, so memory use doesn't grow with the
+size of the table.
+
+Obsmodes are checked through an ObsmodeIndex, a sorted index of the
+normalized obsmodes of every extension that answers exact and prefix lookups
+with binary searches and finds duplicated obsmodes. With --index-cache the
+index of each table is saved in that directory and reused while the table
+is unchanged.
+
+With --graph every obsmode is also traced through the GRAPHTAB and COMPTAB
+named in the table's header (or given with --graphtab and --comptab) to
+check that it resolves to a throughput path: the path reaches the end of the
+graph, every keyword of the obsmode is used and every component is in the
+COMPTAB. Paths are memoized by node and the obsmode keywords that can still
+be used from that node, so obsmodes sharing a prefix only trace it once.
+
+Usage: checkimpht.py [-j JOBS] [--cache CACHE] [--stream ROWS]
+                     [--index-cache DIR] [--graph] [--graphtab GRAPHTAB]
+                     [--comptab COMPTAB] <impht fits tables>
+
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import sqlite3
 
 import numpy as np
 
 import pyfits
 
+import fitsheader
+
+# number of bytes read at a time when hashing files
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+# changes whenever the checks change, so cached findings from older versions
+# aren't used
+CHECKS_VERSION = 2
+
+# ObsmodeGraphs that have been loaded, by (graphtab, comptab) file names
+_GRAPHS = {}
+
+# numpy types of the binary table formats read when streaming rows. P and Q
+# are variable length array descriptors, read as (count, offset) pairs.
+STREAM_DTYPE = {'L': 'S1', 'B': 'u1', 'I': '>i2', 'J': '>i4', 'K': '>i8',
+                'E': '>f4', 'D': '>f8', 'C': '>c8', 'M': '>c16',
+                'P': '>i4', 'Q': '>i8'}
+
 class CheckImpht(object):
   """
   Perform checks on an IMPHTTAB produced by reftools.mkimphttab.createTable.
@@ -13,17 +73,37 @@ class CheckImpht(object):
   table for internal consistency.
   
   Takes a pyfits.core.HDUList object as input.
+
+  The check methods return lists of messages and run_checks() prints them.
+
+  If chunk_rows is given extensions are checked that many rows at a time
+  straight from the file (see TableStream) instead of through pyfits.
+  Gzipped files can't be memory mapped, so they're always read through
+  pyfits and chunk_rows is ignored for them. If index_cache is given it's a
+  directory where the table's ObsmodeIndex is saved (see ObsmodeIndex.cached).
+  If graph is given it's the ObsmodeGraph the obsmodes are checked against.
   
   """
-  def __init__(self,fits_obj):
+  def __init__(self,fits_obj,chunk_rows=None,index_cache=None,graph=None):
     self.fits = fits_obj
+
+    filename = fits_obj.filename()
+    if chunk_rows is not None and filename is not None and \
+       is_gzipped(filename):
+      chunk_rows = None
+    self.chunk_rows = chunk_rows
+    self.index_cache = index_cache
+    self.graph = graph
     
-    self.check_header_keys()
+    self.header_key_messages = self.check_header_keys()
     self.read_header()
+
+    self.rules = RuleSet(self.num_par)
     
   def check_header_keys(self):
     """
-    Check that the header has all the keywords we expect it to.
+    Check that the header has all the keywords we expect it to. Returns a
+    list of messages for missing keywords.
     
     """
     keys = ['SIMPLE',
@@ -47,9 +127,13 @@ class CheckImpht(object):
              'PEDIGREE',
              'DESCRIP']
              
+    messages = []
+
     for k in keys:
       if not self.fits['primary'].header.has_key(k):
-        print 'Header does not have key {}'.format(k)
+        messages.append('Header does not have key {}'.format(k))
+
+    return messages
     
   def read_header(self):
     """
@@ -61,235 +145,1544 @@ class CheckImpht(object):
     
   def check_header_vals(self):
     """
-    Check header keyword values say what they should say.
+    Check header keyword values say what they should say. Returns a list of
+    messages.
     
     """
-    print '** Checking header values.'
+    messages = ['** Checking header values.']
     
     if self.num_ext != len(self.fits)-1:
       s = 'Number of image extensions is {} and does not match header keyword {}.'
-      print s.format(len(self.fits)-1, self.num_ext)
+      messages.append(s.format(len(self.fits)-1, self.num_ext))
+
+    return messages
       
-  def check_ext_data(self):
+  def check_ext_data(self,jobs=1,cache=None):
     """
-    Run all the tests that apply to an extension.
-    
+    Run all the tests that apply to an extension, for every extension, and
+    return the list of messages in extension order. With jobs > 1 the
+    extensions are checked by a pool of that many processes, each reopening
+    the file; the messages are the same as from a serial run. Tables not read
+    from a file are always checked serially, and never streamed.
+
+    With a FindingsCache, extensions whose contents (and PARNUM) have been
+    checked before take their messages from the cache and only the rest are
+    checked.
+
     """
-    for i,ext in enumerate(self.fits[1:]):
-      print '** Checking extension {}'.format(ext.name)
-      
-      # check that all the obsmodes start with the same string
-      start = ext.data['obsmode'][0].strip().split(',')[0]
-      
-      if not np.char.startswith(ext.data['obsmode'],start).all():
-        w = np.where(np.char.startswith(ext.data['obsmode'],start) != True)
-        
-        s = 'obsmode for row {}: {} does not match row 0:{}\n'
-        
-        for i in w[0]:
-          print(s.format(i,ext.data['obsmode'][i],ext.data['obsmode'][0]))
-      
-      # perform other checks on individual rows
-      self.check_rows(ext,i+1)
-      
-  def check_rows(self,ext,ext_num):
+    filename = self.fits.filename()
+    num_ext = len(self.fits) - 1
+
+    findings = [None] * num_ext
+
+    if cache is not None and filename is not None:
+      digests = self.hdu_digests()
+      keys = ['ext:{}:{}:{}:{}'.format(CHECKS_VERSION,self.num_par,i+1,
+                                       digests[i+1])
+              for i in range(num_ext)]
+      for i in range(num_ext):
+        findings[i] = cache.get(keys[i])
+    else:
+      keys = None
+
+    todo = [i for i in range(num_ext) if findings[i] is None]
+
+    if jobs > 1 and len(todo) > 1 and filename is not None:
+      # with an index cache the index is built (or found) once here and
+      # loaded by each worker
+      if self.index_cache is not None:
+        self.obsmode_index()
+        index_path = ObsmodeIndex.cache_path(self.index_cache,
+                                             self.hdu_digests())
+      else:
+        index_path = None
+      args = [(filename,i+1,self.num_par,self.chunk_rows,index_path)
+              for i in todo]
+      pool = multiprocessing.Pool(min(jobs,len(todo)))
+      try:
+        results = pool.map(_check_extension_file,args)
+      finally:
+        pool.close()
+        pool.join()
+    elif self.chunk_rows is not None and filename is not None:
+      index = self.obsmode_index() if todo else None
+      results = [check_extension_stream(filename,i+1,self.rules,
+                                        self.chunk_rows,index)
+                 for i in todo]
+    else:
+      index = self.obsmode_index() if todo else None
+      results = [check_extension(self.fits[i+1],i+1,self.rules,index)
+                 for i in todo]
+
+    for i,messages in zip(todo,results):
+      findings[i] = messages
+      if keys is not None:
+        cache.put(keys[i],messages)
+
+    return [msg for messages in findings for msg in messages]
+
+  def check_graph(self):
     """
-    Run all the tests that apply to an extension row.
-    
+    Check that every distinct obsmode in the table resolves to a throughput
+    path through self.graph. Returns a list of messages, one for each
+    obsmode that doesn't, giving the first row it's used in.
+
     """
-    for i,row in enumerate(ext.data):
-#      print '** Checking row {} of extension {}.'.format(i,ext.name)
-      check_obsmode(row['obsmode'],ext_num,i)
-      check_row_len(self.num_par,row,ext_num,i)
-      check_row(self.num_par, row, ext_num, i)
-      
-  def run_checks(self):
-    self.check_header_vals()
-    self.check_ext_data()
+    graph = self.graph
+    messages = ['** Checking obsmodes against {} and {}'.format(
+                graph.graphtab,graph.comptab)]
+
+    if graph.error is not None:
+      messages.append(graph.error)
+      return messages
+
+    index = self.obsmode_index()
+
+    keys,first = np.unique(index.keys,return_index=True)
+    order = np.lexsort((index.rows[first],index.ext_nums[first]))
+
+    s = 'obsmode {} (extension {} row {}) does not resolve: {}'
+
+    for i in first[order]:
+      if index.keys[i] == b'':
+        continue
+      problems = graph.validate(_text(index.keys[i]))
+      if problems:
+        messages.append(s.format(_text(index.obsmodes[i]),index.ext_nums[i],
+                                 index.rows[i],'; '.join(problems)))
+
+    return messages
+
+  def obsmode_index(self):
+    """
+    The ObsmodeIndex of every extension of the table, built (or loaded from
+    self.index_cache) the first time it's needed.
+
+    """
+    if getattr(self,'_index',None) is None:
+      filename = self.fits.filename()
+      if filename is not None and self.index_cache is not None:
+        self._index = ObsmodeIndex.cached(filename,self.index_cache,
+                                          self.hdu_digests(),self.chunk_rows)
+      elif filename is not None and self.chunk_rows is not None:
+        self._index = ObsmodeIndex.from_file(filename,self.chunk_rows)
+      else:
+        self._index = ObsmodeIndex.from_fits(self.fits)
+
+    return self._index
+
+  def hdu_digests(self):
+    """
+    sha1 digests of the bytes of each HDU of the file, computed the first time
+    they're needed (see hdu_digests()).
+
+    """
+    if getattr(self,'_digests',None) is None:
+      self._digests = hdu_digests(self.fits.filename())
+
+    return self._digests
+
+  def messages(self,jobs=1,cache=None):
+    """
+    Messages from all the checks, in the order run_checks() prints them.
+
+    """
+    messages = self.header_key_messages + self.check_header_vals() + \
+               self.check_ext_data(jobs,cache)
+
+    if self.graph is not None:
+      messages.extend(self.check_graph())
+
+    return messages
+
+  def run_checks(self,jobs=1,cache=None):
+    for msg in self.messages(jobs,cache):
+      print msg
       
-def check_obsmode(obsmode,ext_num,row_num):
+class FindingsCache(object):
   """
-  Is obsmode set to something?
+  Cache of check messages in an sqlite database, keyed by strings made from
+  content hashes (see check_files() and CheckImpht.check_ext_data()).
+
   """
-  
-  if len(obsmode) == 0:
-    print 'Obsmode column is empty for extension {} row {}'.format(ext_num,row_num)
-    
-def check_row_len(num_par,row,ext_num,row_num):
+  def __init__(self,filename):
+    self.filename = filename
+
+    self.conn = sqlite3.connect(filename,timeout=60)
+    self.conn.execute('CREATE TABLE IF NOT EXISTS findings ('
+                      'key TEXT PRIMARY KEY, messages TEXT)')
+    self.conn.commit()
+
+  def get(self,key):
+    """
+    Cached list of messages for key, or None.
+
+    """
+    row = self.conn.execute('SELECT messages FROM findings WHERE key = ?',
+                            (key,)).fetchone()
+
+    if row is None:
+      return None
+
+    return json.loads(row[0])
+
+  def put(self,key,messages):
+    self.conn.execute('INSERT OR REPLACE INTO findings VALUES (?,?)',
+                      (key,json.dumps(messages)))
+    self.conn.commit()
+
+  def close(self):
+    self.conn.close()
+
+def hdu_digests(filename):
   """
-  Does the row have the expected number of columns?
+  Return a list of sha1 hex digests, one for the bytes (header and data) of
+  each HDU in a fits file, found with fitsheader.iter_headers(). Gzipped
+  files are hashed decompressed.
+
   """
-  
-  len_should = 5 + (4 * num_par)
-  
-  if len(row) != len_should:
-    s = 'Row {} of extension {} should have length {} but has length {}'
-    print s.format(row_num, ext_num, len_should, len(row))
-    
-def check_row(num_par,row,ext_num,row_num):
+  digests = []
+
+  f = fitsheader.open_fits(filename)
+
+  try:
+    for header in fitsheader.iter_headers(filename):
+      digest = hashlib.sha1()
+      fitsheader.skip_to(f,header.header_offset)
+      remaining = header.data_offset + header.data_span - header.header_offset
+      while remaining > 0:
+        block = f.read(min(HASH_BLOCK_SIZE,remaining))
+        if not block:
+          break
+        digest.update(block)
+        remaining -= len(block)
+      digests.append(digest.hexdigest())
+  finally:
+    f.close()
+
+  return digests
+
+def check_files(filenames,jobs=1,cache=None,chunk_rows=None,index_cache=None,
+                graph=False,graphtab=None,comptab=None):
   """
-  Does the column specified in the datacol column contain data, and do the
-  other data columns contain zero? Also checks the paramter names, values,
-  parameter number of elements columns.
+  Run all the checks on each IMPHTTAB in filenames, printing the messages
+  for one file before moving on to the next. With a FindingsCache, files
+  whose contents have been checked before have their messages printed from
+  the cache, and changed files only have their changed extensions checked.
+  chunk_rows and index_cache are passed on to CheckImpht.
+
+  If graph is True obsmodes are also checked against the GRAPHTAB and
+  COMPTAB in each file's header, or graphtab and comptab if they're given.
+
   """
-  
-  datacol = row['datacol']
-  
-  if datacol[-1] not in [str(x) for x in range(1,num_par+1)]:
-    # plain, single number case
-    
-    # check that the data column has a value
-    if row['datacol'] == 0:
-      s = 'Column {} of extension {} row {} is zero and shouldn\'t be.'
-      print s.format(datacol, ext_num, row_num)
-    
-    # check that the other data columns are [0]
-    datacolnum = ['{}{}'.format(datacol,x) for x in range(1,num_par+1)]
-    
-    for d in datacolnum:
-      try:
-        if row[d].tolist() != [0]:
-          s = 'Column {} of extension {} row {} is not [0]. {} instead.'
-          print s.format(d, ext_num, row_num, row[p])
-      except AttributeError:
-        s = 'Column {} of extension {} row {} is not an array. {} instead.'
-        print s.format(p, ext_num, row_num, row[p])
-        
-    # check that the parameter names are ''
-    parnames = ['PAR{}NAMES'.format(x) for x in range(1,num_par+1)]
-    
-    for p in parnames:
-      if row[p] != '':
-        s = 'Column {} of extension {} row {} has value {} when it should be blank.'
-        print s.format(p, ext_num, row_num, row[p])
-        
-    # check that the parameter values are [0]
-    parvals = ['PAR{}VALUES'.format(x) for x in range(1,num_par+1)]
-    
-    for p in parvals:
-      try:
-        if row[p].tolist() != [0]:
-          s = 'Column {} of extension {} row {} is not [0]. {} instead.'
-          print s.format(p, ext_num, row_num, row[p])
-      except AttributeError:
-        s = 'Column {} of extension {} row {} is not an array. {} instead.'
-        print s.format(p, ext_num, row_num, row[p])
-        
-    # check that the nelem# keywords are 0
-    nelems = ['NELEM{}'.format(x) for x in range(1,num_par+1)]
-    
-    for n in nelems:
-      if row[n] != 0:
-        s = 'Column {} of extension {} row {} is not 0. {} instead.'
-        print s.format(n, ext_num, row_num, row[n])
-    
+  for filename in filenames:
+    print '** Running checks on file {}'.format(filename)
+
+    if graph:
+      obsmode_graph = graph_for_file(filename,graphtab,comptab)
+    else:
+      obsmode_graph = None
+
+    if cache is not None:
+      digests = hdu_digests(filename)
+      key = 'file:{}:{}'.format(CHECKS_VERSION,_file_digest(digests))
+      if obsmode_graph is not None:
+        key += ':' + obsmode_graph.digest
+      messages = cache.get(key)
+      if messages is not None:
+        for msg in messages:
+          print msg
+        continue
+
+    fits = pyfits.open(filename,'readonly')
+
+    try:
+      checker = CheckImpht(fits,chunk_rows,index_cache,obsmode_graph)
+      if cache is not None:
+        checker._digests = digests
+      messages = checker.messages(jobs,cache)
+    finally:
+      fits.close()
+
+    if cache is not None:
+      cache.put(key,messages)
+
+    for msg in messages:
+      print msg
+
+def graph_for_file(filename,graphtab=None,comptab=None):
+  """
+  The ObsmodeGraph for the GRAPHTAB and COMPTAB keywords in the primary
+  header of an IMPHTTAB file, either of which can be overridden. Graphs are
+  only loaded once per run.
+
+  """
+  header = fitsheader.read_header(filename)
+
+  if graphtab is None:
+    graphtab = resolve_path(header.get('GRAPHTAB') or '')
+  if comptab is None:
+    comptab = resolve_path(header.get('COMPTAB') or '')
+
+  if (graphtab,comptab) not in _GRAPHS:
+    _GRAPHS[(graphtab,comptab)] = ObsmodeGraph(graphtab,comptab)
+
+  return _GRAPHS[(graphtab,comptab)]
+
+def resolve_path(name):
+  """
+  Expand an IRAF style path such as mtab$g_tmg.fits. The directory for mtab$
+  comes from the mtab environment variable if it's set and is otherwise
+  $PYSYN_CDBS/mtab.
+
+  """
+  if '$' not in name:
+    return name
+
+  prefix,rest = name.split('$',1)
+
+  directory = os.environ.get(prefix)
+  if directory is None:
+    directory = os.path.join(os.environ.get('PYSYN_CDBS',''),prefix)
+
+  return os.path.join(directory,rest)
+
+def is_gzipped(filename):
+  """
+  True if filename is a gzipped file (see fitsheader.open_fits).
+
+  """
+  f = fitsheader.open_fits(filename)
+
+  try:
+    return isinstance(f,gzip.GzipFile)
+  finally:
+    f.close()
+
+def _file_digest(digests):
+  """
+  One digest for a whole file from the list of its hdu_digests().
+
+  """
+  return hashlib.sha1(' '.join(digests).encode('ascii')).hexdigest()
+
+def check_extension(ext,ext_num,rules,index=None):
+  """
+  Run all the tests that apply to an extension and return the messages that
+  would be printed, in order.
+
+  Input:
+    ext -- the extension HDU
+    ext_num -- extension number, used in messages
+    rules -- RuleSet for the table's PARNUM
+    index -- ObsmodeIndex including this extension, built from ext if None
+
+  """
+  messages = ['** Checking extension {}'.format(ext.name)]
+
+  if index is None:
+    index = ObsmodeIndex([(ext_num,ext.data.field('obsmode'))])
+
+  messages.extend(_obsmode_messages(index,ext_num,len(ext.data)))
+
+  # perform other checks on individual rows
+  messages.extend(rules.evaluate(ExtColumns(ext),ext_num))
+
+  return messages
+
+def check_extension_stream(filename,ext_num,rules,chunk_rows,index=None):
+  """
+  check_extension() for one extension of an IMPHTTAB file, reading its rows
+  chunk_rows at a time with a TableStream. Returns the same messages.
+
+  """
+  stream = TableStream(filename,ext_num)
+
+  try:
+    if index is None:
+      index = ObsmodeIndex.from_stream(stream,ext_num,chunk_rows)
+
+    messages = ['** Checking extension {}'.format(stream.name)]
+    messages.extend(_obsmode_messages(index,ext_num,stream.nrows))
+
+    for start,columns in stream.chunks(chunk_rows):
+      messages.extend(rules.evaluate(columns,ext_num,start))
+      del columns
+  finally:
+    stream.close()
+
+  return messages
+
+def _obsmode_messages(index,ext_num,nrows):
+  """
+  Messages from the obsmode checks of one extension, using an ObsmodeIndex:
+  do all the obsmodes start with the same instrument as row 0, and is any
+  obsmode used by more than one row?
+
+  """
+  messages = []
+
+  if nrows == 0:
+    return messages
+
+  first = index.obsmode(ext_num,0)
+  start = first.strip().split(',')[0]
+
+  if start:
+    matches = np.zeros(nrows,dtype=bool)
+    matches[index.prefix_rows(start,ext_num)] = True
+
+    s = 'obsmode for row {}: {} does not match row 0:{}\n'
+
+    for j in np.nonzero(~matches)[0]:
+      messages.append(s.format(j,index.obsmode(ext_num,j),first))
+
+  s = 'obsmode {} of extension {} row {} is the same as row {}'
+
+  for group in index.duplicates(ext_num):
+    e,row0 = group[0]
+    for e,row in group[1:]:
+      messages.append(s.format(index.obsmode(ext_num,row),ext_num,row,row0))
+
+  return messages
+
+def _check_extension_file(args):
+  """
+  check_extension() for one extension of an IMPHTTAB file, for running in a
+  worker process. args is (file name, extension number, PARNUM, chunk_rows,
+  index path), where chunk_rows is None to read the extension through pyfits
+  and index path is a saved ObsmodeIndex of the file, or None to index the
+  extension in the worker.
+
+  """
+  filename,ext_num,num_par,chunk_rows,index_path = args
+
+  if index_path is not None:
+    index = ObsmodeIndex.load(index_path)
   else:
-    # one of the parameter sets that's stored as an array
-    # (stuff here starts assuming that there are 9 or fewer parameters)
-    # (i.e., they only take up one character space)
-    
-    # check that the plain data column is 0
-    if row[datacol[:-1]] != 0:
-      s = 'Column {} of extension {} row {} is not 0. {} instead.'
-      print s.format(datacol[:-1], ext_num, row_num, row[datacol[:-1]])
-      
-    # how many parameters are we actually dealing with (must be <= num_par from header)
-    np = int(datacol[-1])
-    
-    # the array length in datacol should be nelem1 * nelem2 * nelem3 *... up to
-    # and including nelem#np
-    # check array length and the values in the NELEM# columns up to nelem#np
-    nelems = ['NELEM{}'.format(x) for x in range(1,np+1)]
-    data_len = 1
-    
-    for n in nelems:
-      if row[n] == 0:
-        s = 'Column {} of extension {} row {} is zero and shouldn\'t be.'
-        print s.format(n, ext_num, row_num)
-      
-      data_len *= row[n]
-        
-    if len(row[datacol]) != data_len:
-      s = 'Column {} of extension {} row {} should have length {}. Has length {} instead.'
-      print s.format(datacol, ext_num, row_num, data_len, len(row[datacol]))
-      
-    # check that the rest of the NELEM# fields are 0
-    nelems = ['NELEM{}'.format(x) for x in range(np+1,num_par+1)]
-    
-    for n in nelems:
-      if row[n] != 0:
-        s = 'Column {} of extension {} row {} is not 0. {} instead.'
-        print s.format(n, ext_num, row_num, row[n])
-    
-    # only the data column specified by datacol should be populated, all others
-    # should be [0]
-    datacolnum = ['{}{}'.format(datacol[:-1],x) for x in range(1,num_par+1)]
-    datacolnum.remove(datacol)
-    
-    for d in datacolnum:
-      try:
-        if row[d].tolist() != [0]:
-          s = 'Column {} of extension {} row {} is not [0]. {} instead.'
-          print s.format(d, ext_num, row_num, row[p])
-      except AttributeError:
-        s = 'Column {} of extension {} row {} is not an array. {} instead.'
-        print s.format(p, ext_num, row_num, row[p])
-    
-    
-    # parameter columns up to and including the number of parameters np should
-    # be populated, columns with parameter numbers higher should not be populated.
-    # check that the parameter names are not '' up to par{#np}name
-    parnames = ['PAR{}NAMES'.format(x) for x in range(1,np+1)]
-    
-    for p in parnames:
-      if row[p] == '':
-        s = 'Column {} of extension {} row {} is blank when it shouldn\'t be.'
-        print s.format(p, ext_num, row_num)
-        
-    # check that the rest of them are ''
-    parnames = ['PAR{}NAMES'.format(x) for x in range(np+1,num_par+1)]
-    
-    for p in parnames:
-      if row[p] != '':
-        s = 'Column {} of extension {} row {} has value {} when it should be blank.'
-        print s.format(p, ext_num, row_num, row[p])
-        
-    # all par#value columns up to #np should have the length specified in 
-    # the corresponding nelem# column
-    parvals = ['PAR{}VALUES'.format(x) for x in range(1,np+1)]
-    nelems = ['NELEM{}'.format(x) for x in range(1,np+1)]
-    
-    for p,n in zip(parvals,nelems):
-      if len(row[p]) != row[n]:
-        s = 'Length of column {} of extension {} row {} should be {}. {} instead.'
-        print s.format(p, ext_num, row_num, row[n], len(row[p]))
-        
-    # all the rest of the par#values columns should be [0]
-    parvals = ['PAR{}VALUES'.format(x) for x in range(np+1,num_par+1)]
-    
-    for p in parvals:
-      try:
-        if row[p].tolist() != [0]:
-          s = 'Column {} of extension {} row {} is not [0]. {} instead.'
-          print s.format(p, ext_num, row_num, row[p])
-      except AttributeError:
-        s = 'Column {} of extension {} row {} is not an array. {} instead.'
-        print s.format(p, ext_num, row_num, row[p])
+    index = None
 
-def usage():
-  print 'Usage: checkimpht.py <impht fits table>'
+  if chunk_rows is not None:
+    return check_extension_stream(filename,ext_num,RuleSet(num_par),chunk_rows,
+                                  index)
 
-if __name__ == '__main__':
-  if len(sys.argv) != 2:
-    usage()
-    exit()
-    
-  print '** Running checks on file {}'.format(sys.argv[1])
-    
-  fits = pyfits.open(sys.argv[1],'readonly')
-  
-  checker = CheckImpht(fits)
-  
-  checker.run_checks()
-  
-  fits.close()
+  fits = pyfits.open(filename,'readonly')
+
+  try:
+    return check_extension(fits[ext_num],ext_num,RuleSet(num_par),index)
+  finally:
+    fits.close()
+
+class ExtColumns(object):
+  """
+  Whole column access to the data of an IMPHTTAB extension for RuleSet.
+  Columns are read from the extension the first time they're used and kept.
+
+  Attributes:
+    nrows -- number of rows in the extension
+    ncols -- number of columns in the extension
+
+  """
+  def __init__(self,ext):
+    self.data = ext.data
+    self.nrows = len(ext.data)
+    self.ncols = len(ext.columns)
+
+    self._values = {}
+    self._arrays = {}
+
+  def values(self,name):
+    """
+    Column name as an array with one value per row. String columns have
+    trailing blanks stripped.
+
+    """
+    key = name.upper()
+
+    if key not in self._values:
+      values = self.data.field(name)
+      if values.dtype.kind in 'SU':
+        values = np.char.rstrip(values)
+      self._values[key] = values
+
+    return self._values[key]
+
+  def cell(self,name,row):
+    """
+    The value of column name in one row, as it would be printed.
+
+    """
+    return self.data.field(name)[row]
+
+  def array_info(self,name):
+    """
+    Describe a column whose cells should be arrays. Returns (kind, lengths,
+    firsts), where kind is 'array' if the cells are arrays, 'scalar' if they
+    are single numbers and 'string' if they are strings. For arrays lengths
+    and firsts give the length and first element (0 if empty) of each cell.
+
+    """
+    key = name.upper()
+
+    if key not in self._arrays:
+      values = self.data.field(name)
+
+      if values.dtype.kind in 'SU':
+        self._arrays[key] = ('string',None,None)
+      elif values.dtype == object:
+        # variable length arrays
+        lengths = np.frompyfunc(len,1,1)(values).astype(np.int64)
+        firsts = np.zeros(len(values))
+        nonempty = lengths > 0
+        if nonempty.any():
+          firsts[nonempty] = [cell[0] for cell in values[nonempty]]
+        self._arrays[key] = ('array',lengths,firsts)
+      elif values.ndim > 1:
+        flat = values.reshape(len(values),-1)
+        lengths = np.zeros(len(values),dtype=np.int64) + flat.shape[1]
+        firsts = flat[:,0] if flat.shape[1] > 0 else np.zeros(len(values))
+        self._arrays[key] = ('array',lengths,firsts)
+      else:
+        self._arrays[key] = ('scalar',None,None)
+
+    return self._arrays[key]
+
+
+class ObsmodeGraph(object):
+  """
+  A throughput graph table (GRAPHTAB) and component table (COMPTAB) held in
+  memory for resolving obsmodes, the way synphot does.
+
+  A path starts at innode 1. At each node the branch whose keyword is in the
+  obsmode is taken, or the 'default' branch if none is, and its component is
+  added to the path. The path ends at a node with no branches. Keywords
+  with parameters such as mjd#55000 match the graph keyword mjd#.
+
+  Resolved paths are memoized by (node, the obsmode keywords that appear
+  anywhere downstream of the node), so every obsmode that reaches a node
+  with the same relevant keywords shares the rest of its path.
+
+  Attributes:
+    graphtab -- file name of the graph table
+    comptab -- file name of the component table
+    error -- message if either table couldn't be read, otherwise None
+    digest -- sha1 of the contents of both tables, for cache keys
+
+  """
+  def __init__(self,graphtab,comptab):
+    self.graphtab = graphtab
+    self.comptab = comptab
+    self.error = None
+
+    # branches from each innode, as (keyword, compname, outnode) in table
+    # order
+    self.nodes = {}
+    self.components = set()
+
+    self._reachable = {}
+    self._paths = {}
+    self._results = {}
+
+    try:
+      self.digest = hashlib.sha1((_file_digest(hdu_digests(graphtab)) +
+                                  _file_digest(hdu_digests(comptab))
+                                  ).encode('ascii')).hexdigest()
+      self._read_graph(graphtab)
+      self._read_comps(comptab)
+    except (IOError,OSError,KeyError,IndexError,
+            fitsheader.HeaderParseError) as e:
+      self.digest = 'error'
+      self.error = 'Could not read graph tables {} and {}: {}'.format(
+                   graphtab,comptab,e)
+
+  def _read_graph(self,graphtab):
+    fits = pyfits.open(graphtab,'readonly')
+
+    try:
+      data = fits[1].data
+      keywords = np.char.lower(np.char.strip(data.field('keyword')))
+      compnames = np.char.lower(np.char.strip(data.field('compname')))
+      innodes = data.field('innode')
+      outnodes = data.field('outnode')
+
+      for keyword,compname,innode,outnode in zip(keywords,compnames,
+                                                 innodes,outnodes):
+        self.nodes.setdefault(int(innode),[]).append(
+            (str(keyword),str(compname),int(outnode)))
+    finally:
+      fits.close()
+
+  def _read_comps(self,comptab):
+    fits = pyfits.open(comptab,'readonly')
+
+    try:
+      compnames = np.char.lower(np.char.strip(fits[1].data.field('compname')))
+      self.components = set(str(c) for c in compnames)
+    finally:
+      fits.close()
+
+  def reachable(self,node):
+    """
+    frozenset of the keywords (other than 'default') on every branch that
+    can be reached from node.
+
+    """
+    if node in self._reachable:
+      return self._reachable[node]
+
+    # iterative depth first search, filling in nodes after their children
+    stack = [(node,False)]
+    visiting = set()
+
+    while stack:
+      n,done = stack.pop()
+
+      if n in self._reachable:
+        continue
+
+      branches = self.nodes.get(n,[])
+
+      if done:
+        keywords = set(k for k,c,o in branches if k != 'default')
+        for k,c,o in branches:
+          keywords |= self._reachable.get(o,frozenset())
+        self._reachable[n] = frozenset(keywords)
+        visiting.discard(n)
+        continue
+
+      visiting.add(n)
+      stack.append((n,True))
+      for k,c,o in branches:
+        # outnodes already being visited are loops, which resolve() reports
+        if o not in self._reachable and o not in visiting:
+          stack.append((o,False))
+
+    return self._reachable[node]
+
+  def resolve(self,keywords,node=1):
+    """
+    Follow the graph from node for a set of obsmode keywords. Returns
+    (compnames, used keywords, error), where error is a message if the path
+    couldn't be followed to the end of the graph and otherwise None.
+
+    """
+    keywords = frozenset(keywords)
+
+    steps = []
+    seen = set()
+
+    while True:
+      key = (node,keywords & self.reachable(node))
+
+      if key in self._paths:
+        result = self._paths[key]
+        break
+
+      branches = self.nodes.get(node)
+
+      if not branches:
+        result = ((),frozenset(),None)
+        break
+
+      if node in seen:
+        result = ((),frozenset(),'graph has a loop at node {}'.format(node))
+        break
+
+      seen.add(node)
+
+      chosen = None
+      default = None
+      for branch in branches:
+        if branch[0] in keywords:
+          chosen = branch
+          break
+        if branch[0] == 'default' and default is None:
+          default = branch
+
+      if chosen is None:
+        chosen = default
+
+      if chosen is None:
+        result = ((),frozenset(),'no default branch at node {}'.format(node))
+        break
+
+      steps.append((key,chosen))
+      node = chosen[2]
+
+    compnames,used,error = result
+
+    for key,(keyword,compname,outnode) in reversed(steps):
+      compnames = (compname,) + compnames
+      if keyword != 'default':
+        used = used | frozenset([keyword])
+      self._paths[key] = (compnames,used,error)
+
+    return compnames,used,error
+
+  def validate(self,obsmode):
+    """
+    Return a list of the problems with a normalized obsmode, empty if it
+    resolves to a throughput path.
+
+    """
+    if obsmode in self._results:
+      return self._results[obsmode]
+
+    keywords = set()
+    for component in obsmode.split(','):
+      if '#' in component:
+        component = component[:component.index('#') + 1]
+      if component:
+        keywords.add(component)
+
+    compnames,used,error = self.resolve(keywords)
+
+    problems = []
+
+    if error is not None:
+      problems.append(error)
+
+    unused = sorted(keywords - used)
+    if unused:
+      problems.append('keywords not used: {}'.format(', '.join(unused)))
+
+    missing = [c for c in compnames if c != 'clear' and
+               c not in self.components]
+    if missing:
+      problems.append('components not in COMPTAB: {}'.format(
+                      ', '.join(missing)))
+
+    self._results[obsmode] = problems
+
+    return problems
+
+def _obsmode_bytes(obsmodes):
+  """
+  An array of obsmode strings as bytes ('S'), the way the table stores them.
+  Unicode arrays take four bytes a character, so the index doesn't keep them.
+
+  """
+  obsmodes = np.asarray(obsmodes)
+
+  if obsmodes.dtype.kind == 'U':
+    obsmodes = np.char.encode(obsmodes,'ascii')
+
+  if len(obsmodes) == 0:
+    return np.array([],dtype='S1')
+
+  return obsmodes
+
+def _text(value):
+  """
+  A bytes value from an obsmode array as str, for messages and lookups.
+
+  """
+  if isinstance(value,bytes) and not isinstance(value,str):
+    return value.decode('ascii')
+
+  return value
+
+def normalize_obsmodes(obsmodes):
+  """
+  Normalized forms of an array of obsmode strings, as bytes: lower case, with
+  all blanks removed, so 'ACS, WFC1,F555W ' becomes 'acs,wfc1,f555w'.
+
+  """
+  obsmodes = _obsmode_bytes(obsmodes)
+
+  if len(obsmodes) == 0:
+    return obsmodes
+
+  return np.char.replace(np.char.lower(obsmodes),b' ',b'')
+
+class ObsmodeIndex(object):
+  """
+  Index of the obsmodes of the rows of one or more IMPHTTAB extensions.
+
+  Normalized obsmodes (see normalize_obsmodes) are kept in arrays sorted by
+  extension and then obsmode, alongside the row number of each, so exact and
+  prefix lookups are binary searches within one extension's range and rows
+  sharing an obsmode are next to each other. Prefixes match whole comma
+  separated components: 'acs,wfc1' matches 'acs,wfc1' and 'acs,wfc1,f555w' but
+  not 'acs,wfc12'. Obsmodes are kept as bytes, as the table stores them, and
+  are returned as str.
+
+  Lookups return lists of (extension number, row) pairs sorted by extension
+  and row, or with prefix_rows() an array of the rows of one extension. An
+  index can be saved to and loaded from a numpy .npz file.
+
+  Input:
+    columns -- list of (extension number, obsmode column) pairs
+
+  """
+  def __init__(self,columns=()):
+    ext_nums = []
+    rows = []
+    obsmodes = []
+
+    for ext_num,obsmode in columns:
+      obsmode = np.char.rstrip(_obsmode_bytes(obsmode))
+      ext_nums.append(np.zeros(len(obsmode),dtype=np.int32) + ext_num)
+      rows.append(np.arange(len(obsmode),dtype=np.int64))
+      obsmodes.append(obsmode)
+
+    if columns:
+      self._set(np.concatenate(ext_nums),np.concatenate(rows),
+                np.concatenate(obsmodes))
+    else:
+      self._set(np.array([],dtype=np.int32),np.array([],dtype=np.int64),
+                np.array([],dtype='S1'))
+
+  def _set(self,ext_nums,rows,obsmodes,keys=None):
+    # indexes saved by older versions hold unicode arrays
+    obsmodes = _obsmode_bytes(obsmodes)
+
+    if keys is None:
+      keys = normalize_obsmodes(obsmodes)
+    else:
+      keys = _obsmode_bytes(keys)
+
+    # sorted here even for loaded indexes, which may have been saved in
+    # another order
+    order = np.lexsort((rows,keys,ext_nums))
+
+    self.keys = keys[order]
+    self.ext_nums = ext_nums[order]
+    self.rows = rows[order]
+    self.obsmodes = obsmodes[order]
+
+    # range of positions in the sorted arrays of each extension, and the
+    # position of each of its rows
+    self._extents = {}
+    self._where = {}
+    for ext_num in np.unique(self.ext_nums):
+      lo = int(np.searchsorted(self.ext_nums,ext_num,'left'))
+      hi = int(np.searchsorted(self.ext_nums,ext_num,'right'))
+      where = np.zeros(hi - lo,dtype=np.int64)
+      where[self.rows[lo:hi]] = np.arange(lo,hi)
+      self._extents[int(ext_num)] = (lo,hi)
+      self._where[int(ext_num)] = where
+
+  @classmethod
+  def from_fits(cls,fits):
+    """
+    Index the obsmodes of every extension of an open IMPHTTAB HDUList.
+
+    """
+    return cls([(i,fits[i].data.field('obsmode'))
+                for i in range(1,len(fits))])
+
+  @classmethod
+  def from_stream(cls,stream,ext_num,chunk_rows):
+    """
+    Index the obsmodes of the extension read by a TableStream, chunk_rows rows
+    at a time.
+
+    """
+    return cls([(ext_num,_stream_obsmodes(stream,chunk_rows))])
+
+  @classmethod
+  def from_file(cls,filename,chunk_rows):
+    """
+    Index the obsmodes of every extension of an IMPHTTAB file, reading them
+    with TableStreams chunk_rows rows at a time.
+
+    """
+    columns = []
+
+    for ext_num in range(1,len(fitsheader.read_headers(filename))):
+      stream = TableStream(filename,ext_num)
+      try:
+        columns.append((ext_num,_stream_obsmodes(stream,chunk_rows)))
+      finally:
+        stream.close()
+
+    return cls(columns)
+
+  @classmethod
+  def cached(cls,filename,cache_dir,digests=None,chunk_rows=None):
+    """
+    The index of an IMPHTTAB file, loaded from cache_dir if it was saved there
+    for the same file contents and otherwise built and saved there. digests
+    are the file's hdu_digests(), computed if not given. The index is read
+    through pyfits unless chunk_rows is given.
+
+    """
+    if digests is None:
+      digests = hdu_digests(filename)
+
+    path = cls.cache_path(cache_dir,digests)
+
+    if os.path.exists(path):
+      return cls.load(path)
+
+    if chunk_rows is not None:
+      index = cls.from_file(filename,chunk_rows)
+    else:
+      fits = pyfits.open(filename,'readonly')
+      try:
+        index = cls.from_fits(fits)
+      finally:
+        fits.close()
+
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+    index.save(path)
+
+    return index
+
+  @staticmethod
+  def cache_path(cache_dir,digests):
+    """
+    Where cached() keeps the index of a file with hdu_digests() digests.
+
+    """
+    return os.path.join(cache_dir,'{}.npz'.format(_file_digest(digests)))
+
+  def save(self,filename):
+    """
+    Save the index to a numpy .npz file. Writes to a temporary file first
+    and renames it so readers never see a partly written index.
+
+    """
+    tmp = '{}.{}.tmp'.format(filename,os.getpid())
+
+    with open(tmp,'wb') as f:
+      np.savez(f,keys=self.keys,ext_nums=self.ext_nums,rows=self.rows,
+               obsmodes=self.obsmodes)
+
+    os.rename(tmp,filename)
+
+  @classmethod
+  def load(cls,filename):
+    """
+    Load an index saved with save().
+
+    """
+    index = cls()
+
+    with np.load(filename) as saved:
+      index._set(saved['ext_nums'],saved['rows'],saved['obsmodes'],
+                 saved['keys'])
+
+    return index
+
+  def __len__(self):
+    return len(self.keys)
+
+  def obsmode(self,ext_num,row):
+    """
+    The obsmode of one row as it appears in the table, less trailing blanks.
+
+    """
+    return _text(self.obsmodes[self._where[ext_num][row]])
+
+  def _positions(self,obsmode,ext_num,prefix):
+    """
+    Positions in the sorted arrays of the rows matching obsmode, exactly or
+    as a prefix, in every extension or only in extension ext_num. Each
+    extension's range of keys is binary searched.
+
+    """
+    key = normalize_obsmodes([obsmode])[0]
+
+    # every key starting with key + ',' sorts from key + ',' up to key + '-'
+    if prefix:
+      key = key.rstrip(b',')
+      bounds = [(key,key,'right'),(key + b',',key + b'-','left')]
+    else:
+      bounds = [(key,key,'right')]
+
+    if ext_num is None:
+      extents = [self._extents[e] for e in sorted(self._extents)]
+    else:
+      extents = [self._extents.get(ext_num,(0,0))]
+
+    positions = []
+    for lo,hi in extents:
+      keys = self.keys[lo:hi]
+      for start,stop,side in bounds:
+        positions.append(np.arange(lo + np.searchsorted(keys,start,'left'),
+                                   lo + np.searchsorted(keys,stop,side)))
+
+    if not positions:
+      return np.array([],dtype=np.int64)
+
+    return np.concatenate(positions)
+
+  def _pairs(self,positions):
+    order = np.lexsort((self.rows[positions],self.ext_nums[positions]))
+    positions = positions[order]
+    return list(zip(self.ext_nums[positions].tolist(),
+                    self.rows[positions].tolist()))
+
+  def exact(self,obsmode,ext_num=None):
+    """
+    Rows whose obsmode is obsmode once both are normalized, in every
+    extension or only in extension ext_num.
+
+    """
+    return self._pairs(self._positions(obsmode,ext_num,False))
+
+  def prefix(self,obsmode,ext_num=None):
+    """
+    Rows whose obsmode is obsmode or starts with obsmode followed by more
+    components, in every extension or only in extension ext_num.
+
+    """
+    return self._pairs(self._positions(obsmode,ext_num,True))
+
+  def prefix_rows(self,obsmode,ext_num):
+    """
+    prefix() for one extension, as a sorted array of row numbers.
+
+    """
+    return np.sort(self.rows[self._positions(obsmode,ext_num,True)])
+
+  def duplicates(self,ext_num=None):
+    """
+    Groups of rows of the same extension that share a normalized obsmode, as
+    a list of lists of (extension number, row) pairs, ordered by the first
+    row of each group. Only extension ext_num is looked at if it's given.
+    Empty obsmodes are not counted.
+
+    """
+    if ext_num is None:
+      lo,hi = 0,len(self.keys)
+    else:
+      lo,hi = self._extents.get(ext_num,(0,0))
+
+    if hi - lo < 2:
+      return []
+
+    keys = self.keys[lo:hi]
+    ext_nums = self.ext_nums[lo:hi]
+
+    same = ((keys[1:] == keys[:-1]) &
+            (ext_nums[1:] == ext_nums[:-1]) &
+            (keys[1:] != b''))
+
+    groups = []
+    for i in np.nonzero(same)[0] + lo:
+      if groups and groups[-1][-1] == i:
+        groups[-1].append(i + 1)
+      else:
+        groups.append([i,i + 1])
+
+    groups = [[(int(self.ext_nums[i]),int(self.rows[i])) for i in group]
+              for group in groups]
+
+    return sorted(groups)
+
+def _stream_obsmodes(stream,chunk_rows):
+  """
+  The whole obsmode column of the extension read by a TableStream, as bytes
+  with trailing blanks stripped.
+
+  """
+  field = stream.columns['OBSMODE'][0]
+  obsmode = [np.char.rstrip(columns.rows[field])
+             for start,columns in stream.chunks(chunk_rows)]
+
+  if not obsmode:
+    return np.array([],dtype='S1')
+
+  return np.concatenate(obsmode)
+
+class TableStream(object):
+  """
+  Reads the rows of a binary table extension straight from a memory map of
+  the file, a chunk at a time, without going through pyfits. The header is
+  read with fitsheader. Only one chunk of rows is copied out of the map at
+  once and variable length array cells are read from the heap as needed, so
+  memory use is bounded by the chunk size rather than the table size.
+  Gzipped files can't be mapped and raise ValueError.
+
+  Attributes:
+    name -- EXTNAME of the extension
+    nrows -- number of rows in the table
+    ncols -- number of columns in the table
+
+  """
+  def __init__(self,filename,ext_num):
+    if is_gzipped(filename):
+      raise ValueError('{}: gzipped files can\'t be streamed.'.format(filename))
+
+    self.header = fitsheader.read_header(filename,ext_num)
+    self.name = self.header.name
+    self.nrows = self.header.get('NAXIS2',0)
+    self.ncols = self.header.get('TFIELDS',0)
+    self.row_size = self.header.get('NAXIS1',0)
+
+    self.columns = {}
+    dtype = []
+
+    for n in range(1,self.ncols+1):
+      name = self.header.get('TTYPE{}'.format(n),'col{}'.format(n))
+      tform = self.header.get('TFORM{}'.format(n),'')
+      match = re.match(r'^\s*(\d*)([A-Z])(?:([A-Z]))?',tform)
+      repeat = int(match.group(1) or 1)
+      code = match.group(2)
+
+      if code in 'PQ':
+        dtype.append((name,STREAM_DTYPE[code],(2,)))
+      elif code == 'A':
+        dtype.append((name,'S{}'.format(repeat)))
+      elif code == 'X':
+        dtype.append((name,'u1',((repeat + 7) // 8,)))
+      elif repeat == 1:
+        dtype.append((name,STREAM_DTYPE[code]))
+      else:
+        dtype.append((name,STREAM_DTYPE[code],(repeat,)))
+
+      element = match.group(3) if code in 'PQ' else None
+      self.columns[name.upper()] = (name,code,element)
+
+    self.dtype = np.dtype(dtype)
+
+    table_size = self.row_size * self.nrows
+    self.heap_offset = (self.header.data_offset +
+                        self.header.get('THEAP',table_size))
+
+    self._file = open(filename,'rb')
+    if self.header.data_size > 0:
+      self._map = mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+    else:
+      self._map = None
+
+  def chunks(self,chunk_rows):
+    """
+    Generator of (first row number, ChunkColumns) for each chunk of up to
+    chunk_rows rows, in order.
+
+    """
+    chunk_rows = max(1,int(chunk_rows))
+
+    for start in range(0,self.nrows,chunk_rows):
+      stop = min(start + chunk_rows,self.nrows)
+      offset = self.header.data_offset + start * self.row_size
+      rows = np.frombuffer(self._map[offset:offset + (stop-start)*self.row_size],
+                           dtype=self.dtype)
+      yield start,ChunkColumns(self,rows)
+
+  def heap_cell(self,element,count,offset):
+    """
+    Read one variable length array cell of count elements of format element
+    from offset bytes into the heap.
+
+    """
+    dtype = np.dtype(STREAM_DTYPE[element])
+    start = self.heap_offset + offset
+    return np.frombuffer(self._map[start:start + count*dtype.itemsize],
+                         dtype=dtype)
+
+  def heap_firsts(self,element,offsets):
+    """
+    Read the first element of format element at each of offsets bytes into
+    the heap, with one index into the map rather than a read per cell.
+
+    """
+    dtype = np.dtype(STREAM_DTYPE[element])
+    heap = np.frombuffer(self._map,dtype=np.uint8,offset=self.heap_offset)
+    index = np.asarray(offsets,dtype=np.int64)[:,None] + \
+            np.arange(dtype.itemsize)
+    firsts = heap[index].view(dtype)[:,0]
+    del heap
+
+    return firsts
+
+  def close(self):
+    if self._map is not None:
+      self._map.close()
+    self._file.close()
+
+class ChunkColumns(object):
+  """
+  The same interface as ExtColumns over one chunk of rows from a
+  TableStream, for RuleSet. Variable length array cells are read from the
+  heap only for the lengths and first elements array_info() needs and for
+  cells that are printed in messages.
+
+  Attributes:
+    nrows -- number of rows in the chunk
+    ncols -- number of columns in the table
+
+  """
+  def __init__(self,stream,rows):
+    self.stream = stream
+    self.rows = rows
+    self.nrows = len(rows)
+    self.ncols = stream.ncols
+
+    self._values = {}
+    self._arrays = {}
+
+  def _column(self,name):
+    try:
+      return self.stream.columns[name.upper()]
+    except KeyError:
+      raise KeyError('Key {!r} does not exist.'.format(name))
+
+  def strings(self,name):
+    """
+    String column name as an array of str with trailing blanks stripped.
+
+    """
+    field = self._column(name)[0]
+    return np.char.rstrip(self.rows[field]).astype(str)
+
+  def values(self,name):
+    """
+    Column name as an array with one value per row. String columns have
+    trailing blanks stripped.
+
+    """
+    key = name.upper()
+
+    if key not in self._values:
+      field,code,element = self._column(name)
+      if code == 'A':
+        self._values[key] = self.strings(name)
+      else:
+        self._values[key] = self.rows[field]
+
+    return self._values[key]
+
+  def cell(self,name,row):
+    """
+    The value of column name in one row, as it would be printed.
+
+    """
+    field,code,element = self._column(name)
+
+    if code == 'A':
+      return self.values(name)[row]
+    elif code in 'PQ':
+      count,offset = self.rows[field][row]
+      return self.stream.heap_cell(element,int(count),int(offset))
+
+    return self.rows[field][row]
+
+  def array_info(self,name):
+    """
+    Describe a column whose cells should be arrays, as ExtColumns.array_info
+    does.
+
+    """
+    key = name.upper()
+
+    if key not in self._arrays:
+      field,code,element = self._column(name)
+      values = self.rows[field]
+
+      if code == 'A':
+        self._arrays[key] = ('string',None,None)
+      elif code in 'PQ':
+        lengths = values[:,0].astype(np.int64)
+        firsts = np.zeros(self.nrows)
+        nonempty = lengths > 0
+        if nonempty.any():
+          firsts[nonempty] = self.stream.heap_firsts(element,
+                                                     values[nonempty,1])
+        self._arrays[key] = ('array',lengths,firsts)
+      elif values.ndim > 1:
+        flat = values.reshape(len(values),-1)
+        lengths = np.zeros(len(values),dtype=np.int64) + flat.shape[1]
+        firsts = flat[:,0] if flat.shape[1] > 0 else np.zeros(len(values))
+        self._arrays[key] = ('array',lengths,firsts)
+      else:
+        self._arrays[key] = ('scalar',None,None)
+
+    return self._arrays[key]
+
+class RuleSet(object):
+  """
+  The row checks for IMPHTTAB extensions with a given number of parameters
+  (the PARNUM header keyword).
+
+  Which columns should be populated depends on the DATACOL value of a row, so
+  the checks are compiled into a list of rules for each DATACOL value the
+  first time it's seen. Each rule tests one column and is evaluated as a
+  numpy mask over all the rows sharing that DATACOL value. Messages are only
+  made for the rows that fail.
+
+  Rules are (kind, column, other) tuples. The kinds are:
+    nonzero -- column should not be 0
+    zero -- column should be 0
+    zero_array -- column should be the array [0]
+    blank -- column should be ''
+    not_blank -- column should not be ''
+    nelem_len -- length of column should be the product of the NELEM# columns
+                 listed in other
+    par_len -- length of column should be the value of the NELEM# column other
+
+  """
+  def __init__(self,num_par):
+    self.num_par = num_par
+    self.len_should = 5 + (4 * num_par)
+    self._rules = {}
+
+  def rules_for(self,datacol):
+    """
+    Return the list of rules for rows with the given DATACOL value, compiling
+    them if this is the first time datacol has been seen.
+
+    """
+    if datacol not in self._rules:
+      self._rules[datacol] = self.compile(datacol)
+
+    return self._rules[datacol]
+
+  def compile(self,datacol):
+    """
+    Make the list of rules for rows with the given DATACOL value. Does the
+    column specified in the datacol column contain data, and do the other data
+    columns contain zero? Also checks the parameter names, values and number
+    of elements columns.
+
+    """
+    num_par = self.num_par
+    rules = []
+
+    if datacol[-1:] not in [str(x) for x in range(1,num_par+1)]:
+      # plain, single number case
+      # the data column has a value, the other data columns are [0], the
+      # parameter names are '', the parameter values are [0] and the NELEM#
+      # columns are 0
+      rules.append(('nonzero',datacol,None))
+
+      for x in range(1,num_par+1):
+        rules.append(('zero_array','{}{}'.format(datacol,x),None))
+
+      for x in range(1,num_par+1):
+        rules.append(('blank','PAR{}NAMES'.format(x),None))
+
+      for x in range(1,num_par+1):
+        rules.append(('zero_array','PAR{}VALUES'.format(x),None))
+
+      for x in range(1,num_par+1):
+        rules.append(('zero','NELEM{}'.format(x),None))
+
+    else:
+      # one of the parameter sets that's stored as an array
+      # (stuff here starts assuming that there are 9 or fewer parameters)
+      # (i.e., they only take up one character space)
+      npar = int(datacol[-1])
+
+      # the plain data column is 0
+      rules.append(('zero',datacol[:-1],None))
+
+      # the array length in datacol should be nelem1 * nelem2 * ... up to and
+      # including nelem#npar, none of which should be 0
+      nelems = ['NELEM{}'.format(x) for x in range(1,npar+1)]
+
+      for n in nelems:
+        rules.append(('nonzero',n,None))
+
+      rules.append(('nelem_len',datacol,nelems))
+
+      # the rest of the NELEM# fields are 0
+      for x in range(npar+1,num_par+1):
+        rules.append(('zero','NELEM{}'.format(x),None))
+
+      # only the data column specified by datacol should be populated, all
+      # others should be [0]
+      for x in range(1,num_par+1):
+        if x != npar:
+          rules.append(('zero_array','{}{}'.format(datacol[:-1],x),None))
+
+      # parameter names up to and including npar should be populated, higher
+      # ones should be ''
+      for x in range(1,npar+1):
+        rules.append(('not_blank','PAR{}NAMES'.format(x),None))
+
+      for x in range(npar+1,num_par+1):
+        rules.append(('blank','PAR{}NAMES'.format(x),None))
+
+      # par#values columns up to npar should have the length given in the
+      # corresponding nelem# column, the rest should be [0]
+      for x in range(1,npar+1):
+        rules.append(('par_len','PAR{}VALUES'.format(x),'NELEM{}'.format(x)))
+
+      for x in range(npar+1,num_par+1):
+        rules.append(('zero_array','PAR{}VALUES'.format(x),None))
+
+    return rules
+
+  def evaluate(self,columns,ext_num,row_offset=0):
+    """
+    Run every check on the rows in columns (an ExtColumns) and return the
+    list of messages for the rows that fail, in row order and, within a row,
+    in the order the checks are listed in self.compile(). row_offset is added
+    to row numbers in messages.
+
+    """
+    # (row, check number, message) for every failure
+    findings = []
+
+    # is obsmode set to something?
+    empty = np.char.str_len(columns.values('obsmode')) == 0
+    for row in np.nonzero(empty)[0]:
+      s = 'Obsmode column is empty for extension {} row {}'
+      findings.append((row,0,s.format(ext_num,row + row_offset)))
+
+    # does the row have the expected number of columns?
+    if columns.ncols != self.len_should:
+      s = 'Row {} of extension {} should have length {} but has length {}'
+      for row in range(columns.nrows):
+        findings.append((row,1,s.format(row + row_offset,ext_num,
+                                        self.len_should,columns.ncols)))
+
+    datacols = np.char.strip(columns.values('datacol'))
+
+    for datacol in np.unique(datacols):
+      rows = np.nonzero(datacols == datacol)[0]
+
+      for i,rule in enumerate(self.rules_for(str(datacol))):
+        fail = self.test(rule,columns,rows)
+        for row in rows[fail]:
+          findings.append((row,i + 2,self.message(rule,columns,row,ext_num,
+                                                  row_offset)))
+
+    findings.sort(key=lambda f: (f[0],f[1]))
+
+    return [f[2] for f in findings]
+
+  def test(self,rule,columns,rows):
+    """
+    Evaluate one rule over the given rows. Returns a boolean array, True for
+    the rows that fail.
+
+    """
+    kind,column,other = rule
+
+    if kind == 'nonzero':
+      return columns.values(column)[rows] == 0
+    elif kind == 'zero':
+      return columns.values(column)[rows] != 0
+    elif kind == 'blank':
+      return columns.values(column)[rows] != ''
+    elif kind == 'not_blank':
+      return columns.values(column)[rows] == ''
+    elif kind == 'zero_array':
+      array_kind,lengths,firsts = columns.array_info(column)
+      if array_kind != 'array':
+        return np.ones(len(rows),dtype=bool)
+      return ~((lengths[rows] == 1) & (firsts[rows] == 0))
+    elif kind == 'nelem_len':
+      expected = np.ones(len(rows),dtype=np.int64)
+      for n in other:
+        expected *= columns.values(n)[rows]
+      return self._lengths(columns,column,rows) != expected
+    elif kind == 'par_len':
+      return self._lengths(columns,column,rows) != columns.values(other)[rows]
+
+    raise ValueError('Unknown rule kind {}'.format(kind))
+
+  def _lengths(self,columns,column,rows):
+    array_kind,lengths,firsts = columns.array_info(column)
+
+    if array_kind != 'array':
+      return np.ones(len(rows),dtype=np.int64)
+
+    return lengths[rows]
+
+  def message(self,rule,columns,row,ext_num,row_offset=0):
+    """
+    Make the message for a row that fails a rule.
+
+    """
+    kind,column,other = rule
+    row_num = row + row_offset
+
+    if kind == 'nonzero':
+      s = 'Column {} of extension {} row {} is zero and shouldn\'t be.'
+      return s.format(column, ext_num, row_num)
+    elif kind == 'zero':
+      s = 'Column {} of extension {} row {} is not 0. {} instead.'
+      return s.format(column, ext_num, row_num, columns.cell(column,row))
+    elif kind == 'zero_array':
+      if columns.array_info(column)[0] == 'string':
+        s = 'Column {} of extension {} row {} is not an array. {} instead.'
+      else:
+        s = 'Column {} of extension {} row {} is not [0]. {} instead.'
+      return s.format(column, ext_num, row_num, columns.cell(column,row))
+    elif kind == 'blank':
+      s = 'Column {} of extension {} row {} has value {} when it should be blank.'
+      return s.format(column, ext_num, row_num, columns.cell(column,row))
+    elif kind == 'not_blank':
+      s = 'Column {} of extension {} row {} is blank when it shouldn\'t be.'
+      return s.format(column, ext_num, row_num)
+    elif kind == 'nelem_len':
+      data_len = 1
+      for n in other:
+        data_len *= columns.values(n)[row]
+      s = 'Column {} of extension {} row {} should have length {}. Has length {} instead.'
+      return s.format(column, ext_num, row_num, data_len,
+                      self._lengths(columns,column,np.array([row]))[0])
+    elif kind == 'par_len':
+      s = 'Length of column {} of extension {} row {} should be {}. {} instead.'
+      return s.format(column, ext_num, row_num, columns.values(other)[row],
+                      self._lengths(columns,column,np.array([row]))[0])
+
+    raise ValueError('Unknown rule kind {}'.format(kind))
+
+def parse_args():
+  parser = argparse.ArgumentParser(description=
+                                   'Check an IMPHTTAB for internal consistency.')
+
+  parser.add_argument('impht', type=str, nargs='+',
+                      help='Names of IMPHTTAB fits tables.')
+
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help='Number of worker processes used to check '
+                           'extensions. Defaults to 1.')
+
+  parser.add_argument('--cache', type=str, default=None,
+                      help='sqlite file used to cache findings for files '
+                           'and extensions that haven\'t changed.')
+
+  parser.add_argument('--stream', type=int, default=None, metavar='ROWS',
+                      help='Read extension data straight from the file ROWS '
+                           'rows at a time to keep memory use down on very '
+                           'large tables. Gzipped files are read through '
+                           'pyfits as usual.')
+
+  parser.add_argument('--index-cache', type=str, default=None, metavar='DIR',
+                      help='Directory where obsmode indexes of the tables '
+                           'are saved and reused.')
+
+  parser.add_argument('--graph', action='store_true',
+                      help='Check that every obsmode resolves to a '
+                           'throughput path through the GRAPHTAB and '
+                           'COMPTAB.')
+
+  parser.add_argument('--graphtab', type=str, default=None,
+                      help='GRAPHTAB to use instead of the one in the '
+                           'header. Implies --graph.')
+
+  parser.add_argument('--comptab', type=str, default=None,
+                      help='COMPTAB to use instead of the one in the '
+                           'header. Implies --graph.')
+
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+
+  if args.cache is not None:
+    cache = FindingsCache(args.cache)
+  else:
+    cache = None
+
+  try:
+    graph = args.graph or args.graphtab is not None or args.comptab is not None
+    check_files(args.impht,args.jobs,cache,args.stream,args.index_cache,
+                graph,args.graphtab,args.comptab)
+  finally:
+    if cache is not None:
+      cache.close()
+
+if __name__ == '__main__':
+  raise SystemExit(main())
@@ -6,21 +6,98 @@ This script compares two fits files and gives some information about whether it
 thinks they are the same, in the sense that their headers and data appear to be
 the same.
 
-Usage: compfits.py <fits file 1> <fits file 2>
+Usage: compfits.py [-b BLOCK_SIZE] <fits file 1> <fits file 2>
+       compfits.py [-j JOBS] <directory 1> <directory 2>
+
+Use -b/--block-size to compare data arrays in blocks of at most BLOCK_SIZE
+bytes over memory mapped files, which keeps memory use down for very large
+images and stops at the first block containing a difference.
+
+Use --cache to keep per-extension digests of each file in an on disk cache
+(see DigestCache). Files whose cached digests match are reported as the same
+without being opened again.
+
+Use -a/--all to report every difference found in one pass instead of
+stopping at the first one, or --json to print that report as JSON. Data
+arrays are compared with the --rtol and --atol tolerances and each differing
+image gets a count of differing pixels, the largest absolute and relative
+differences, and the bounding box of the differences.
+
+Use --headers-only to compare just the headers. Headers are read straight
+from the header blocks (see fitsheader.py) and data units are skipped with
+seek, so this takes time in proportion to the size of the headers.
+
+Binary table extensions are compared column by column. Variable length array
+columns are compared straight from the heap. Use --col-tol NAME=RTOL,ATOL to
+give a column its own tolerances.
+
+Tile compressed images are compared a tile at a time. Tiles whose compressed
+bytes match are skipped and only differing tiles are decompressed.
+
+Given two directories, every fits file under the first is compared with the
+file at the same relative path under the second using a pool of worker
+processes. A line is printed for each pair as it finishes, followed by a
+summary of identical, different, missing and extra files.
 
 """
 
-import sys
+import argparse
+import fnmatch
+import itertools
+import multiprocessing
+import multiprocessing.util
+import hashlib
+import json
+import mmap
+import os
+import re
+import sqlite3
+import time
 
 import numpy as np
 
 import pyfits
 
+import fitsheader
+
 # some header values we can't expect to be the same (e.g. time lost modified)
 # so let up a global list of those values here and make sure they're ignored
 # in CompareFits.compare_header_values()
 IGNORE_HEADER_VALUES = ['IRAF-TLM','DATE']
 
+# number of bytes compared at a time by CompareFits.compare_raw_data() when
+# no block size has been given
+RAW_BLOCK_SIZE = 4 * 1024 * 1024
+
+# default location and size (in files) of the on disk digest cache
+DIGEST_CACHE = os.path.join(os.path.expanduser('~'),'.compfits_cache.db')
+DIGEST_CACHE_SIZE = 10000
+
+# changes whenever the digests change, so entries cached by older versions
+# aren't used
+DIGEST_VERSION = 2
+
+# element sizes in bytes of binary table formats, used when reading variable
+# length array columns from the heap. X (bits) is handled separately.
+TABLE_ITEMSIZE = {'L': 1, 'B': 1, 'A': 1, 'I': 2, 'J': 4, 'K': 8,
+                  'E': 4, 'D': 8, 'C': 8, 'M': 16}
+
+# numpy types of the fixed width binary table formats, used to read the rows
+# of compressed image tables. A (strings) and X (bits) are handled separately.
+TABLE_ROW_DTYPE = {'L': 'i1', 'B': 'u1', 'I': '>i2', 'J': '>i4', 'K': '>i8',
+                   'E': '>f4', 'D': '>f8', 'C': '>c8', 'M': '>c16',
+                   'P': '>i4', 'Q': '>i8'}
+
+# numpy types of the stored values of images, by BITPIX
+IMAGE_DTYPE = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+# numpy types of the numeric binary table formats
+TABLE_DTYPE = {'B': 'u1', 'I': '>i2', 'J': '>i4', 'K': '>i8',
+               'E': '>f4', 'D': '>f8', 'C': '>c8', 'M': '>c16'}
+
+# file name patterns picked up when comparing directory trees
+TREE_PATTERNS = ['*.fits','*.fit','*.fits.gz']
+
 class FitsError(Exception):
   """
   Base class of exceptions for comparing fits files.
@@ -84,8 +161,8 @@ class FitsHeaderKeyError(FitsError):
   Exception raised when fits file headers have different keys.
 
   Attributes:
-    header1 -- first fits file header (pyfits.PrimaryHDU object)
-    header2 -- second fits file header (pyfits.PrimaryHDU object)
+    header1 -- first fits file header (fitsheader.CardMap object)
+    header2 -- second fits file header (fitsheader.CardMap object)
     header1_extra_keys -- list of header keys in first fits but not second
     header2_extra_keys -- list of header keys in second fits but not first
     ext_num -- fits file extension number for this error
@@ -107,8 +184,8 @@ class FitsHeaderValueError(FitsError):
   Exception raised when fits file headers have different values.
 
   Attributes:
-    header1 -- first fits file header (pyfits.PrimaryHDU object)
-    header2 -- second fits file header (pyfits.PrimaryHDU object)
+    header1 -- first fits file header (fitsheader.CardMap object)
+    header2 -- second fits file header (fitsheader.CardMap object)
     diff_keys -- list of header keys for which the values differ
     ext_num -- fits file extension number for this error
     msg -- may contain a message describing the error
@@ -130,22 +207,79 @@ class FitsDataError(FitsError):
     data2 -- data array from second fits file
     ext_num -- fits extension number for this error
     msg -- may contain a message describing the error
+    index -- index tuple (zero based) of the first differing pixel, if known
 
   """
-  def __init__(self,data1,data2,ext_num,msg=''):
+  def __init__(self,data1,data2,ext_num,msg='',index=None):
     self.data1 = data1
     self.data2 = data2
     self.ext_num = ext_num
     self.msg = msg
+    self.index = index
+
+
+class FitsTableError(FitsError):
+  """
+  Exception raised when binary table extensions have different columns,
+  different numbers of rows, or columns with different values.
 
+  Attributes:
+    ext_num -- fits extension number for this error
+    columns -- dictionary of differing column names and their first differing
+               row (zero based), empty if the tables don't line up at all
+    msg -- may contain a message describing the error
+
+  """
+  def __init__(self,ext_num,columns,msg=''):
+    self.ext_num = ext_num
+    self.columns = columns
+    self.msg = msg
 
 class CompareFits:
-  def __init__(self,fits1,fits2):
+  """
+  Compare two fits files.
+
+  Input:
+    fits1 -- name of first fits file
+    fits2 -- name of second fits file
+    block_size -- if given, data arrays are memory mapped and compared in
+                  blocks of at most this many bytes (see compare_data_blocks)
+    col_tol -- optional dictionary of (rtol, atol) tolerances for binary
+               table columns, keyed by column name (see compare_table).
+               Column names are matched without regard to case.
+    headers_only -- if True only the headers are read, pyfits isn't used to
+                    open the files, and run_all_comps() skips the size and
+                    data comparisons
+
+  Headers are compared using fitsheader.CardMap objects in self.headers1 and
+  self.headers2, read directly from the files' header blocks.
+
+  """
+  def __init__(self,fits1,fits2,block_size=None,col_tol=None,
+               headers_only=False):
     self.fits_file1 = fits1
     self.fits_file2 = fits2
+    self.block_size = block_size
+    self.col_tol = dict((name.upper(),tols)
+                        for name,tols in (col_tol or {}).items())
+    self.headers_only = headers_only
+
+    if headers_only:
+      self.fits1 = None
+      self.fits2 = None
+    elif block_size is not None:
+      self.fits1 = pyfits.open(fits1,memmap=True)
+      self.fits2 = pyfits.open(fits2,memmap=True)
+    else:
+      self.fits1 = pyfits.open(fits1)
+      self.fits2 = pyfits.open(fits2)
+
+    self.headers1 = _read_headers(fits1,self.fits1)
+    self.headers2 = _read_headers(fits2,self.fits2)
 
-    self.fits1 = pyfits.open(fits1)
-    self.fits2 = pyfits.open(fits2)
+    # extension numbers whose data sections are byte for byte identical,
+    # filled in by self.compare_raw_data()
+    self.raw_identical = set()
 
   def compare_length(self):
     """
@@ -155,8 +289,8 @@ class CompareFits:
     """
     same_length = False
 
-    len_fits1 = len(self.fits1)
-    len_fits2 = len(self.fits2)
+    len_fits1 = len(self.headers1)
+    len_fits2 = len(self.headers2)
 
     if len_fits1 == len_fits2:
       same_length = True
@@ -177,8 +311,8 @@ class CompareFits:
     """
     same_names = False
 
-    names1 = [x.name for x in self.fits1]
-    names2 = [x.name for x in self.fits2]
+    names1 = [x.name for x in self.headers1]
+    names2 = [x.name for x in self.headers2]
 
     if names1 == names2:
       same_names = True
@@ -194,7 +328,9 @@ class CompareFits:
     """
     Verify that the .size() and .filebytes() methods return matching values
     for each extension of the fits files. Raises FitsSizeError if either or
-    both sets of sizes do not match.
+    both sets of sizes do not match. The file sizes of tile compressed images
+    depend on how well each tile compressed, so they aren't compared; their
+    data is compared by compare_comp_image().
 
     """
     same_size = False
@@ -202,12 +338,19 @@ class CompareFits:
     size1 = [x.size() for x in self.fits1]
     size2 = [x.size() for x in self.fits2]
 
-    filebytes1 = [x.filebytes() for x in self.fits1]
-    filebytes2 = [x.filebytes() for x in self.fits2]
+    # the sizes of the header and data in the file, which is what
+    # .filebytes() works out, but without reading (and scaling) the data
+    filebytes1 = _filebytes(self.fits1)
+    filebytes2 = _filebytes(self.fits2)
+
+    same_filebytes = len(filebytes1) == len(filebytes2) and \
+                     all(filebytes1[i] == filebytes2[i] or
+                         self.is_comp_image_pair(i)
+                         for i in range(len(filebytes1)))
 
-    if (size1 == size2) and (filebytes1 == filebytes2):
+    if (size1 == size2) and same_filebytes:
       same_size = True
-    elif (size1 != size2) and (filebytes1 != filebytes2):
+    elif (size1 != size2) and not same_filebytes:
       msg = 'Fits file extensions do not have the same .size() or \n'
       msg += '.filebytes() sizes.\n'
       msg += '.size() sizes:\n'
@@ -222,7 +365,7 @@ class CompareFits:
       msg += '\tFits1 sizes: ' + repr(size1) + '\n'
       msg += '\tFits2 sizes: ' + repr(size2) + '\n'
       raise FitsSizeError(size1,size2,filebytes1,filebytes2,msg)
-    elif (filebytes1 == filebytes2):
+    elif same_filebytes:
       msg = 'Fits file extensions do not have the same .filebytes() values.\n'
       msg += '\tFits1 filebytes: ' + repr(filebytes1) + '\n'
       msg += '\tFits2 filebytes: ' + repr(filebytes2) + '\n'
@@ -230,10 +373,55 @@ class CompareFits:
 
     return same_size
 
+  def compare_raw_data(self):
+    """
+    Compare the data sections of each extension as raw bytes read through
+    mmap, with no decoding or scaling. Assumes the files have the same
+    extension layout, i.e. self.compare_length(), self.compare_names() and
+    self.compare_size() have passed. Extensions whose bytes match are added to
+    self.raw_identical and are skipped by self.compare_data(). Returns True if
+    all data sections are identical.
+
+    Files that can't be memory mapped as plain fits (e.g. gzipped files) are
+    left for the normal decoded comparison.
+
+    """
+    self.raw_identical = set()
+
+    raw1 = _map_fits(self.fits_file1)
+    raw2 = _map_fits(self.fits_file2)
+
+    if raw1 is None or raw2 is None:
+      for raw in (raw1,raw2):
+        if raw is not None:
+          raw.close()
+      return False
+
+    step = int(self.block_size or RAW_BLOCK_SIZE)
+
+    try:
+      for i in range(len(self.fits1)):
+        info1 = self.fits1.fileinfo(i)
+        info2 = self.fits2.fileinfo(i)
+
+        if info1['datSpan'] != info2['datSpan']:
+          continue
+
+        if _same_bytes(raw1,info1['datLoc'],raw2,info2['datLoc'],
+                       info1['datSpan'],step):
+          self.raw_identical.add(i)
+    finally:
+      raw1.close()
+      raw2.close()
+
+    return len(self.raw_identical) == len(self.fits1)
+
   def compare_header_keys(self,ext_num):
     """
     Verify that the fits files have the same header keys. Raises
-    FitsHeaderKeyError if the headers have different keys.
+    FitsHeaderKeyError if the headers have different keys. Repeated keys such
+    as COMMENT and HISTORY only need to appear in both headers; differences in
+    how many times they appear are reported by compare_header_values().
 
     Input:
       ext_num -- extension number (zero based) for which to compare heaer keys
@@ -241,21 +429,23 @@ class CompareFits:
     """
     same_header_keys = False
 
-    header_keys1 = sorted(self.fits1[ext_num].header.keys())
-    header_keys2 = sorted(self.fits2[ext_num].header.keys())
+    header1 = self.headers1[ext_num]
+    header2 = self.headers2[ext_num]
+
+    only1,only2,diff_values = fitsheader.diff_cards(header1,header2)
 
-    if header_keys1 == header_keys2:
+    if not only1 and not only2:
       same_header_keys = True
     else:
-      header1_extra_keys = sorted(set(header_keys1).difference(set(header_keys2)))
-      header2_extra_keys = sorted(set(header_keys2).difference(set(header_keys1)))
+      header1_extra_keys = sorted(only1)
+      header2_extra_keys = sorted(only2)
       msg = 'Fits files do not have the same header keys for extension ' + \
             str(ext_num) + '.\n'
       msg += 'Header keys in Fits1 but not Fits2:\n'
       msg += '\t' + repr(header1_extra_keys) + '\n'
       msg += 'Header keys in Fits2 but not Fits1:\n'
       msg += '\t' + repr(header2_extra_keys) + '\n'
-      raise FitsHeaderKeyError(self.fits1[ext_num].header,self.fits2[ext_num].header,
+      raise FitsHeaderKeyError(header1,header2,
                                header1_extra_keys,header2_extra_keys,ext_num,msg)
 
     return same_header_keys
@@ -264,7 +454,10 @@ class CompareFits:
     """
     Veryify that fits files have the same header values, assuming they have the
     same header keys. Raises FitsHeaderValueError if the headers have different
-    values.
+    values. Repeated keys such as COMMENT and HISTORY differ if their values
+    differ in any card, or they appear a different number of times. For tile
+    compressed images the keys describing the compressed table (see
+    _comp_table_keys()) are not compared.
 
     Input:
       ext_num -- extension number (zero based) for which to compare header values
@@ -272,14 +465,15 @@ class CompareFits:
     """
     same_header_values = False
 
-    header1 = self.fits1[ext_num].header
-    header2 = self.fits2[ext_num].header
+    header1 = self.headers1[ext_num]
+    header2 = self.headers2[ext_num]
 
-    diff_keys = []
+    # keys missing from header2 are reported by compare_header_keys(), and the
+    # table layout of compressed images by compare_comp_image()
+    ignore = set(IGNORE_HEADER_VALUES)
+    ignore.update(_comp_table_keys(header1) & _comp_table_keys(header2))
 
-    for key in header1.keys():
-      if (header1[key] != header2[key]) and (key not in IGNORE_HEADER_VALUES):
-        diff_keys.append(key)
+    only1,only2,diff_keys = fitsheader.diff_cards(header1,header2,ignore)
 
     if len(diff_keys) == 0:
       same_header_values = True
@@ -316,35 +510,56 @@ class CompareFits:
     """
     same_headers = True
 
-    for i in range(len(self.fits1)):
+    for i in range(len(self.headers1)):
       if self.compare_header_num(i) is not True:
         same_headers = False
         break
 
     return same_headers
 
+  def compare_data_shape(self,ext_num):
+    """
+    Verify that the data arrays for a fits extension have the same shape.
+    Raises FitsDataError if they do not.
+
+    Input:
+      ext_num -- extension number (zero based) for which to compare shapes
+
+    """
+    # shapes come from the headers so scaled images aren't read here
+    if _image_shape(self.headers1[ext_num]) != \
+       _image_shape(self.headers2[ext_num]):
+      data1 = self.fits1[ext_num].data
+      data2 = self.fits2[ext_num].data
+      msg = 'Data arrays for fits extension ' + str(ext_num) + ' do not have\n'
+      msg += 'matching shapes.\n'
+      msg += 'Fits1 shape: ' + repr(data1.shape) + '\n'
+      msg += 'Fits2 shape: ' + repr(data2.shape) + '\n'
+      raise FitsDataError(data1,data2,ext_num,msg)
+
+    return True
+
   def compare_data_array(self,ext_num):
     """
     Compare data ararys for a fits extension. Checks whether they are the same
-    shape and contain the same values.
+    shape and contain the same values. If self.block_size is set the comparison
+    is handed off to self.compare_data_blocks().
 
     Input:
       ext_num -- extension number (zero based) for which to compare data
 
     """
+    if self.block_size is not None:
+      return self.compare_data_blocks(ext_num)
+
     same_data = False
 
+    self.compare_data_shape(ext_num)
+
     data1 = self.fits1[ext_num].data
     data2 = self.fits2[ext_num].data
 
-    if data1.shape == data2.shape:
-      data_comp = (data1 == data2)
-    else:
-      msg = 'Data arrays for fits extension ' + str(ext_num) + ' do not have\n'
-      msg += 'matching shapes.\n'
-      msg += 'Fits1 shape: ' + repr(data1.shape) + '\n'
-      msg += 'Fits2 shape: ' + repr(data2.shape) + '\n'
-      raise FitsDataError(data1,data2,ext_num,msg)
+    data_comp = (data1 == data2)
 
     if bool(data_comp.all()) is True:
       same_data = True
@@ -354,6 +569,84 @@ class CompareFits:
 
     return same_data
 
+  def compare_data_blocks(self,ext_num):
+    """
+    Compare data arrays for a fits extension a block at a time, where each
+    block covers at most self.block_size bytes of either array. Only one pair
+    of blocks is held in memory at once so peak memory is set by the block
+    size rather than the array size. Stops at the first block that differs and
+    raises FitsDataError with the index of the first differing pixel.
+
+    The stored values are read from a memory map of each file (see
+    _raw_image) so that pyfits never scales a whole image with BSCALE and
+    BZERO. Blocks are compared unscaled when both images have the same
+    scaling, and only a block that differs, or every block if the scalings
+    differ, is scaled to compare the physical values. Files that can't be
+    mapped (e.g. gzipped files) and tile compressed images are compared
+    through pyfits.
+
+    Input:
+      ext_num -- extension number (zero based) for which to compare data
+
+    """
+    self.compare_data_shape(ext_num)
+
+    header1 = self.headers1[ext_num]
+    header2 = self.headers2[ext_num]
+
+    # compressed images are stored as tables, so only plain images are mapped
+    if self.is_comp_image_pair(ext_num):
+      data1 = data2 = None
+    else:
+      data1 = _raw_image(self.fits_file1,
+                         self.fits1.fileinfo(ext_num)['datLoc'],header1)
+      data2 = _raw_image(self.fits_file2,
+                         self.fits2.fileinfo(ext_num)['datLoc'],header2)
+
+    if data1 is not None and data2 is not None:
+      scaling1 = _scaling(header1)
+      scaling2 = _scaling(header2)
+    else:
+      data1 = self.fits1[ext_num].data
+      data2 = self.fits2[ext_num].data
+      scaling1 = scaling2 = None
+
+    # fits data are contiguous so these are views, not copies
+    flat1 = data1.reshape(-1)
+    flat2 = data2.reshape(-1)
+
+    itemsize = max(data1.itemsize,data2.itemsize)
+    step = max(1,int(self.block_size) // itemsize)
+
+    start = 0
+    while start < flat1.size:
+      block1 = flat1[start:start+step]
+      block2 = flat2[start:start+step]
+
+      if scaling1 == scaling2:
+        block_comp = (block1 == block2)
+      else:
+        block_comp = None
+
+      if block_comp is None or not block_comp.all():
+        block1 = _scale(block1,scaling1)
+        block2 = _scale(block2,scaling2)
+        block_comp = (block1 == block2)
+
+      if not block_comp.all():
+        first = int(np.argmin(block_comp))
+        index = tuple(int(i) for i in np.unravel_index(start + first,
+                                                        data1.shape))
+        msg = 'Data arrays for fits extension ' + str(ext_num) + ' are not equal.\n'
+        msg += 'First differing pixel (zero based): ' + repr(index) + '\n'
+        msg += 'Fits1 value: ' + repr(block1[first].item()) + '\n'
+        msg += 'Fits2 value: ' + repr(block2[first].item()) + '\n'
+        raise FitsDataError(data1,data2,ext_num,msg,index)
+
+      start += step
+
+    return True
+
   def compare_data(self):
     """
     Runs self.compare_data_array for all data arrays in the fits files, assuming
@@ -364,36 +657,521 @@ class CompareFits:
     same_data = True
 
     # loop over all fits extensions but we only want to run compare_data_array
-    # on the extensions that actually contain data arrays.
+    # on the extensions that actually contain data arrays. extensions already
+    # found to be byte for byte identical don't need their data decoded.
     for i in range(len(self.fits1)):
-      if (type(self.fits1[i]) == pyfits.ImageHDU) and \
-         (type(self.fits2[i]) == pyfits.ImageHDU) and \
-         (type(self.fits1[i].data) == np.ndarray) and \
-         (type(self.fits2[i].data) == np.ndarray):
+      if i in self.raw_identical:
+        continue
 
+      if self.is_image_pair(i):
         if self.compare_data_array(i) is not True:
           same_data = False
           break
+      elif self.is_table_pair(i):
+        if self.compare_table(i) is not True:
+          same_data = False
+          break
+      elif self.is_comp_image_pair(i):
+        if self.compare_comp_image(i) is not True:
+          same_data = False
+          break
 
     return same_data
 
+  def is_comp_image_pair(self,ext_num):
+    """
+    Returns True if extension ext_num is a tile compressed image (CompImageHDU)
+    in both fits files.
+
+    """
+    return (type(self.fits1[ext_num]) == pyfits.CompImageHDU) and \
+           (type(self.fits2[ext_num]) == pyfits.CompImageHDU)
+
+  def compare_comp_image(self,ext_num):
+    """
+    Compare tile compressed image extensions one tile at a time. The compressed
+    bytes of each tile (its row of the compressed table, including the heap
+    data it points to) are compared first and tiles that match are skipped
+    without decompressing them. Differing tiles are decompressed one at a time
+    through the HDU's section, where available, so memory use is bounded by
+    the tile size. Without a section (as in pyfits) both images are
+    decompressed whole, once, when the first differing tile is found. Raises
+    FitsDataError with the index of the first differing pixel.
+
+    Images with different tiling or compressed table layouts can't be matched
+    tile for tile and are compared with self.compare_data_array() instead.
+
+    Input:
+      ext_num -- extension number (zero based) for which to compare data
+
+    """
+    header1 = self.headers1[ext_num]
+    header2 = self.headers2[ext_num]
+
+    tiles = _tile_slices(header1)
+    columns = _table_columns(header1)
+
+    if tiles != _tile_slices(header2) or columns != _table_columns(header2):
+      return self.compare_data_array(ext_num)
+
+    raw1 = _map_fits(self.fits_file1)
+    raw2 = _map_fits(self.fits_file2)
+
+    if raw1 is None or raw2 is None:
+      for raw in (raw1,raw2):
+        if raw is not None:
+          raw.close()
+      return self.compare_data_array(ext_num)
+
+    try:
+      rows1 = _table_rows(raw1,header1,columns)
+      rows2 = _table_rows(raw2,header2,columns)
+
+      heap1 = _heap_offset(header1)
+      heap2 = _heap_offset(header2)
+
+      hdu1 = self.fits1[ext_num]
+      hdu2 = self.fits2[ext_num]
+      sectioned = hasattr(hdu1,'section') and hasattr(hdu2,'section')
+
+      data1 = None
+      data2 = None
+
+      for k,slices in enumerate(tiles):
+        if _same_tile(rows1[k],rows2[k],columns,raw1,heap1,raw2,heap2):
+          continue
+
+        if sectioned:
+          tile1 = hdu1.section[slices]
+          tile2 = hdu2.section[slices]
+        else:
+          if data1 is None:
+            data1 = hdu1.data
+            data2 = hdu2.data
+          tile1 = data1[slices]
+          tile2 = data2[slices]
+
+        tile_diff = _diff_mask(tile1,tile2)
+
+        if tile_diff.any():
+          first = np.unravel_index(int(np.argmax(tile_diff)),tile_diff.shape)
+          index = tuple(int(sl.start + i) for sl,i in zip(slices,first))
+          msg = 'Data arrays for fits extension ' + str(ext_num) + ' are not equal.\n'
+          msg += 'First differing tile (zero based): ' + str(k) + '\n'
+          msg += 'First differing pixel (zero based): ' + repr(index) + '\n'
+          raise FitsDataError(tile1,tile2,ext_num,msg,index)
+    finally:
+      raw1.close()
+      raw2.close()
+
+    return True
+
+  def is_table_pair(self,ext_num):
+    """
+    Returns True if extension ext_num is a BinTableHDU (but not a compressed
+    image) in both fits files.
+
+    """
+    return (type(self.fits1[ext_num]) == pyfits.BinTableHDU) and \
+           (type(self.fits2[ext_num]) == pyfits.BinTableHDU)
+
+  def table_diff(self,ext_num,rtol=0.,atol=0.):
+    """
+    Compare binary table extensions column by column. Each column is compared
+    as a whole with numpy; numeric columns use the tolerances in self.col_tol
+    for that column or else rtol and atol (see _diff_mask). Variable length
+    array columns are compared straight from the heap (see heap_column_diff).
+
+    Raises FitsTableError if the tables don't have the same columns and number
+    of rows. Otherwise returns a dictionary of differing column names, each
+    with a dictionary holding the number of differing rows and the first one.
+
+    Input:
+      ext_num -- extension number (zero based) for which to compare tables
+      rtol -- default relative tolerance
+      atol -- default absolute tolerance
+
+    """
+    hdu1 = self.fits1[ext_num]
+    hdu2 = self.fits2[ext_num]
+
+    names1 = list(hdu1.columns.names)
+    names2 = list(hdu2.columns.names)
+
+    if names1 != names2:
+      msg = 'Tables in fits extension ' + str(ext_num) + ' do not have the '
+      msg += 'same columns.\n'
+      msg += '\tFits1 columns: ' + repr(names1) + '\n'
+      msg += '\tFits2 columns: ' + repr(names2) + '\n'
+      raise FitsTableError(ext_num,{},msg)
+
+    nrows1 = hdu1.header['NAXIS2']
+    nrows2 = hdu2.header['NAXIS2']
+
+    if nrows1 != nrows2:
+      msg = 'Tables in fits extension ' + str(ext_num) + ' do not have the '
+      msg += 'same number of rows.\n'
+      msg += '\tFits1 rows: ' + str(nrows1) + '\n'
+      msg += '\tFits2 rows: ' + str(nrows2) + '\n'
+      raise FitsTableError(ext_num,{},msg)
+
+    diff_columns = {}
+
+    for col1,col2 in zip(hdu1.columns,hdu2.columns):
+      col_rtol,col_atol = self.col_tol.get(col1.name.upper(),(rtol,atol))
+
+      if _vla_format(col1.format) or _vla_format(col2.format):
+        row_diff = self.heap_column_diff(ext_num,col1.name,col_rtol,col_atol)
+      else:
+        values1 = hdu1.data.field(col1.name)
+        values2 = hdu2.data.field(col2.name)
+        row_diff = _diff_mask(values1,values2,col_rtol,col_atol)
+        if row_diff.ndim > 1:
+          row_diff = row_diff.reshape(row_diff.shape[0],-1).any(axis=1)
+
+      num_diff = int(row_diff.sum())
+      if num_diff > 0:
+        diff_columns[col1.name] = {'differing_rows': num_diff,
+                                   'first_row': int(np.argmax(row_diff))}
+
+    return diff_columns
+
+  def heap_column_diff(self,ext_num,name,rtol=0.,atol=0.):
+    """
+    Compare a variable length array column of a binary table extension. Rows
+    are compared using the raw (count, offset) descriptors and the heap bytes
+    they point to, gathered for runs of rows covering at most
+    self.block_size (or RAW_BLOCK_SIZE) bytes of heap at once, so the arrays
+    are never decoded row by row and memory use doesn't grow with the heap. Values are compared exactly as bytes unless a
+    tolerance is given for a numeric column. Returns a boolean array with True
+    for each differing row.
+
+    Falls back to comparing the decoded arrays for files that can't be memory
+    mapped.
+
+    Input:
+      ext_num -- extension number (zero based) of the table
+      name -- column name
+      rtol -- relative tolerance
+      atol -- absolute tolerance
+
+    """
+    hdu1 = self.fits1[ext_num]
+    hdu2 = self.fits2[ext_num]
+
+    format1 = _vla_format(hdu1.columns[name].format)
+    format2 = _vla_format(hdu2.columns[name].format)
+
+    raw1 = _map_fits(self.fits_file1)
+    raw2 = _map_fits(self.fits_file2)
+
+    if format1 != format2 or raw1 is None or raw2 is None:
+      for raw in (raw1,raw2):
+        if raw is not None:
+          raw.close()
+      values1 = hdu1.data.field(name)
+      values2 = hdu2.data.field(name)
+      return np.array([(len(v1) != len(v2)) or bool(_diff_mask(v1,v2,rtol,atol).any())
+                       for v1,v2 in zip(values1,values2)],dtype=bool)
+
+    try:
+      desc1 = np.asarray(np.rec.recarray.field(hdu1.data,name))
+      desc2 = np.asarray(np.rec.recarray.field(hdu2.data,name))
+
+      counts1 = desc1[:,0].astype(np.int64)
+      counts2 = desc2[:,0].astype(np.int64)
+
+      row_diff = counts1 != counts2
+      counts = np.where(row_diff,0,counts1)
+
+      heap1 = _heap_bytes(raw1,self.fits1,ext_num)
+      heap2 = _heap_bytes(raw2,self.fits2,ext_num)
+
+      if format1 == 'X':
+        nbytes = (counts + 7) // 8
+      else:
+        nbytes = counts * TABLE_ITEMSIZE[format1]
+
+      offsets1 = desc1[:,1].astype(np.int64)
+      offsets2 = desc2[:,1].astype(np.int64)
+
+      step = int(self.block_size or RAW_BLOCK_SIZE)
+
+      for lo,hi in _row_chunks(nbytes,step):
+        bytes1 = _gather(heap1,offsets1[lo:hi],nbytes[lo:hi])
+        bytes2 = _gather(heap2,offsets2[lo:hi],nbytes[lo:hi])
+
+        if (rtol or atol) and format1 in TABLE_DTYPE:
+          dtype = np.dtype(TABLE_DTYPE[format1])
+          elem_diff = _diff_mask(bytes1.view(dtype),bytes2.view(dtype),
+                                 rtol,atol)
+          elem_rows = np.repeat(np.arange(hi - lo),counts[lo:hi])
+        else:
+          elem_diff = bytes1 != bytes2
+          elem_rows = np.repeat(np.arange(hi - lo),nbytes[lo:hi])
+
+        row_diff[lo:hi] |= np.bincount(elem_rows[elem_diff],
+                                       minlength=hi - lo).astype(bool)
+
+        del bytes1,bytes2
+
+      # drop numpy's references to the maps before closing them
+      del heap1,heap2
+    finally:
+      raw1.close()
+      raw2.close()
+
+    return row_diff
+
+  def compare_table(self,ext_num):
+    """
+    Compare binary table extensions with self.table_diff(), using the column
+    tolerances in self.col_tol and exact comparison for other columns. Raises
+    FitsTableError if any column differs.
+
+    Input:
+      ext_num -- extension number (zero based) for which to compare tables
+
+    """
+    diff_columns = self.table_diff(ext_num)
+
+    if diff_columns:
+      msg = 'Tables in fits extension ' + str(ext_num) + ' have different '
+      msg += 'values.\n'
+      for name in sorted(diff_columns):
+        msg += '\tColumn ' + name + ': ' + \
+               str(diff_columns[name]['differing_rows']) + \
+               ' rows differ, first at row ' + \
+               str(diff_columns[name]['first_row']) + '\n'
+      raise FitsTableError(ext_num,diff_columns,msg)
+
+    return True
+
+  def is_image_pair(self,ext_num):
+    """
+    Returns True if extension ext_num is an ImageHDU containing a data array in
+    both fits files.
+
+    """
+    # whether there's data is worked out from the headers, because getting
+    # .data would read (and scale) the whole image
+    return (type(self.fits1[ext_num]) == pyfits.ImageHDU) and \
+           (type(self.fits2[ext_num]) == pyfits.ImageHDU) and \
+           bool(_image_shape(self.headers1[ext_num])) and \
+           bool(_image_shape(self.headers2[ext_num]))
+
+  def data_stats(self,ext_num,rtol=0.,atol=0.):
+    """
+    Compare the data arrays of an image extension within tolerances in a single
+    sweep over blocks of rows. Pixels are counted as different where
+    abs(data1 - data2) > atol + rtol * abs(data2); pixels that are NaN in both
+    arrays are the same. Integer images are compared exactly, without going
+    through float64. Assumes the arrays have the same shape.
+
+    Returns a dictionary with the number of differing pixels, the largest
+    absolute and relative differences, and the bounding box of the differing
+    pixels as a [min, max] (zero based, inclusive) pair per axis, or None if
+    no pixels differ.
+
+    Input:
+      ext_num -- extension number (zero based) for which to compare data
+      rtol -- relative tolerance
+      atol -- absolute tolerance
+
+    """
+    data1 = self.fits1[ext_num].data
+    data2 = self.fits2[ext_num].data
+
+    ndim = data1.ndim
+    row_bytes = max(data1[:1].nbytes,data2[:1].nbytes,1)
+    step = max(1,int(self.block_size or RAW_BLOCK_SIZE) // row_bytes)
+
+    num_diff = 0
+    max_abs = 0.
+    max_rel = 0.
+    bbox = None
+
+    for start in range(0,data1.shape[0],step):
+      raw1 = np.asarray(data1[start:start+step])
+      raw2 = np.asarray(data2[start:start+step])
+
+      block1 = raw1.astype(np.float64)
+      block2 = raw2.astype(np.float64)
+
+      if raw1.dtype.kind in 'iu' and raw2.dtype.kind in 'iu':
+        # integers are compared exactly in their own type and their
+        # differences taken as integers, since float64 can't tell apart
+        # integers above 2**53
+        abs_diff = np.abs(raw1.astype(np.int64) -
+                          raw2.astype(np.int64)).astype(np.float64)
+        diff = (raw1 != raw2) & ~(abs_diff <= atol + rtol * np.abs(block2))
+      else:
+        abs_diff = np.abs(block1 - block2)
+        diff = _diff_mask(block1,block2,rtol,atol)
+
+      finite = np.isfinite(abs_diff)
+      if finite.any():
+        max_abs = max(max_abs,float(abs_diff[finite].max()))
+
+      nonzero = finite & (block2 != 0)
+      if nonzero.any():
+        rel_diff = abs_diff[nonzero] / np.abs(block2[nonzero])
+        max_rel = max(max_rel,float(rel_diff.max()))
+
+      block_diff = int(diff.sum())
+      if block_diff == 0:
+        continue
+
+      num_diff += block_diff
+
+      block_bbox = []
+      for axis in range(ndim):
+        others = tuple(a for a in range(ndim) if a != axis)
+        where = np.nonzero(diff.any(axis=others) if others else diff)[0]
+        lo,hi = int(where[0]),int(where[-1])
+        if axis == 0:
+          lo,hi = lo + start,hi + start
+        block_bbox.append([lo,hi])
+
+      if bbox is None:
+        bbox = block_bbox
+      else:
+        bbox = [[min(b[0],bb[0]),max(b[1],bb[1])]
+                for b,bb in zip(bbox,block_bbox)]
+
+    return {'differing_pixels': num_diff,
+            'max_abs_diff': max_abs,
+            'max_rel_diff': max_rel,
+            'bounding_box': bbox}
+
+  def collect_differences(self,rtol=0.,atol=0.):
+    """
+    Run every comparison without stopping at the first difference and return a
+    report of everything found as a dictionary (suitable for json.dumps). The
+    'same' entry is True only if nothing differed.
+
+    Data arrays are compared with self.data_stats() and binary tables with
+    self.table_diff() using the given tolerances, so values that differ only
+    within tolerance count as the same.
+
+    Input:
+      rtol -- relative tolerance for data comparisons
+      atol -- absolute tolerance for data comparisons
+
+    """
+    report = {'fits1': self.fits_file1,
+              'fits2': self.fits_file2,
+              'rtol': rtol,
+              'atol': atol,
+              'messages': [],
+              'extensions': []}
+
+    layout_comps = [self.compare_length,self.compare_names]
+    if not self.headers_only:
+      layout_comps.append(self.compare_size)
+
+    layout_ok = True
+    for comp in layout_comps:
+      try:
+        comp()
+      except FitsError as e:
+        report['messages'].append(e.msg)
+        layout_ok = False
+
+    if layout_ok and not self.headers_only:
+      self.compare_raw_data()
+
+    same = layout_ok
+
+    for i in range(min(len(self.headers1),len(self.headers2))):
+      ext = {'ext': i,
+             'name': self.headers1[i].name,
+             'header_keys_fits1_only': [],
+             'header_keys_fits2_only': [],
+             'header_values_differ': [],
+             'data': None,
+             'columns': None,
+             'messages': []}
+
+      try:
+        self.compare_header_keys(i)
+      except FitsHeaderKeyError as e:
+        ext['header_keys_fits1_only'] = e.header1_extra_keys
+        ext['header_keys_fits2_only'] = e.header2_extra_keys
+        ext['messages'].append(e.msg)
+
+      try:
+        self.compare_header_values(i)
+      except FitsHeaderValueError as e:
+        ext['header_values_differ'] = e.diff_keys
+        ext['messages'].append(e.msg)
+
+      if self.headers_only or i in self.raw_identical:
+        pass
+      elif self.is_image_pair(i):
+        try:
+          self.compare_data_shape(i)
+        except FitsDataError as e:
+          ext['messages'].append(e.msg)
+        else:
+          ext['data'] = self.data_stats(i,rtol,atol)
+          if ext['data']['differing_pixels'] > 0:
+            msg = 'Data arrays for fits extension ' + str(i) + ' differ in '
+            msg += str(ext['data']['differing_pixels']) + ' pixels.\n'
+            ext['messages'].append(msg)
+      elif self.is_comp_image_pair(i):
+        try:
+          self.compare_comp_image(i)
+        except FitsDataError as e:
+          ext['messages'].append(e.msg)
+      elif self.is_table_pair(i):
+        try:
+          ext['columns'] = self.table_diff(i,rtol,atol)
+        except FitsTableError as e:
+          ext['messages'].append(e.msg)
+        else:
+          for name in sorted(ext['columns']):
+            msg = 'Table column ' + name + ' in fits extension ' + str(i)
+            msg += ' differs in ' + str(ext['columns'][name]['differing_rows'])
+            msg += ' rows.\n'
+            ext['messages'].append(msg)
+
+      if ext['messages']:
+        same = False
+
+      report['extensions'].append(ext)
+
+    report['same'] = same
+
+    return report
+
   def close_fits(self):
     """
     Closes self.fits1 and self.fits2.
 
     """
-    self.fits1.close()
-    self.fits2.close()
+    if self.fits1 is not None:
+      self.fits1.close()
+    if self.fits2 is not None:
+      self.fits2.close()
 
   def run_all_comps(self):
     """
     Runs all comparisons in a logical order. Returns True if they all pass. If
-    any exceptions are raised they are not handled.
+    any exceptions are raised they are not handled. Only the length, names
+    and headers are compared if self.headers_only is True.
 
     """
+    if self.headers_only:
+      same_fits = self.compare_length() and self.compare_names() and \
+                  self.compare_all_headers()
+      self.close_fits()
+      return same_fits
+
     same_length = self.compare_length()
     same_names = self.compare_names()
     same_size = self.compare_size()
+    self.compare_raw_data()
     same_headers = self.compare_all_headers()
     same_data = self.compare_data()
 
@@ -404,8 +1182,521 @@ class CompareFits:
 
     return same_fits
 
-def comp_fits(fits1,fits2):
-  comp = CompareFits(fits1,fits2)
+class DigestCache(object):
+  """
+  On disk cache of per-extension digests of fits files, stored in an sqlite
+  database. Entries are keyed by absolute path and are only used while the
+  file's size and modification time are unchanged. Once the cache holds more
+  than max_entries files the least recently used entries are evicted.
+
+  Digests are lists with one [name, header digest, data digest] entry per
+  extension, as returned by fits_digests().
+
+  Lookups only read the database. The times entries are used are kept in
+  memory and written in one transaction by put() and close().
+
+  Input:
+    filename -- name of the sqlite database file
+    max_entries -- maximum number of files to keep digests for
+
+  """
+  def __init__(self,filename=DIGEST_CACHE,max_entries=DIGEST_CACHE_SIZE):
+    self.filename = filename
+    self.max_entries = max_entries
+
+    # path -> time of the lookups since the last write
+    self._used = {}
+
+    self.conn = sqlite3.connect(filename,timeout=60)
+    self.conn.execute('CREATE TABLE IF NOT EXISTS digests ('
+                      'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                      'digests TEXT, used REAL)')
+    self.conn.commit()
+
+  def get(self,fits_file):
+    """
+    Return the cached digests for fits_file, or None if there are none or the
+    file has changed since they were computed.
+
+    """
+    path = os.path.abspath(fits_file)
+    st = os.stat(path)
+
+    row = self.conn.execute('SELECT size, mtime, digests FROM digests '
+                            'WHERE path = ?',(path,)).fetchone()
+
+    if row is None or row[0] != st.st_size or row[1] != st.st_mtime:
+      return None
+
+    version,digests = json.loads(row[2])
+    if version != DIGEST_VERSION:
+      return None
+
+    self._used[path] = time.time()
+
+    return digests
+
+  def put(self,fits_file,digests):
+    """
+    Store digests for fits_file, evicting old entries if necessary.
+
+    """
+    path = os.path.abspath(fits_file)
+    st = os.stat(path)
+
+    self.conn.execute('INSERT OR REPLACE INTO digests VALUES (?,?,?,?,?)',
+                      (path,st.st_size,st.st_mtime,
+                       json.dumps([DIGEST_VERSION,digests]),time.time()))
+    self.write_used()
+    self.evict()
+    self.conn.commit()
+
+  def write_used(self):
+    """
+    Write the times of the lookups made since the last write, without
+    committing.
+
+    """
+    if self._used:
+      self.conn.executemany('UPDATE digests SET used = ? WHERE path = ?',
+                            [(used,path) for path,used in self._used.items()])
+      self._used = {}
+
+  def evict(self):
+    """
+    Remove the least recently used entries beyond self.max_entries.
+
+    """
+    self.conn.execute('DELETE FROM digests WHERE path NOT IN '
+                      '(SELECT path FROM digests ORDER BY used DESC LIMIT ?)',
+                      (self.max_entries,))
+
+  def digests(self,fits_file):
+    """
+    Return digests for fits_file, from the cache if possible, otherwise by
+    computing them with fits_digests() and storing the result. Returns None
+    for files that can't be digested.
+
+    """
+    digests = self.get(fits_file)
+
+    if digests is None:
+      digests = fits_digests(fits_file)
+      if digests is not None:
+        self.put(fits_file,digests)
+
+    return digests
+
+  def same_fits(self,fits1,fits2):
+    """
+    Returns True if both files have digests and they match. A False return
+    doesn't mean the files differ, only that a full comparison is needed.
+
+    """
+    digests1 = self.digests(fits1)
+
+    if digests1 is None:
+      return False
+
+    return digests1 == self.digests(fits2)
+
+  def close(self):
+    self.write_used()
+    self.conn.commit()
+    self.conn.close()
+
+def fits_digests(fits_file,block_size=RAW_BLOCK_SIZE):
+  """
+  Compute per-extension digests for a fits file. Header digests cover the
+  card image of every card except those in IGNORE_HEADER_VALUES, so any change
+  to a card (including the tail of a long string in CONTINUE cards) changes
+  the digest. Headers are read with
+  fitsheader.iter_headers(). Data digests are taken over the raw bytes of
+  each data section, block_size bytes at a time.
+
+  Returns a list of [name, header digest, data digest] lists, one per
+  extension, or None if the file can't be memory mapped (see _map_fits).
+
+  """
+  raw = _map_fits(fits_file)
+
+  if raw is None:
+    return None
+
+  digests = []
+
+  try:
+    for header in fitsheader.iter_headers(fits_file):
+      head_hash = hashlib.sha1()
+      for card in header:
+        if card.key not in IGNORE_HEADER_VALUES:
+          head_hash.update(card.image.encode('ascii','replace'))
+
+      data_hash = hashlib.sha1()
+      start = header.data_offset
+      end = start + header.data_span
+      while start < end:
+        data_hash.update(raw[start:min(start+block_size,end)])
+        start += block_size
+
+      digests.append([header.name,head_hash.hexdigest(),data_hash.hexdigest()])
+  finally:
+    raw.close()
+
+  return digests
+
+def _read_headers(fits_file,fits=None):
+  """
+  Return a list of fitsheader.CardMap objects for every header in fits_file.
+  Files fitsheader can't read directly (e.g. gzipped files) have their headers
+  taken from fits, an open pyfits HDUList, if one is given.
+
+  """
+  try:
+    return fitsheader.read_headers(fits_file)
+  except fitsheader.HeaderParseError:
+    if fits is None:
+      raise
+
+  return [fitsheader.CardMap.from_string(hdu.header.tostring()) for hdu in fits]
+
+def _diff_mask(values1,values2,rtol=0.,atol=0.):
+  """
+  Return a boolean array that is True where values1 and values2 differ. Numeric
+  values differ where abs(values1 - values2) > atol + rtol * abs(values2), with
+  equal values (including infinities of the same sign) and NaNs in both arrays
+  counting as the same. Other types must be equal.
+
+  >>> _diff_mask([np.inf,-np.inf,np.nan,1.],[np.inf,-np.inf,np.nan,np.inf]).tolist()
+  [False, False, False, True]
+  >>> _diff_mask([np.inf,-np.inf],[-np.inf,np.inf],rtol=1.).tolist()
+  [True, True]
+
+  """
+  values1 = np.asarray(values1)
+  values2 = np.asarray(values2)
+
+  if values1.dtype.kind in 'fciu' and values2.dtype.kind in 'fciu':
+    if values1.dtype.kind in 'fc' or values2.dtype.kind in 'fc' or rtol or atol:
+      dtype = np.result_type(values1,values2,np.float64)
+      values1 = values1.astype(dtype)
+      values2 = values2.astype(dtype)
+      abs_diff = np.abs(values1 - values2)
+      both_nan = np.isnan(values1) & np.isnan(values2)
+      # an infinite abs_diff is never within tolerance, even of an infinity
+      close = np.isfinite(abs_diff) & (abs_diff <= atol + rtol * np.abs(values2))
+      return ~((values1 == values2) | close | both_nan)
+
+  return np.asarray(values1 != values2,dtype=bool)
+
+def _vla_format(tform):
+  """
+  Return the element format letter of a variable length array column format
+  such as 'PE(10)' or '1QD', or None for other formats.
+
+  """
+  match = re.match(r'^\s*[01]?[PQ]([A-Z])',str(tform))
+
+  if match is None:
+    return None
+
+  return match.group(1)
+
+def _heap_bytes(raw,fits,ext_num):
+  """
+  Return a uint8 array over the heap of a binary table extension in raw, an
+  mmap of the fits file.
+
+  """
+  header = fits[ext_num].header
+  info = fits.fileinfo(ext_num)
+
+  table_size = header['NAXIS1'] * header['NAXIS2']
+  theap = header.get('THEAP',table_size)
+  heap_size = header['PCOUNT'] - (theap - table_size)
+
+  return np.frombuffer(raw,dtype=np.uint8,count=heap_size,
+                       offset=info['datLoc'] + theap)
+
+def _table_columns(header):
+  """
+  Return a list of (repeat, format letter, element format letter) tuples, one
+  per column of the binary table described by header (a fitsheader.CardMap).
+  The element format is only set for variable length array columns.
+
+  """
+  columns = []
+
+  for n in range(1,header.get('TFIELDS',0)+1):
+    tform = header.get('TFORM{}'.format(n),'')
+    match = re.match(r'^\s*(\d*)([A-Z])',tform)
+    repeat = int(match.group(1) or 1)
+    columns.append((repeat,match.group(2),_vla_format(tform)))
+
+  return columns
+
+def _table_rows(raw,header,columns):
+  """
+  Read the rows of a binary table straight from raw, an mmap of the fits
+  file, as a numpy record array (a copy, not a view of raw) with a field for
+  each column. Variable length array columns give (count, offset) pairs.
+
+  """
+  dtype = []
+
+  for n,(repeat,code,element) in enumerate(columns):
+    if code in 'PQ':
+      dtype.append(('f{}'.format(n),TABLE_ROW_DTYPE[code],(2,)))
+    elif code == 'A':
+      dtype.append(('f{}'.format(n),'S{}'.format(repeat)))
+    elif code == 'X':
+      dtype.append(('f{}'.format(n),'u1',((repeat + 7) // 8,)))
+    else:
+      dtype.append(('f{}'.format(n),TABLE_ROW_DTYPE[code],(repeat,)))
+
+  start = header.data_offset
+  size = header['NAXIS1'].value * header['NAXIS2'].value
+
+  return np.frombuffer(raw[start:start+size],dtype=np.dtype(dtype))
+
+def _heap_offset(header):
+  """
+  Byte offset in the file of the heap of the binary table described by header
+  (a fitsheader.CardMap read by fitsheader.iter_headers).
+
+  """
+  table_size = header.get('NAXIS1') * header.get('NAXIS2')
+
+  return header.data_offset + header.get('THEAP',table_size)
+
+def _same_tile(row1,row2,columns,raw1,heap1,raw2,heap2):
+  """
+  Returns True if two rows of compressed image tables hold the same bytes,
+  comparing the heap data of variable length array columns rather than their
+  descriptors.
+
+  """
+  for n,(repeat,code,element) in enumerate(columns):
+    field = 'f{}'.format(n)
+
+    if code not in 'PQ':
+      if row1[field].tobytes() != row2[field].tobytes():
+        return False
+      continue
+
+    count1,offset1 = [int(x) for x in row1[field]]
+    count2,offset2 = [int(x) for x in row2[field]]
+
+    if count1 != count2:
+      return False
+
+    if element == 'X':
+      nbytes = (count1 + 7) // 8
+    else:
+      nbytes = count1 * TABLE_ITEMSIZE[element]
+
+    if raw1[heap1+offset1:heap1+offset1+nbytes] != \
+       raw2[heap2+offset2:heap2+offset2+nbytes]:
+      return False
+
+  return True
+
+def _tile_slices(header):
+  """
+  Return a list with a tuple of slices (in numpy axis order) for each tile of
+  the tile compressed image described by header (a fitsheader.CardMap), in
+  the order the tiles are stored in the compressed table.
+
+  """
+  naxis = header.get('ZNAXIS',0)
+  axes = [header.get('ZNAXIS{}'.format(i)) for i in range(1,naxis+1)]
+  tile = [header.get('ZTILE{}'.format(i),axes[0] if i == 1 else 1)
+          for i in range(1,naxis+1)]
+
+  # ranges of slices along each axis, slowest varying (last fits axis) first
+  ranges = []
+  for n,t in reversed(list(zip(axes,tile))):
+    ranges.append([slice(start,min(start+t,n)) for start in range(0,n,t)])
+
+  return [tuple(slices) for slices in itertools.product(*ranges)]
+
+def _row_chunks(nbytes,limit):
+  """
+  Generator of (first, last + 1) row ranges covering every row, each with at
+  most limit bytes in total of nbytes, except that a row bigger than limit
+  gets a range to itself.
+
+  """
+  ends = np.cumsum(nbytes)
+  lo = 0
+
+  while lo < len(nbytes):
+    done = int(ends[lo-1]) if lo > 0 else 0
+    hi = max(lo + 1,int(np.searchsorted(ends,done + limit,'right')))
+    yield lo,hi
+    lo = hi
+
+def _gather(heap,offsets,nbytes):
+  """
+  Gather nbytes[i] bytes starting at offsets[i] from heap for every i and
+  return them concatenated, without looping over rows in python. The index
+  array this builds takes 8 bytes per byte gathered, so callers should gather
+  bounded runs of rows (see _row_chunks). A single row is sliced instead.
+
+  """
+  total = int(nbytes.sum())
+
+  if total == 0:
+    return np.zeros(0,dtype=np.uint8)
+
+  if len(offsets) == 1:
+    return np.array(heap[offsets[0]:offsets[0] + total])
+
+  ends = np.cumsum(nbytes)
+  index = np.repeat(offsets - (ends - nbytes),nbytes) + np.arange(total)
+
+  return heap[index]
+
+def _filebytes(fits):
+  """
+  .filebytes() of each HDU of an HDUList read from a file, from its
+  fileinfo().
+
+  """
+  sizes = []
+
+  for i in range(len(fits)):
+    info = fits.fileinfo(i)
+    sizes.append(info['datLoc'] - info['hdrLoc'] + info['datSpan'])
+
+  return sizes
+
+def _image_shape(header):
+  """
+  The numpy shape of the data of an image header, or () if it has no data.
+  For a tile compressed image it's the shape of the image, not the table.
+
+  """
+  prefix = 'ZNAXIS' if header.get('ZIMAGE') is True else 'NAXIS'
+
+  shape = tuple(header.get('{}{}'.format(prefix,i),0)
+                for i in range(header.get(prefix,0),0,-1))
+
+  if not shape or 0 in shape:
+    return ()
+
+  return shape
+
+def _comp_table_keys(header):
+  """
+  Keys of a tile compressed image header that describe its compressed table
+  (the row size and number of tiles, heap size and column formats) rather than
+  the image, so they can differ between files holding the same image. Empty
+  for other headers.
+
+  """
+  if header.get('ZIMAGE') is not True:
+    return set()
+
+  keys = set(['NAXIS1','NAXIS2','PCOUNT','THEAP'])
+  keys.update('TFORM{}'.format(i) for i in range(1,header.get('TFIELDS',0)+1))
+
+  return keys
+
+def _scaling(header):
+  """
+  (BSCALE, BZERO) of an image header, or None if its values aren't scaled.
+
+  """
+  bscale = header.get('BSCALE',1)
+  bzero = header.get('BZERO',0)
+
+  if bscale == 1 and bzero == 0:
+    return None
+
+  return bscale,bzero
+
+def _scale(values,scaling):
+  """
+  Physical values of stored image values with scaling from _scaling().
+  Integer scalings (such as BZERO = 32768 for unsigned 16 bit data) keep
+  integer values, and others give float64.
+
+  """
+  if scaling is None:
+    return values
+
+  bscale,bzero = scaling
+
+  if values.dtype.kind in 'iu' and bscale == 1 and bzero == int(bzero):
+    return values.astype(np.int64) + int(bzero)
+
+  return values * np.float64(bscale) + bzero
+
+def _raw_image(fits_file,offset,header):
+  """
+  Read only memory map of the stored (unscaled) values of the image whose
+  data starts offset bytes into fits_file, or None if the file can't be
+  mapped (see _map_fits) or the image has no data.
+
+  """
+  shape = _image_shape(header)
+
+  if not shape or header.get('BITPIX') not in IMAGE_DTYPE:
+    return None
+
+  raw = _map_fits(fits_file)
+  if raw is None:
+    return None
+  raw.close()
+
+  return np.memmap(fits_file,dtype=IMAGE_DTYPE[header.get('BITPIX')],
+                   mode='r',offset=offset,shape=shape)
+
+def _map_fits(fits_file):
+  """
+  Return a read only mmap of a plain (uncompressed) fits file, or None if the
+  file is empty or doesn't start with a fits header.
+
+  """
+  f = open(fits_file,'rb')
+
+  try:
+    if f.read(6) != b'SIMPLE':
+      return None
+    return mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+  except (ValueError,EnvironmentError):
+    return None
+  finally:
+    # the mmap keeps its own handle on the file
+    f.close()
+
+def _same_bytes(raw1,loc1,raw2,loc2,length,step):
+  """
+  Compare length bytes of raw1 starting at loc1 with raw2 starting at loc2,
+  step bytes at a time. Returns False as soon as a block differs.
+
+  """
+  if loc1 + length > len(raw1) or loc2 + length > len(raw2):
+    return False
+
+  done = 0
+  while done < length:
+    n = min(step,length - done)
+    if raw1[loc1+done:loc1+done+n] != raw2[loc2+done:loc2+done+n]:
+      return False
+    done += n
+
+  return True
+
+def comp_fits(fits1,fits2,block_size=None,cache=None,col_tol=None,
+              headers_only=False):
+  if cache is not None and not headers_only and cache.same_fits(fits1,fits2):
+    print('All sameness tests passed (cached digests) for files: ')
+    print('\t' + fits1 + '    ' + fits2)
+    return
+
+  comp = CompareFits(fits1,fits2,block_size,col_tol,headers_only)
 
   try:
     same_fits = comp.run_all_comps()
@@ -414,7 +1705,8 @@ def comp_fits(fits1,fits2):
           FitsSizeError,
           FitsHeaderKeyError,
           FitsHeaderValueError,
-          FitsDataError) as e:
+          FitsDataError,
+          FitsTableError) as e:
     print(e.msg)
     raise
   except:
@@ -427,15 +1719,260 @@ def comp_fits(fits1,fits2):
       print('Some tests failed but did not raise exceptions,')
       print('you should check that out.')
 
-def usage():
-  print('Usage: compfits.py <fits file 1> <fits file 2>')
+def print_report(report):
+  """
+  Print a report from CompareFits.collect_differences() as text.
 
-if __name__ == '__main__':
-  if len(sys.argv) != 3:
-    usage()
-    exit()
+  """
+  for msg in report['messages']:
+    print(msg.rstrip())
+
+  for ext in report['extensions']:
+    for msg in ext['messages']:
+      print(msg.rstrip())
+
+    data = ext['data']
+    if data is not None and data['differing_pixels'] > 0:
+      print('\tmax abs diff: ' + repr(data['max_abs_diff']))
+      print('\tmax rel diff: ' + repr(data['max_rel_diff']))
+      print('\tbounding box: ' + repr(data['bounding_box']))
 
-  fits1 = sys.argv[1]
-  fits2 = sys.argv[2]
+  if report['same']:
+    print('All sameness tests passed for files: ')
+  else:
+    print('Differences found for files: ')
+  print('\t' + report['fits1'] + '    ' + report['fits2'])
+
+def find_fits(root,patterns=TREE_PATTERNS):
+  """
+  Return a sorted list of paths, relative to root, of files under root whose
+  names match any of patterns.
+
+  """
+  found = []
+
+  for dirpath,dirnames,filenames in os.walk(root):
+    for name in filenames:
+      if any(fnmatch.fnmatch(name,p) for p in patterns):
+        found.append(os.path.relpath(os.path.join(dirpath,name),root))
+
+  return sorted(found)
+
+# digest cache used by tree comparison worker processes, opened once per
+# process by _init_tree_worker
+_worker_cache = None
+
+def _init_tree_worker(cache_file,cache_size):
+  global _worker_cache
+
+  if cache_file is not None:
+    _worker_cache = DigestCache(cache_file,cache_size)
+    # close the cache, writing its access times, when the worker exits
+    multiprocessing.util.Finalize(_worker_cache,_worker_cache.close,
+                                  exitpriority=10)
+
+def _comp_tree_pair(args):
+  """
+  Compare one pair of files for comp_trees. Returns a tuple of
+  (relative path, status, message) where status is 'same', 'different' or
+  'error'.
 
-  comp_fits(fits1,fits2)
+  """
+  rel,fits1,fits2,block_size,headers_only,col_tol = args
+
+  try:
+    if _worker_cache is not None and _worker_cache.same_fits(fits1,fits2):
+      return (rel,'same','')
+
+    comp = CompareFits(fits1,fits2,block_size,col_tol,headers_only)
+    try:
+      same_fits = comp.run_all_comps()
+    finally:
+      comp.close_fits()
+  except FitsError as e:
+    return (rel,'different',e.msg)
+  except Exception as e:
+    return (rel,'error',repr(e))
+
+  if same_fits is True:
+    return (rel,'same','')
+  else:
+    return (rel,'different','Some tests failed but did not raise exceptions.')
+
+def comp_trees(dir1,dir2,block_size=None,cache_file=None,
+               cache_size=DIGEST_CACHE_SIZE,processes=None,
+               patterns=TREE_PATTERNS,headers_only=False,col_tol=None):
+  """
+  Compare every fits file under dir1 with the file at the same relative path
+  under dir2 using a pool of processes worker processes (defaults to the
+  number of CPUs). Results are printed as they arrive, followed by a summary.
+  With headers_only only the headers are compared, and col_tol gives table
+  column tolerances (see CompareFits).
+
+  Returns a dictionary with 'same', 'different', 'error', 'missing' (in dir1
+  but not dir2) and 'extra' (in dir2 but not dir1) lists of relative paths.
+
+  """
+  files1 = find_fits(dir1,patterns)
+  files2 = find_fits(dir2,patterns)
+
+  set2 = set(files2)
+  set1 = set(files1)
+
+  results = {'same': [],
+             'different': [],
+             'error': [],
+             'missing': [f for f in files1 if f not in set2],
+             'extra': [f for f in files2 if f not in set1]}
+
+  jobs = [(f,os.path.join(dir1,f),os.path.join(dir2,f),block_size,
+           headers_only,col_tol)
+          for f in files1 if f in set2]
+
+  pool = multiprocessing.Pool(processes,_init_tree_worker,
+                              (cache_file,cache_size))
+
+  try:
+    for rel,status,msg in pool.imap_unordered(_comp_tree_pair,jobs,
+                                              chunksize=8):
+      results[status].append(rel)
+      print('{:<10}{}'.format(status.upper(),rel))
+      if msg:
+        print('\t' + msg.strip().replace('\n','\n\t'))
+  finally:
+    pool.close()
+    pool.join()
+
+  for rel in results['missing']:
+    print('{:<10}{}'.format('MISSING',rel))
+
+  for rel in results['extra']:
+    print('{:<10}{}'.format('EXTRA',rel))
+
+  print('')
+  print('Summary for ' + dir1 + '    ' + dir2)
+  for status in ['same','different','error','missing','extra']:
+    print('\t{:<10}{}'.format(status,len(results[status])))
+
+  return results
+
+def parse_args():
+  parser = argparse.ArgumentParser(description=
+                                   'Compare two fits files or two '
+                                   'directory trees of fits files.')
+
+  parser.add_argument('fits1', type=str,
+                      help='Name of first fits file or directory.')
+
+  parser.add_argument('fits2', type=str,
+                      help='Name of second fits file or directory.')
+
+  parser.add_argument('-b', '--block-size', type=int, default=None,
+                      help='Compare data in memory mapped blocks of at most '
+                           'this many bytes. Default is to compare whole arrays.')
+
+  parser.add_argument('--cache', nargs='?', const=DIGEST_CACHE, default=None,
+                      help='Use an on disk digest cache. Defaults to ' +
+                           DIGEST_CACHE + ' if no file is given.')
+
+  parser.add_argument('--cache-size', type=int, default=DIGEST_CACHE_SIZE,
+                      help='Maximum number of files kept in the digest cache.')
+
+  parser.add_argument('-a', '--all', action='store_true',
+                      help='Report all differences instead of stopping at '
+                           'the first one.')
+
+  parser.add_argument('--json', action='store_true',
+                      help='Print the report of all differences as JSON.')
+
+  parser.add_argument('--rtol', type=float, default=0.,
+                      help='Relative tolerance for data comparisons in '
+                           '-a/--json mode. Defaults to 0.')
+
+  parser.add_argument('--atol', type=float, default=0.,
+                      help='Absolute tolerance for data comparisons in '
+                           '-a/--json mode. Defaults to 0.')
+
+  parser.add_argument('--headers-only', action='store_true',
+                      help='Only compare headers, without reading any data.')
+
+  parser.add_argument('--col-tol', type=parse_col_tol, action='append',
+                      default=[],
+                      help='Tolerances for a binary table column, given as '
+                           'NAME=RTOL,ATOL. May be given more than once.')
+
+  parser.add_argument('-j', '--jobs', type=int, default=None,
+                      help='Number of worker processes for directory '
+                           'comparisons. Defaults to the number of CPUs.')
+
+  parser.add_argument('-p', '--pattern', type=str, action='append',
+                      help='File name pattern to compare in directory mode. '
+                           'May be given more than once. Defaults to ' +
+                           ' '.join(TREE_PATTERNS) + '.')
+
+  return parser.parse_args()
+
+
+def parse_col_tol(s):
+  """
+  Turn a NAME=RTOL,ATOL string into a (NAME, (rtol, atol)) pair, with the
+  column name upper cased. Used as the argparse type of --col-tol, so
+  malformed tolerances are reported as usage errors.
+
+  """
+  try:
+    name,tols = s.split('=',1)
+    rtol,atol = tols.split(',')
+    return name.strip().upper(),(float(rtol),float(atol))
+  except ValueError:
+    raise argparse.ArgumentTypeError('expected NAME=RTOL,ATOL, '
+                                     'got {!r}'.format(s))
+
+
+def main():
+  args = parse_args()
+
+  col_tol = dict(args.col_tol)
+
+  if os.path.isdir(args.fits1) and os.path.isdir(args.fits2):
+    results = comp_trees(args.fits1,args.fits2,args.block_size,args.cache,
+                         args.cache_size,args.jobs,
+                         args.pattern or TREE_PATTERNS,args.headers_only,
+                         col_tol)
+    if results['different'] or results['error'] or \
+       results['missing'] or results['extra']:
+      return 1
+    return
+
+  if args.all or args.json:
+    comp = CompareFits(args.fits1,args.fits2,args.block_size,col_tol,
+                       args.headers_only)
+    try:
+      report = comp.collect_differences(args.rtol,args.atol)
+    finally:
+      comp.close_fits()
+
+    if args.json:
+      print(json.dumps(report,indent=2,sort_keys=True))
+    else:
+      print_report(report)
+
+    if not report['same']:
+      return 1
+    return
+
+  if args.cache is not None:
+    cache = DigestCache(args.cache,args.cache_size)
+  else:
+    cache = None
+
+  try:
+    comp_fits(args.fits1,args.fits2,args.block_size,cache,col_tol,
+              args.headers_only)
+  finally:
+    if cache is not None:
+      cache.close()
+
+
+if __name__ == '__main__':
+  raise SystemExit(main())
@@ -0,0 +1,27 @@
+"""
+Lists of files for the command line tools that take them. A file name of -
+stands for the names read from stdin, one per line, so the tools can be fed
+from find:
+
+> find /data -name '*_raw.fits' | hedit.py - FLATCORR PERFORM -j 16
+
+"""
+
+import sys
+
+
+def read_file_list(fits_files):
+  """
+  Replace any - in fits_files with the file names read from stdin, one per
+  line.
+
+  """
+  names = []
+
+  for fits in fits_files:
+    if fits == '-':
+      names.extend(line.strip() for line in sys.stdin if line.strip())
+    else:
+      names.append(fits)
+
+  return names
@@ -0,0 +1,674 @@
+"""
+Read FITS headers straight from the file without pyfits (or numpy).
+
+Headers are read a 2880 byte block at a time up to the END card and parsed
+into a CardMap, an ordered multi-map of cards that keeps duplicate keys such
+as COMMENT and HISTORY. The size of each data unit is worked out from the
+BITPIX, NAXISn, PCOUNT and GCOUNT keywords so that iter_headers() can seek
+straight past it to the next header without reading any data.
+
+Gzipped files are decompressed as they're read, only as far as the last
+header needed. Data units in between can't be seeked past in a compressed
+stream so they are decompressed a bounded block at a time and thrown away,
+never held in memory. Offsets in gzipped files are offsets into the
+decompressed stream.
+
+Examples
+--------
+
+Print the keys of every header in a file:
+
+for header in iter_headers('jb1f98q1q_raw.fits'):
+  print(header.keys())
+
+Compare two primary headers:
+
+only1, only2, diff = diff_cards(read_header('a.fits'), read_header('b.fits'))
+
+Pick out every PHOT* and *CORR card of a header, compiling the patterns once:
+
+selector = KeywordSelector(['PHOT*','re:CORR$'])
+cards = selector.select(read_header('jb1f98q1q_raw.fits'))
+
+"""
+
+import gzip
+import re
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# first two bytes of a gzip file
+GZIP_MAGIC = b'\x1f\x8b'
+
+# number of bytes decompressed and discarded at a time when skipping data in
+# gzipped files
+SKIP_BLOCK_SIZE = 1024 * 1024
+
+try:
+  _string_types = basestring
+except NameError:
+  _string_types = str
+
+# keys whose values are free text rather than 'KEY = value / comment'
+COMMENTARY_KEYS = ['COMMENT','HISTORY','']
+
+
+class HeaderParseError(Exception):
+  """
+  Exception raised when a file doesn't look like a FITS file, or a header is
+  cut off before its END card.
+
+  """
+  pass
+
+
+class Card(object):
+  """
+  One 80 character header card.
+
+  Attributes:
+    key -- keyword, upper case with no padding
+    value -- parsed value: str, bool, int, float, or None for keys with no value
+    comment -- comment string, '' if there isn't one
+    image -- the 80 character card image
+
+  """
+  __slots__ = ('key','value','comment','image')
+
+  def __init__(self,image):
+    self.image = image
+    self.key,self.value,self.comment = parse_card(image)
+
+  def __str__(self):
+    return self.image
+
+  def __repr__(self):
+    return 'Card({!r})'.format(self.image)
+
+
+class CardMap(object):
+  """
+  Ordered multi-map of the cards in one header. Cards are kept in file order
+  and a dictionary maps each key to the positions of all the cards with that
+  key, so lookups of unique and repeated keys are both a single dictionary
+  access.
+
+  header[key] returns the first Card with that key (raising KeyError if there
+  is none) and header.get(key) its value. header.getall(key) returns the
+  values of every card with that key, in order.
+
+  Long strings continued over CONTINUE cards (a string ending in & followed
+  by CONTINUE cards) are joined into the value of the card they start on.
+  The CONTINUE cards are kept as well, each with its own piece of the string
+  as its value, so header.getall('CONTINUE') sees changes to the tail.
+
+  When read by iter_headers() these attributes describe where the HDU is:
+    header_offset -- byte offset of the start of the header
+    data_offset -- byte offset of the start of the data unit
+    data_size -- size in bytes of the data unit, not counting padding
+    data_span -- size in bytes of the data unit including padding to a whole
+                 number of 2880 byte blocks
+
+  """
+  def __init__(self,cards=()):
+    self.cards = []
+    self.index = {}
+
+    # the card whose string value is being continued, if any
+    self._continued = None
+
+    self.header_offset = None
+    self.data_offset = None
+    self.data_size = None
+    self.data_span = None
+
+    for card in cards:
+      self.append(card)
+
+  @classmethod
+  def from_string(cls,s):
+    """
+    Make a CardMap from a string of concatenated 80 character card images,
+    stopping at the END card if there is one.
+
+    """
+    header = cls()
+
+    for i in range(0,len(s),CARD_SIZE):
+      image = s[i:i+CARD_SIZE].ljust(CARD_SIZE)
+      if _is_end(image):
+        break
+      header.append(Card(image))
+
+    return header
+
+  def append(self,card):
+    string = isinstance(card.value,_string_types)
+
+    if card.key == 'CONTINUE' and self._continued is not None and string:
+      parent = self._continued
+      parent.value = parent.value[:-1] + card.value
+      if not parent.value.endswith('&'):
+        self._continued = None
+    elif string and card.value.endswith('&') and \
+         card.key not in COMMENTARY_KEYS:
+      self._continued = card
+    else:
+      self._continued = None
+
+    self.index.setdefault(card.key,[]).append(len(self.cards))
+    self.cards.append(card)
+
+  def keys(self):
+    """
+    Unique keys in the order they first appear.
+
+    """
+    return [card.key for i,card in enumerate(self.cards)
+            if self.index[card.key][0] == i]
+
+  def get(self,key,default=None):
+    positions = self.index.get(key.upper())
+
+    if not positions:
+      return default
+
+    return self.cards[positions[0]].value
+
+  def getall(self,key):
+    return [self.cards[i].value for i in self.index.get(key.upper(),[])]
+
+  def __getitem__(self,key):
+    positions = self.index.get(key.upper())
+
+    if not positions:
+      raise KeyError(key)
+
+    return self.cards[positions[0]]
+
+  def __contains__(self,key):
+    return key.upper() in self.index
+
+  def __iter__(self):
+    return iter(self.cards)
+
+  def __len__(self):
+    return len(self.cards)
+
+  def __str__(self):
+    return '\n'.join(card.image for card in self.cards)
+
+  @property
+  def name(self):
+    """
+    EXTNAME of the header, 'PRIMARY' for a primary header without one, and
+    otherwise ''.
+
+    """
+    extname = self.get('EXTNAME')
+
+    if isinstance(extname,_string_types) and extname.strip():
+      return extname.strip()
+    elif 'SIMPLE' in self:
+      return 'PRIMARY'
+    else:
+      return ''
+
+
+class KeywordSelector(object):
+  """
+  Matches header keywords against a list of patterns, compiled once. Each
+  pattern is one of:
+    an exact keyword, such as EXPSTART
+    a glob with * and ?, or [] for a set of characters, such as PHOT*
+    a regular expression after re:, such as re:CORR$, which matches if it's
+    found anywhere in the keyword
+
+  Matching ignores case. All the globs and regular expressions are combined
+  into a single regular expression, and the result for each keyword is kept
+  so each distinct keyword is only matched once however many headers it's
+  seen in.
+
+  """
+  def __init__(self,patterns):
+    self.patterns = list(patterns)
+    self.exact = set()
+
+    parts = []
+    for pattern in self.patterns:
+      if pattern.startswith('re:'):
+        parts.append('.*?(?:{})'.format(pattern[3:]))
+      elif is_glob(pattern):
+        parts.append('(?:{})\\Z'.format(glob_to_regex(pattern.upper())))
+      else:
+        self.exact.add(pattern.upper())
+
+    if parts:
+      self.regex = re.compile('|'.join(parts),re.IGNORECASE)
+    else:
+      self.regex = None
+
+    self._matches = {}
+
+  @property
+  def has_patterns(self):
+    """
+    True if any of the patterns is a glob or regular expression.
+
+    """
+    return self.regex is not None
+
+  def match(self,key):
+    """
+    True if key matches any of the patterns.
+
+    """
+    try:
+      return self._matches[key]
+    except KeyError:
+      pass
+
+    result = (key.upper() in self.exact or
+              (self.regex is not None and self.regex.match(key) is not None))
+    self._matches[key] = result
+
+    return result
+
+  def select(self,header):
+    """
+    The Cards of a CardMap whose keys match, in header order. Only exact
+    keywords are looked up in the header's index; otherwise the cards are
+    scanned once.
+
+    """
+    if self.regex is None:
+      positions = sorted(i for key in self.exact
+                         for i in header.index.get(key,[]))
+      return [header.cards[i] for i in positions]
+
+    return [card for card in header if self.match(card.key)]
+
+
+def is_glob(pattern):
+  """
+  True if pattern has any glob wildcards.
+
+  """
+  return any(c in pattern for c in '*?[')
+
+
+def glob_to_regex(pattern):
+  """
+  Translate a glob pattern to a regular expression, without anchors or
+  flags, so that it can be combined with others.
+
+  """
+  parts = []
+  i = 0
+
+  while i < len(pattern):
+    c = pattern[i]
+    i += 1
+
+    if c == '*':
+      parts.append('.*')
+    elif c == '?':
+      parts.append('.')
+    elif c == '[':
+      # a ] straight after [ or [! is part of the set
+      start = i + 1 if pattern[i:i+1] == '!' else i
+      end = pattern.find(']',start + 1)
+      if end < 0:
+        parts.append(re.escape(c))
+        continue
+      chars = pattern[i:end]
+      if chars.startswith('!'):
+        chars = '^' + chars[1:]
+      parts.append('[{}]'.format(chars.replace('\\','\\\\')))
+      i = end + 1
+    else:
+      parts.append(re.escape(c))
+
+  return ''.join(parts)
+
+
+def parse_card(image):
+  """
+  Split an 80 character card image into (key, value, comment). The value of
+  a CONTINUE card is the piece of long string it holds.
+
+  """
+  key = image[:8].strip().upper()
+
+  if key in COMMENTARY_KEYS:
+    return key,image[8:].rstrip(),''
+
+  if key == 'HIERARCH' and '=' in image:
+    # ESO style long keyword: HIERARCH ESO DET CHIP = value / comment
+    eq = image.index('=')
+    key = image[9:eq].strip().upper()
+    field = image[eq+1:]
+  elif image[8:10] == '= ':
+    field = image[10:]
+  elif key == 'CONTINUE':
+    field = image[8:]
+  else:
+    return key,None,image[8:].rstrip()
+
+  field = field.strip()
+
+  if field.startswith("'"):
+    # string value, with '' standing for a literal quote
+    i = 1
+    chars = []
+    while i < len(field):
+      if field[i] == "'":
+        if field[i+1:i+2] == "'":
+          chars.append("'")
+          i += 2
+          continue
+        break
+      chars.append(field[i])
+      i += 1
+    value = ''.join(chars).rstrip()
+    rest = field[i+1:]
+    comment = rest.split('/',1)[1].strip() if '/' in rest else ''
+    return key,value,comment
+
+  if '/' in field:
+    field,comment = field.split('/',1)
+    field = field.strip()
+    comment = comment.strip()
+  else:
+    comment = ''
+
+  return key,parse_value(field),comment
+
+
+def parse_value(field):
+  """
+  Convert a non-string value field to bool, int, float or complex. Fields
+  that can't be converted are returned as stripped strings, and empty fields
+  as None.
+
+  """
+  if field == '':
+    return None
+  elif field == 'T':
+    return True
+  elif field == 'F':
+    return False
+
+  try:
+    return int(field)
+  except ValueError:
+    pass
+
+  try:
+    return float(field.replace('D','E'))
+  except ValueError:
+    pass
+
+  if field.startswith('(') and field.endswith(')') and ',' in field:
+    real,imag = field[1:-1].split(',',1)
+    try:
+      return complex(float(real.replace('D','E')),float(imag.replace('D','E')))
+    except ValueError:
+      pass
+
+  return field
+
+
+def _is_end(image):
+  return image[:8] == 'END     '
+
+
+def read_cards(f):
+  """
+  Read one header from the open binary file f, starting at its current
+  position, and return a CardMap. f is left at the start of the data unit.
+  Returns None if f is already at the end of the file.
+
+  """
+  header = CardMap()
+
+  first = True
+  while True:
+    block = f.read(BLOCK_SIZE)
+
+    if not block and first:
+      return None
+    elif len(block) < BLOCK_SIZE:
+      raise HeaderParseError('Header is cut off before its END card.')
+
+    block = block.decode('ascii','replace')
+
+    for i in range(0,BLOCK_SIZE,CARD_SIZE):
+      image = block[i:i+CARD_SIZE]
+
+      if _is_end(image):
+        return header
+
+      if first and i == 0 and image[:8] not in ('SIMPLE  ','XTENSION'):
+        raise HeaderParseError('Header does not start with SIMPLE or XTENSION.')
+
+      header.append(Card(image))
+
+    first = False
+
+
+def data_size(header):
+  """
+  Size in bytes of the data unit described by header, not counting padding.
+
+  """
+  naxis = header.get('NAXIS',0)
+
+  if naxis == 0:
+    return 0
+
+  axes = [header.get('NAXIS{}'.format(i),0) for i in range(1,naxis+1)]
+
+  # random groups have NAXIS1 = 0, which doesn't count
+  if header.get('GROUPS') is True and axes[0] == 0:
+    axes = axes[1:]
+
+  pixels = 1
+  for n in axes:
+    pixels *= n
+
+  bits = abs(header.get('BITPIX',8))
+
+  return bits // 8 * header.get('GCOUNT',1) * (header.get('PCOUNT',0) + pixels)
+
+
+def padded(size):
+  """
+  size rounded up to a whole number of 2880 byte blocks.
+
+  """
+  return -(-size // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def open_fits(filename):
+  """
+  Open a FITS file for reading in binary mode. Gzipped files (recognized by
+  their first bytes, not their names) are returned as a gzip.GzipFile that
+  decompresses as it's read.
+
+  """
+  f = open(filename,'rb')
+
+  magic = f.read(len(GZIP_MAGIC))
+  f.seek(0)
+
+  if magic == GZIP_MAGIC:
+    f.close()
+    return gzip.GzipFile(filename,'rb')
+
+  return f
+
+
+def skip_to(f,offset):
+  """
+  Move the open file f to offset. Plain files seek; gzip files read forward
+  SKIP_BLOCK_SIZE bytes at a time, discarding what they read.
+
+  """
+  if not isinstance(f,gzip.GzipFile):
+    f.seek(offset)
+    return
+
+  remaining = offset - f.tell()
+
+  if remaining < 0:
+    # going backwards means decompressing from the start again
+    f.seek(offset)
+    return
+
+  while remaining > 0:
+    block = f.read(min(SKIP_BLOCK_SIZE,remaining))
+    if not block:
+      break
+    remaining -= len(block)
+
+
+def iter_headers(fits):
+  """
+  Generator of a CardMap for each HDU of a FITS file, in order. Data units
+  are skipped with seek and never read (or, in gzipped files, decompressed
+  and discarded; see skip_to). fits may be a file name, of a plain or
+  gzipped file, or an open binary file positioned at the start of a header.
+
+  The header_offset, data_offset, data_size and data_span attributes of each
+  CardMap are filled in. Anything after the last HDU that doesn't start with
+  an XTENSION card is ignored.
+
+  """
+  if isinstance(fits,_string_types):
+    f = open_fits(fits)
+    close = True
+  else:
+    f = fits
+    close = False
+
+  try:
+    first = True
+    while True:
+      offset = f.tell()
+
+      try:
+        header = read_cards(f)
+      except HeaderParseError:
+        if first:
+          raise
+        return
+
+      if header is None:
+        return
+
+      first = False
+
+      header.header_offset = offset
+      header.data_offset = f.tell()
+      header.data_size = data_size(header)
+      header.data_span = padded(header.data_size)
+
+      yield header
+
+      skip_to(f,header.data_offset + header.data_span)
+  finally:
+    if close:
+      f.close()
+
+
+def read_headers(fits):
+  """
+  List of CardMaps for every HDU of a FITS file (see iter_headers).
+
+  """
+  return list(iter_headers(fits))
+
+
+def read_header(fits,ext=0):
+  """
+  CardMap for extension number ext of a FITS file, reading only the headers
+  up to and including that one (so a gzipped file is only decompressed up to
+  the END card of that header). Raises IndexError if there is no such
+  extension.
+
+  """
+  for i,header in enumerate(iter_headers(fits)):
+    if i == ext:
+      return header
+
+  raise IndexError('Extension {} not found.'.format(ext))
+
+
+def select_headers(fits,exts=None):
+  """
+  Generator of (extension number, CardMap) for the HDUs of a FITS file
+  selected by exts, in file order, reading the file once from the start.
+
+  exts is a list where each item is an extension number, an EXTNAME (which
+  selects every extension with that name) or an (EXTNAME, EXTVER) pair.
+  Names are not case sensitive and EXTVER defaults to 1. If exts is None
+  every HDU is selected. Reading stops as soon as everything selected by
+  number or (EXTNAME, EXTVER) has been found, unless a bare EXTNAME is given.
+
+  """
+  return filter_headers(iter_headers(fits),exts)
+
+
+def filter_headers(headers,exts=None):
+  """
+  Generator of (extension number, CardMap) for the CardMaps in the iterable
+  headers, which are in file order, that are selected by exts (see
+  select_headers). Stops taking items from headers once nothing more can be
+  selected.
+
+  """
+  if exts is not None:
+    numbers = set(e for e in exts if isinstance(e,int))
+    names = set(e.upper() for e in exts if isinstance(e,_string_types))
+    versions = set((e[0].upper(),e[1]) for e in exts if isinstance(e,tuple))
+    wanted = len(numbers) + len(versions)
+
+  found = 0
+
+  for i,header in enumerate(headers):
+    if exts is None:
+      yield i,header
+      continue
+
+    name = header.name.upper()
+    version = (name,header.get('EXTVER',1))
+
+    if i in numbers or version in versions or name in names:
+      yield i,header
+
+    found += (i in numbers) + (version in versions)
+
+    if found >= wanted and not names:
+      return
+
+
+def diff_cards(header1,header2,ignore=()):
+  """
+  Compare two CardMaps in a single pass over each.
+
+  Returns (only1, only2, diff_values): keys only in header1, keys only in
+  header2, and keys in both whose values differ. Repeated keys such as
+  COMMENT and HISTORY differ if their lists of values differ. Keys in ignore
+  are left out of diff_values. All three lists are in header order.
+
+  """
+  only1 = [key for key in header1.keys() if key not in header2.index]
+  only2 = [key for key in header2.keys() if key not in header1.index]
+
+  diff_values = [key for key in header1.keys()
+                 if key in header2.index and key not in ignore and
+                 header1.getall(key) != header2.getall(key)]
+
+  return only1,only2,diff_values
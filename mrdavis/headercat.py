@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+"""
+Catalog of the headers of every fits file under one or more directory
+trees, kept in an sqlite database so keyword queries don't have to read the
+files. Type headercat.py -h for help.
+
+Every card of every HDU is stored with its file name, extension number and
+position. Refreshing the catalog only reads the headers of files that are
+new or whose size or modification time has changed, and drops files that
+have been deleted. Headers are read with fitsheader.
+
+imhead.py and listcorr.py take a --catalog option to look up headers in a
+catalog. Files that aren't in the catalog, or have changed
+since it was refreshed, are read from disk as usual.
+
+Examples
+--------
+
+Build or refresh a catalog:
+
+headercat.py headers.db refresh /data/archive
+
+Print the value of keywords in every catalogued header that has them:
+
+headercat.py headers.db query EXPSTART FILTER
+
+"""
+
+import argparse
+import fnmatch
+import os
+import sqlite3
+import sys
+import threading
+
+import fitsheader
+
+# file name patterns picked up when refreshing a catalog
+CATALOG_PATTERNS = ['*.fits','*.fit','*.fits.gz']
+
+# number of files indexed between commits when refreshing
+COMMIT_EVERY = 500
+
+class HeaderCatalog(object):
+  """
+  sqlite catalog of fits headers. Files are keyed by absolute path and their
+  entries are only used while the file's size and modification time are
+  unchanged.
+
+  Each thread gets its own connection to the database so a catalog can be
+  shared by worker threads. close() closes all of them, so it should only be
+  called once the workers are done.
+
+  Input:
+    filename -- name of the sqlite database file
+
+  """
+  def __init__(self,filename):
+    self.filename = filename
+    self._local = threading.local()
+
+    # every thread's connection, so close() can close them all
+    self._conns = []
+    self._lock = threading.Lock()
+
+    conn = self.conn
+    conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                 'id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, '
+                 'mtime REAL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS hdus ('
+                 'file_id INTEGER, ext INTEGER, header_offset INTEGER, '
+                 'data_offset INTEGER, data_size INTEGER, '
+                 'PRIMARY KEY (file_id, ext))')
+    conn.execute('CREATE TABLE IF NOT EXISTS cards ('
+                 'file_id INTEGER, ext INTEGER, position INTEGER, key TEXT, '
+                 'value, image TEXT)')
+    conn.execute('CREATE INDEX IF NOT EXISTS cards_file ON cards '
+                 '(file_id, ext, position)')
+    conn.execute('CREATE INDEX IF NOT EXISTS cards_key ON cards (key)')
+    conn.commit()
+
+  @property
+  def conn(self):
+    """
+    This thread's connection to the database.
+
+    """
+    conn = getattr(self._local,'conn',None)
+
+    if conn is None:
+      conn = sqlite3.connect(self.filename,timeout=60,
+                             check_same_thread=False)
+      self._local.conn = conn
+      with self._lock:
+        self._conns.append(conn)
+
+    return conn
+
+  def refresh(self,roots,patterns=CATALOG_PATTERNS):
+    """
+    Bring the catalog up to date with the files under each directory in
+    roots whose names match any of patterns. Only new and changed files are
+    read, and files that are no longer there are removed.
+
+    Returns (number of files read, number removed, list of (path, error)
+    for files that couldn't be read).
+
+    """
+    conn = self.conn
+
+    updated = 0
+    removed = 0
+    errors = []
+
+    for root in roots:
+      root = os.path.abspath(root)
+
+      # everything catalogued under root, found with a range scan of paths
+      prefix = root.rstrip(os.sep) + os.sep
+      known = dict((path,(file_id,size,mtime)) for file_id,path,size,mtime in
+                   conn.execute('SELECT id, path, size, mtime FROM files '
+                                'WHERE path >= ? AND path < ?',
+                                (prefix,prefix[:-1] + chr(ord(os.sep) + 1))))
+
+      seen = set()
+
+      for dirpath,dirnames,filenames in os.walk(root):
+        for name in filenames:
+          if not any(fnmatch.fnmatch(name,p) for p in patterns):
+            continue
+
+          path = os.path.join(dirpath,name)
+          seen.add(path)
+
+          try:
+            st = os.stat(path)
+            entry = known.get(path)
+            if entry is not None and entry[1:] == (st.st_size,st.st_mtime):
+              continue
+            self._index_file(path,st)
+          except (IOError,OSError,fitsheader.HeaderParseError) as e:
+            errors.append((path,str(e)))
+            continue
+
+          updated += 1
+          if updated % COMMIT_EVERY == 0:
+            conn.commit()
+
+      for path in known:
+        if path not in seen:
+          self._remove(known[path][0])
+          removed += 1
+
+    conn.commit()
+
+    return updated,removed,errors
+
+  def _index_file(self,path,st):
+    """
+    Read the headers of one file and replace its entries.
+
+    """
+    headers = fitsheader.read_headers(path)
+
+    conn = self.conn
+
+    row = conn.execute('SELECT id FROM files WHERE path = ?',(path,)).fetchone()
+    if row is not None:
+      self._remove(row[0])
+
+    file_id = conn.execute('INSERT INTO files (path, size, mtime) '
+                           'VALUES (?,?,?)',
+                           (path,st.st_size,st.st_mtime)).lastrowid
+
+    for ext,header in enumerate(headers):
+      conn.execute('INSERT INTO hdus VALUES (?,?,?,?,?)',
+                   (file_id,ext,header.header_offset,header.data_offset,
+                    header.data_size))
+      conn.executemany('INSERT INTO cards VALUES (?,?,?,?,?,?)',
+                       [(file_id,ext,position,card.key,_sql_value(card.value),
+                         card.image)
+                        for position,card in enumerate(header)])
+
+  def _remove(self,file_id):
+    conn = self.conn
+    conn.execute('DELETE FROM cards WHERE file_id = ?',(file_id,))
+    conn.execute('DELETE FROM hdus WHERE file_id = ?',(file_id,))
+    conn.execute('DELETE FROM files WHERE id = ?',(file_id,))
+
+  def _file_id(self,fits):
+    """
+    Catalog id of fits, or None if it isn't catalogued or has changed.
+
+    """
+    path = os.path.abspath(fits)
+
+    row = self.conn.execute('SELECT id, size, mtime FROM files '
+                            'WHERE path = ?',(path,)).fetchone()
+
+    if row is None:
+      return None
+
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+
+    if row[1:] != (st.st_size,st.st_mtime):
+      return None
+
+    return row[0]
+
+  def read_headers(self,fits):
+    """
+    List of CardMaps for every HDU of fits from the catalog, with their
+    offset attributes filled in, or None if the catalog doesn't have an up
+    to date entry for the file.
+
+    """
+    file_id = self._file_id(fits)
+
+    if file_id is None:
+      return None
+
+    headers = []
+
+    for ext,header_offset,data_offset,data_size in self.conn.execute(
+        'SELECT ext, header_offset, data_offset, data_size FROM hdus '
+        'WHERE file_id = ? ORDER BY ext',(file_id,)):
+      header = fitsheader.CardMap()
+      header.header_offset = header_offset
+      header.data_offset = data_offset
+      header.data_size = data_size
+      header.data_span = fitsheader.padded(data_size)
+      headers.append(header)
+
+    for ext,image in self.conn.execute('SELECT ext, image FROM cards '
+                                       'WHERE file_id = ? '
+                                       'ORDER BY ext, position',(file_id,)):
+      headers[ext].append(fitsheader.Card(image))
+
+    return headers
+
+  def select_headers(self,fits,exts=None):
+    """
+    fitsheader.select_headers() answered from the catalog, falling back to
+    reading the file if it isn't catalogued or has changed.
+
+    """
+    headers = self.read_headers(fits)
+
+    if headers is None:
+      return fitsheader.select_headers(fits,exts)
+
+    return fitsheader.filter_headers(headers,exts)
+
+  def header(self,fits,ext=0):
+    """
+    fitsheader.read_header() answered from the catalog, falling back to
+    reading the file if it isn't catalogued or has changed.
+
+    """
+    for i,header in self.select_headers(fits,[ext]):
+      return header
+
+    raise IndexError('Extension {} not found.'.format(ext))
+
+  def query(self,keys):
+    """
+    Generator of (path, ext, key, value) for every card in the catalog with
+    one of keys, ordered by path, extension and position.
+
+    """
+    keys = [key.upper() for key in keys]
+
+    sql = ('SELECT files.path, cards.ext, cards.key, cards.value '
+           'FROM cards JOIN files ON files.id = cards.file_id '
+           'WHERE cards.key IN ({}) '
+           'ORDER BY files.path, cards.ext, cards.position').format(
+           ','.join('?' * len(keys)))
+
+    for row in self.conn.execute(sql,keys):
+      yield row
+
+  def close(self):
+    """
+    Close every thread's connection to the database.
+
+    """
+    with self._lock:
+      conns = self._conns
+      self._conns = []
+
+    for conn in conns:
+      conn.close()
+
+    self._local = threading.local()
+
+
+def _sql_value(value):
+  """
+  Header value as stored in the catalog's value column: T or F for bools,
+  text for complex numbers, and otherwise unchanged.
+
+  """
+  if value is True:
+    return 'T'
+  elif value is False:
+    return 'F'
+  elif isinstance(value,complex):
+    return str(value)
+
+  return value
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description=
+                                   'Catalog fits headers in an sqlite '
+                                   'database.')
+
+  parser.add_argument('catalog', type=str, help='Catalog database file.')
+
+  subparsers = parser.add_subparsers(dest='command')
+
+  refresh = subparsers.add_parser('refresh',
+                                  help='Add new and changed files under '
+                                       'directories to the catalog.')
+  refresh.add_argument('roots', nargs='+', type=str,
+                       help='Directories to catalog.')
+  refresh.add_argument('-p', '--pattern', type=str, action='append',
+                       help='File name pattern to catalog. May be repeated. '
+                            'Defaults to ' + ' '.join(CATALOG_PATTERNS) + '.')
+
+  query = subparsers.add_parser('query',
+                                help='Print the values of keywords from the '
+                                     'catalog.')
+  query.add_argument('keys', nargs='+', type=str, help='Keywords to print.')
+
+  return parser.parse_args()
+
+
+def main():
+  args = parse_args()
+
+  catalog = HeaderCatalog(args.catalog)
+
+  try:
+    if args.command == 'refresh':
+      updated,removed,errors = catalog.refresh(args.roots,
+                                               args.pattern or CATALOG_PATTERNS)
+      for path,error in errors:
+        sys.stderr.write('{}: {}\n'.format(path,error))
+      print('{} files read, {} removed, {} errors'.format(updated,removed,
+                                                         len(errors)))
+    elif args.command == 'query':
+      for path,ext,key,value in catalog.query(args.keys):
+        print('{}\t{}\t{}\t{}'.format(path,ext,key,value))
+  finally:
+    catalog.close()
+
+
+if __name__ == '__main__':
+  raise SystemExit(main())
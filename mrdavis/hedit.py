@@ -22,28 +22,454 @@ Modify an extension header:
 
 > hedit.py jb1f98q1q_raw.fits SOMEKEY SOMEVALUE --ext 1
 
+Make several edits at once, opening and writing each file only once:
+
+> hedit.py *.fits -a FLATCORR PERFORM -a DARKCORR OMIT
+
+> hedit.py *.fits --script edits.txt
+
+Each line of an edit script is KEYWORD VALUE [TYPE [EXT]], where TYPE is one
+of str, float, int or bool (defaulting to the type given on the command
+line) and EXT is the extension number (defaulting to --ext). Values with
+spaces can be quoted and lines starting with # are ignored:
+
+# keyword  value            type  ext
+FLATCORR   PERFORM
+EXPSTART   58000.5          float
+FILTER     'F606W CLEAR'    str   0
+CCDGAIN    2                int   1
+
+Headers are edited without reading the data. The file is copied to a
+temporary file with the new headers and renamed over the original, so an
+interrupted edit never leaves a half written file. Gzipped files are edited
+through pyfits.
+
+With --in-place, headers that take the same number of 2880 byte blocks as
+before are written over the old ones instead, without copying the data. This
+is much faster for big files but not atomic:
+
+> hedit.py *.fits FLATCORR PERFORM --in-place
+
+Edit many files with a pool of worker threads, reading the list of files
+from stdin (a file name of -). Progress goes to stderr, and files that
+couldn't be edited are listed at the end:
+
+> find /data -name '*_raw.fits' | hedit.py - FLATCORR PERFORM -j 16
+
+Only edit files whose headers match every --where predicate. Predicates are
+KEYWORD=VALUE or KEYWORD!=VALUE, looked up in the primary header unless an
+extension number is given in brackets. Only the header blocks are read to
+test them and files that don't match are skipped:
+
+> hedit.py *.fits FLATCORR PERFORM --where INSTRUME=WFC3 --where DETECTOR=UVIS
+
+> hedit.py *.fits SOMEKEY SOMEVALUE --where 'CCDAMP[1]!=ABCD'
+
+The keyword in a predicate may be a glob, in which case KEYWORD=VALUE
+matches if any matching keyword has the value and KEYWORD!=VALUE if none
+does:
+
+> hedit.py *.fits FLATCORR PERFORM --where '*CORR!=COMPLETE'
+
 """
 
 import argparse
+import os
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+from multiprocessing.pool import ThreadPool
 
 import pyfits
 
+import filelist
+import fitsheader
+
+# value types that can be named in edit scripts
+TYPES = {'str': str, 'float': float, 'int': int, 'bool': True}
+
+# number of bytes copied at a time when a file has to be rewritten
+COPY_BLOCK_SIZE = 4 * 1024 * 1024
+
 
 def setval(fits, key, value, ext):
-  print('{}[{}]: {} -> {}'.format(fits,ext,key,value))
-  pyfits.setval(fits, key, value=value, ext=ext)
+  setvals(fits, [(key, value, ext)])
+
+
+def setvals(fits, edits, verbose=True, where=(), in_place=False):
+  """
+  Apply a list of (key, value, ext) edits to one file, opening it once and
+  writing it at most once. Each edit is printed unless verbose is False.
+  in_place is passed on to write_headers().
+
+  If where is a list of predicates from parse_predicate() the file is only
+  edited if its headers match all of them. Returns True if the file was
+  edited and False if it was skipped.
+
+  """
+  if where and not header_matches(fits, where):
+    return False
+
+  if verbose:
+    for line in edit_lines(fits, edits):
+      print(line)
+
+  if fits.endswith('.gz'):
+    update_file(fits, edits)
+  else:
+    write_headers(fits, edit_headers(fits, edits), in_place)
+
+  return True
+
+
+def parse_predicate(text):
+  """
+  Parse a --where predicate, KEYWORD=VALUE or KEYWORD!=VALUE with an
+  optional extension number after the keyword as in KEYWORD[1]=VALUE.
+  KEYWORD may be a glob with * and ?. Returns (ext, selector, op, value),
+  where selector is a fitsheader.KeywordSelector for KEYWORD.
+
+  """
+  match = re.match(r'^\s*([^=!\[\]\s]+)\s*(?:\[(\d+)\])?\s*(!=|=)(.*)$', text)
+
+  if match is None:
+    raise ValueError('Predicates must look like KEYWORD=VALUE or '
+                     'KEYWORD!=VALUE, not {!r}.'.format(text))
+
+  keyword, ext, op, value = match.groups()
+
+  selector = fitsheader.KeywordSelector([keyword.upper()])
+
+  return int(ext or 0), selector, op, value.strip()
+
+
+def header_matches(fits, predicates):
+  """
+  True if the headers of fits match every (ext, selector, op, value)
+  predicate. Headers are read with fitsheader, which only decompresses
+  gzipped files as far as the last header needed, and the data is never
+  read.
+
+  """
+  exts = sorted(set(p[0] for p in predicates))
+
+  headers = {}
+  for ext, header in enumerate(fitsheader.iter_headers(fits)):
+    if ext in exts:
+      headers[ext] = header
+    if ext >= exts[-1]:
+      break
+
+  for ext, selector, op, value in predicates:
+    if ext not in headers:
+      raise IndexError('{}: extension {} not found.'.format(fits, ext))
+
+    same = any(same_value(card.value, value)
+               for card in selector.select(headers[ext]))
+
+    if same != (op == '='):
+      return False
+
+  return True
+
+
+def same_value(header_value, text):
+  """
+  Compare a value from a header with the text of a predicate, converting the
+  text to the type of the header value.
+
+  """
+  if isinstance(header_value, bool):
+    return text.upper() in (['T','TRUE'] if header_value else ['F','FALSE'])
+  elif isinstance(header_value, (int, float)):
+    try:
+      return float(text) == header_value
+    except ValueError:
+      return False
+  elif header_value is None:
+    return text == ''
+
+  return str(header_value).strip() == text
+
+
+def edit_lines(fits, edits):
+  return ['{}[{}]: {} -> {}'.format(fits,ext,key,value)
+          for key, value, ext in edits]
+
+
+def _setvals_job(args):
+  """
+  setvals() for one file in a worker thread. args is (fits, edits, where,
+  in_place). Returns (fits, lines to print, error message or None, edited).
+
+  """
+  fits, edits, where, in_place = args
+
+  try:
+    edited = setvals(fits, edits, verbose=False, where=where,
+                     in_place=in_place)
+  except Exception as e:
+    return fits, [], '{}: {}'.format(type(e).__name__, e), False
+
+  if not edited:
+    return fits, [], None, False
+
+  return fits, edit_lines(fits, edits), None, True
+
+
+def bulk_setvals(fits_files, edits, jobs, where=(), in_place=False):
+  """
+  Apply edits to every file in fits_files using a pool of jobs threads, so
+  the I/O for many files overlaps. Edit lines are printed as files finish,
+  progress is written to stderr if it's a terminal, and a summary of the
+  files that failed is written to stderr at the end. where and in_place are
+  passed on to setvals(). Returns the number of failed files.
+
+  """
+  # the same file edited by two threads at once could lose edits, so files
+  # named more than once (as a.fits and ./a.fits, or through links) are only
+  # edited the first time
+  seen = set()
+  unique = []
+  for fits in fits_files:
+    path = os.path.realpath(fits)
+    if path not in seen:
+      seen.add(path)
+      unique.append(fits)
+  fits_files = unique
+
+  failures = []
+  skipped = 0
+  total = len(fits_files)
+  progress = sys.stderr.isatty()
+
+  pool = ThreadPool(max(1, jobs))
+
+  try:
+    results = pool.imap_unordered(_setvals_job,
+                                  [(fits, edits, where, in_place)
+                                   for fits in fits_files])
+    for done, (fits, lines, error, edited) in enumerate(results, 1):
+      for line in lines:
+        print(line)
+
+      if error is not None:
+        failures.append((fits, error))
+      elif not edited:
+        skipped += 1
+
+      if progress:
+        sys.stderr.write('\r{}/{} files, {} failed'.format(done, total,
+                                                          len(failures)))
+        sys.stderr.flush()
+  finally:
+    pool.close()
+    pool.join()
+
+  if progress:
+    sys.stderr.write('\n')
+
+  if skipped:
+    sys.stderr.write('{} of {} files did not match --where.\n'.format(skipped,
+                                                                     total))
+
+  if failures:
+    sys.stderr.write('{} of {} files failed:\n'.format(len(failures), total))
+    for fits, error in sorted(failures):
+      sys.stderr.write('  {}: {}\n'.format(fits, error))
+
+  return len(failures)
+
+
+def update_file(fits, edits):
+  """
+  Apply edits through pyfits, which may rewrite the whole file.
+
+  """
+  hdulist = pyfits.open(fits, mode='update')
+
+  try:
+    for key, value, ext in edits:
+      hdulist[ext].header[key] = value
+  finally:
+    hdulist.close()
+
+
+def edit_headers(fits, edits):
+  """
+  Read the headers of fits that edits apply to, straight from the file, and
+  apply the edits to them. Returns a list of (offset, old size, new header)
+  tuples in file order, where offset and old size are the byte offset and
+  size of the old header in the file and new header is the edited header as
+  bytes, padded to a whole number of blocks. No edits give no headers.
+
+  """
+  if not edits:
+    return []
+
+  by_ext = {}
+  for key, value, ext in edits:
+    by_ext.setdefault(ext, []).append((key, value))
+
+  headers = []
+  last = -1
+
+  with open(fits, 'rb') as f:
+    for ext, card_map in enumerate(fitsheader.iter_headers(f)):
+      last = ext
+
+      if ext in by_ext:
+        size = card_map.data_offset - card_map.header_offset
+        f.seek(card_map.header_offset)
+        header = pyfits.Header.fromstring(f.read(size).decode('ascii'))
+
+        for key, value in by_ext[ext]:
+          header[key] = value
+
+        headers.append((card_map.header_offset, size,
+                        header.tostring().encode('ascii')))
+
+      if ext >= max(by_ext):
+        break
+
+  if last < max(by_ext):
+    missing = min(e for e in by_ext if e > last)
+    raise IndexError('{}: extension {} not found.'.format(fits, missing))
+
+  return headers
+
+
+def write_headers(fits, headers, in_place=False):
+  """
+  Write the headers from edit_headers() to fits with rewrite_file(), which
+  is atomic. If in_place is True and every new header takes the same number
+  of blocks as the old one they're written over the old ones instead, which
+  is faster but isn't atomic. A header that shrinks by a block can't be
+  written in place: the blocks it no longer uses would be left between its
+  END card and the data.
+
+  """
+  if in_place and all(len(new) == size for offset, size, new in headers):
+    with open(fits, 'r+b') as f:
+      for offset, size, new in headers:
+        f.seek(offset)
+        f.write(new)
+  else:
+    rewrite_file(fits, headers)
+
+
+def rewrite_file(fits, headers):
+  """
+  Copy fits to a temporary file in the same directory, putting in the new
+  headers from edit_headers(), then rename the copy over the original so the
+  file is never left half written.
+
+  """
+  directory = os.path.dirname(os.path.abspath(fits))
+  fd, tmp = tempfile.mkstemp(dir=directory, prefix='.hedit', suffix='.tmp')
+
+  try:
+    with os.fdopen(fd, 'wb') as out:
+      with open(fits, 'rb') as f:
+        position = 0
+        for offset, size, new in headers:
+          _copy(f, out, offset - position)
+          out.write(new)
+          position = offset + size
+          f.seek(position)
+        _copy(f, out)
+
+      out.flush()
+      os.fsync(out.fileno())
+
+    shutil.copymode(fits, tmp)
+    os.rename(tmp, fits)
+  except BaseException:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+    raise
+
+
+def _copy(f, out, size=None):
+  """
+  Copy size bytes (or everything left if size is None) from f to out.
+
+  """
+  while size is None or size > 0:
+    block = f.read(COPY_BLOCK_SIZE if size is None
+                   else min(COPY_BLOCK_SIZE, size))
+    if not block:
+      break
+    out.write(block)
+    if size is not None:
+      size -= len(block)
+
+
+def convert(value, value_type):
+  """
+  Convert the string value to value_type, which is str, float, int or True
+  for boolean.
+
+  """
+  if value_type is True:
+    # boolean type
+    if value == 'True':
+      return True
+    elif value == 'False':
+      return False
+    else:
+      raise ValueError("Boolean values must be either 'True' or 'False'.")
+  else:
+    return value_type(value)
+
+
+def read_script(script, value_type, ext):
+  """
+  Read an edit script and return its list of (key, value, ext) edits.
+  value_type and ext are used for lines that don't give them.
+
+  """
+  edits = []
+
+  with open(script) as f:
+    for num, line in enumerate(f, 1):
+      words = shlex.split(line, comments=True)
+
+      if not words:
+        continue
+
+      if len(words) < 2 or len(words) > 4:
+        s = '{} line {}: expected KEYWORD VALUE [TYPE [EXT]].'
+        raise ValueError(s.format(script, num))
+
+      if len(words) > 2:
+        if words[2] not in TYPES:
+          s = '{} line {}: type must be one of {}.'
+          raise ValueError(s.format(script, num, ', '.join(sorted(TYPES))))
+        line_type = TYPES[words[2]]
+      else:
+        line_type = value_type
+
+      line_ext = int(words[3]) if len(words) > 3 else ext
+
+      edits.append((words[0], convert(words[1], line_type), line_ext))
+
+  return edits
 
 
 def parse_args():
   parser = argparse.ArgumentParser(description=
-                                   'Add or modify a header value.')
+                                   'Add or modify a header value.',
+                                   usage='%(prog)s [options] fits_files '
+                                         '[keyword new_value]')
   
-  parser.add_argument('fits_files', nargs='+', type=str,
-                      help='Name of fits files.')
-                      
-  parser.add_argument('keyword', help='Keyword to update.')
-                      
-  parser.add_argument('new_value', help='New value of keyword')
+  parser.add_argument('args', nargs='+', type=str, metavar='fits_files',
+                      help='Name of fits files, followed by the keyword to '
+                           'update and its new value unless the edits are '
+                           'given with -a or --script. A file name of - '
+                           'reads file names from stdin.')
   
   parser.add_argument('-e', '--ext', type=int, default=0,
                       help='Extension number. Defaults to 0.')
@@ -60,8 +486,47 @@ def parse_args():
                       
   parser.add_argument('-b', '--bool', action='store_const', const=True,
                       dest='type', help='Value will be stored as boolean.')
+
+  parser.add_argument('-a', '--add', nargs=2, action='append', default=[],
+                      metavar=('KEYWORD','VALUE'), dest='pairs',
+                      help='Keyword and value to set. May be repeated.')
+
+  parser.add_argument('--script', type=str, default=None,
+                      help='File of edits, one KEYWORD VALUE [TYPE [EXT]] '
+                           'per line.')
+
+  parser.add_argument('-w', '--where', action='append', default=[],
+                      metavar='PREDICATE',
+                      help='Only edit files where KEYWORD=VALUE or '
+                           'KEYWORD!=VALUE, with an optional extension '
+                           'number as in KEYWORD[1]=VALUE. May be repeated, '
+                           'all must match.')
+
+  parser.add_argument('-j', '--jobs', type=int, default=None,
+                      help='Edit files with this many worker threads, '
+                           'reporting progress and failures instead of '
+                           'stopping at the first error.')
+
+  parser.add_argument('--in-place', action='store_true',
+                      help='Write headers that keep their size over the old '
+                           'ones without copying the file. Faster, but a '
+                           'file can be left half written if interrupted.')
   
-  return parser.parse_args()
+  args = parser.parse_args()
+
+  if args.pairs or args.script is not None:
+    args.fits_files = args.args
+    args.keyword = None
+    args.new_value = None
+  elif len(args.args) < 3:
+    parser.error('fits_files, keyword and new_value are required unless '
+                 'edits are given with -a or --script.')
+  else:
+    args.fits_files = args.args[:-2]
+    args.keyword = args.args[-2]
+    args.new_value = args.args[-1]
+
+  return args
 
 
 def main():
@@ -73,20 +538,28 @@ def main():
     # if nothing specified, default to string
     value_type = str
   
-  # convert args.new_value to value_type
-  if value_type is True:
-    # boolean type
-    if args.new_value == 'True':
-      new_value = True
-    elif args.new_value == 'False':
-      new_value = False
-    else:
-      raise ValueError("Boolean values must be either 'True' or 'False'.")
+  if args.keyword is not None:
+    edits = [(args.keyword, convert(args.new_value, value_type), args.ext)]
   else:
-    new_value = value_type(args.new_value)
+    edits = [(key, convert(value, value_type), args.ext)
+             for key, value in args.pairs]
+    if args.script is not None:
+      edits.extend(read_script(args.script, value_type, args.ext))
+
+  if not edits:
+    raise SystemExit('hedit.py: error: no edits given, {} has only blank '
+                     'lines and comments.'.format(args.script))
   
-  for fits_file in args.fits_files:
-    setval(fits_file, args.keyword, new_value, args.ext)
+  where = [parse_predicate(p) for p in args.where]
+
+  fits_files = filelist.read_file_list(args.fits_files)
+
+  if args.jobs is not None:
+    if bulk_setvals(fits_files, edits, args.jobs, where, args.in_place):
+      return 1
+  else:
+    for fits_file in fits_files:
+      setvals(fits_file, edits, where=where, in_place=args.in_place)
   
 
 if __name__ == '__main__':
@@ -17,48 +17,338 @@ Print an extension header:
 
 imhead.py -e 1 jb1f98q1q_raw.fits
 
+Print every header, or the headers of extensions picked by EXTNAME or
+EXTNAME,EXTVER, reading the file once:
+
+imhead.py -e all jb1f98q1q_raw.fits
+
+imhead.py -e sci,2 -e dq,2 jb1f98q1q_raw.fits
+
 Print only specified keywords:
 
 imhead.py jb1f98q1q_raw.fits -k expstart -k expend
 
+Keywords can also be globs or, after re:, regular expressions. Every card
+that matches is printed, in header order:
+
+imhead.py jb1f98q1q_raw.fits -k 'phot*' -k 're:CORR$'
+
+Write a table of keywords from many files, one row per file (or per
+selected extension), reading file names from stdin when a file name is -.
+Headers are read by a pool of worker threads and rows are written in the
+order the files were given, as CSV, TSV or a numpy .npy structured array:
+
+find . -name '*_raw.fits' | imhead.py - -k expstart -k expend -k filter \
+    --table csv -j 16 > exposures.csv
+
+Headers are read straight from the file with fitsheader, which seeks past
+the data of earlier extensions without reading it (gzipped files are only
+decompressed up to the last header needed), so neither pyfits nor
+numpy is imported (except by --table npy). With --catalog headers are
+looked up in a headercat.py catalog instead, for files it has up to date.
+
 """
 
 import argparse
+import csv
+import sys
+from multiprocessing.pool import ThreadPool
+
+import filelist
+import fitsheader
+import headercat
 
-import pyfits
 
+def select_headers(fits, exts=None, catalog=None):
+  """
+  fitsheader.select_headers(), answered from a HeaderCatalog if one is
+  given.
 
-def print_header(fits, ext=0, keys=None):
-  head = pyfits.getheader(fits, ext=ext).ascard
+  """
+  if catalog is not None:
+    return catalog.select_headers(fits, exts)
+
+  return fitsheader.select_headers(fits, exts)
+
+
+def print_header(fits, ext=0, keys=None, catalog=None):
+  if catalog is not None:
+    head = catalog.header(fits, ext)
+  else:
+    head = fitsheader.read_header(fits, ext)
 
   if not keys:
     print head
+  elif isinstance(keys, fitsheader.KeywordSelector):
+    for card in keys.select(head):
+      print card
   else:
     for key in keys:
       print head[key]
 
 
+def print_headers(fits, exts=None, keys=None, catalog=None):
+  """
+  Print the headers of fits selected by exts (see
+  fitsheader.select_headers), each after a line naming the file and
+  extension. With keys only those keywords are printed, skipping any an
+  extension doesn't have. keys may be a list of keywords or a
+  fitsheader.KeywordSelector.
+
+  """
+  for ext, head in select_headers(fits, exts, catalog):
+    print ''
+    print '{}[{}]'.format(fits, ext)
+
+    if not keys:
+      print head
+    elif isinstance(keys, fitsheader.KeywordSelector):
+      for card in keys.select(head):
+        print card
+    else:
+      for key in keys:
+        if key in head:
+          print head[key]
+
+
+def read_rows(fits, exts, keys, catalog=None):
+  """
+  Return a row of [file name, extension number, value of each key] for each
+  extension of fits selected by exts. Missing keywords have value None.
+
+  """
+  return [[fits, ext] + [head.get(key) for key in keys]
+          for ext, head in select_headers(fits, exts, catalog)]
+
+
+def _read_rows_job(args):
+  """
+  read_rows() in a worker thread. args is (fits, exts, keys, catalog).
+  Returns (fits, rows, error message or None).
+
+  """
+  fits, exts, keys, catalog = args
+
+  try:
+    return fits, read_rows(fits, exts, keys, catalog), None
+  except (IOError, OSError, IndexError, fitsheader.HeaderParseError) as e:
+    return fits, [], '{}: {}'.format(type(e).__name__, e)
+
+
+def iter_rows(fits_files, exts, keys, jobs=1, catalog=None):
+  """
+  Generator of the rows from read_rows() for every file, in the order of
+  fits_files, reading headers with a pool of jobs threads. Files that can't
+  be read are reported on stderr and left out.
+
+  """
+  pool = ThreadPool(max(1, jobs))
+
+  try:
+    args = [(fits, exts, keys, catalog) for fits in fits_files]
+    for fits, rows, error in pool.imap(_read_rows_job, args, chunksize=16):
+      if error is not None:
+        sys.stderr.write('{}: {}\n'.format(fits, error))
+      for row in rows:
+        yield row
+  finally:
+    pool.close()
+    pool.join()
+
+
+def table_value(value):
+  """
+  Text for a header value in a CSV or TSV table.
+
+  """
+  if value is None:
+    return ''
+  elif value is True:
+    return 'T'
+  elif value is False:
+    return 'F'
+
+  return str(value)
+
+
+def write_text_table(rows, keys, out, delimiter):
+  """
+  Write rows from iter_rows() to out as they arrive, with a line of column
+  names first.
+
+  """
+  writer = csv.writer(out, delimiter=delimiter, lineterminator='\n')
+
+  writer.writerow(['filename', 'ext'] + [key.upper() for key in keys])
+
+  for row in rows:
+    writer.writerow([table_value(value) for value in row])
+
+
+def write_npy_table(rows, keys, out):
+  """
+  Write rows from iter_rows() to out as a numpy structured array with a
+  field for the file name, extension number and each key. Columns whose
+  values are all bools, ints or numbers are stored as such, with NaN for
+  missing numbers; anything else is stored as strings.
+
+  """
+  import numpy as np
+
+  rows = list(rows)
+  names = ['filename', 'ext'] + [key.upper() for key in keys]
+  columns = list(zip(*rows)) if rows else [[] for name in names]
+
+  dtype = []
+  arrays = []
+
+  for name, values in zip(names, columns):
+    present = [v for v in values if v is not None]
+
+    if present and len(present) == len(values) and \
+       all(isinstance(v, bool) for v in present):
+      dtype.append((name, '?'))
+      arrays.append(list(values))
+    elif present and all(isinstance(v, int) and not isinstance(v, bool)
+                         for v in present) and len(present) == len(values):
+      dtype.append((name, 'i8'))
+      arrays.append(list(values))
+    elif present and all(isinstance(v, (int, float)) and
+                         not isinstance(v, bool) for v in present):
+      dtype.append((name, 'f8'))
+      arrays.append([float('nan') if v is None else v for v in values])
+    else:
+      text = [table_value(v) for v in values]
+      dtype.append((name, 'U{}'.format(max([len(t) for t in text] + [1]))))
+      arrays.append(text)
+
+  table = np.zeros(len(rows), dtype=dtype)
+  for (name, kind), values in zip(dtype, arrays):
+    table[name] = values
+
+  np.save(out, table)
+
+
+def write_table(fits_files, exts, keys, fmt, output=None, jobs=1,
+                catalog=None):
+  """
+  Write a table of keys from the headers selected by exts in fits_files, in
+  format fmt ('csv', 'tsv' or 'npy'), to the file output or stdout.
+
+  """
+  rows = iter_rows(fits_files, exts, keys, jobs, catalog)
+
+  if fmt == 'npy':
+    if output is None:
+      raise ValueError('--table npy needs an output file given with -o.')
+    with open(output, 'wb') as out:
+      write_npy_table(rows, keys, out)
+    return
+
+  delimiter = ',' if fmt == 'csv' else '\t'
+
+  if output is None:
+    write_text_table(rows, keys, sys.stdout, delimiter)
+  else:
+    # the csv module wants binary files in python 2
+    with open(output, 'wb') as out:
+      write_text_table(rows, keys, out, delimiter)
+
+
+def parse_ext(ext):
+  """
+  Convert an --ext argument to an extension number, EXTNAME or (EXTNAME,
+  EXTVER) pair for fitsheader.select_headers, or None for 'all'.
+
+  """
+  if ext.lower() == 'all':
+    return None
+  elif ext.isdigit():
+    return int(ext)
+  elif ',' in ext:
+    name, version = ext.split(',', 1)
+    return (name.strip(), int(version))
+  else:
+    return ext.strip()
+
+
 def parse_args():
   parser = argparse.ArgumentParser(description=
                                    'Print a FITS header or keyword.')
 
   parser.add_argument('fits_files', nargs='+', type=str,
-                      help='Name of fits files.')
+                      help='Name of fits files. A name of - reads file names '
+                           'from stdin.')
 
-  parser.add_argument('-e', '--ext', type=int, default=0,
-                      help='Extension number. Defaults to 0.')
+  parser.add_argument('-e', '--ext', type=parse_ext, action='append',
+                      help='Extension number, EXTNAME, EXTNAME,EXTVER or '
+                           'all. May be repeated. Defaults to 0.')
 
   parser.add_argument('-k', '--key', type=str, action='append',
-                      help='Keyword to print.')
+                      help='Keyword to print. May be a glob such as '
+                           'PHOT* or a regular expression after re:.')
+
+  parser.add_argument('-t', '--table', choices=['csv', 'tsv', 'npy'],
+                      help='Write a table of the -k keywords with a row per '
+                           'file and extension.')
+
+  parser.add_argument('-o', '--output', type=str, default=None,
+                      help='Table output file. Defaults to stdout.')
+
+  parser.add_argument('-j', '--jobs', type=int, default=8,
+                      help='Number of threads reading headers for --table. '
+                           'Defaults to 8.')
+
+  parser.add_argument('--catalog', type=str, default=None,
+                      help='headercat.py catalog to look headers up in.')
+
+  args = parser.parse_args()
 
-  return parser.parse_args()
+  if args.table is not None and not args.key:
+    parser.error('--table needs keywords given with -k.')
+
+  if args.table is not None and \
+     fitsheader.KeywordSelector(args.key).has_patterns:
+    parser.error('--table needs exact keywords so its columns are the same '
+                 'for every file.')
+
+  return args
 
 
 def main():
   args = parse_args()
 
-  for fits_file in args.fits_files:
-    print_header(fits_file, args.ext, args.key)
+  exts = args.ext or [0]
+
+  keys = args.key
+  if keys and args.table is None:
+    selector = fitsheader.KeywordSelector(keys)
+    if selector.has_patterns:
+      keys = selector
+
+  fits_files = filelist.read_file_list(args.fits_files)
+
+  if args.catalog is not None:
+    catalog = headercat.HeaderCatalog(args.catalog)
+  else:
+    catalog = None
+
+  try:
+    if args.table is not None:
+      write_table(fits_files, None if None in exts else exts, args.key,
+                  args.table, args.output, args.jobs, catalog)
+      return
+
+    for fits_file in fits_files:
+      if len(exts) == 1 and isinstance(exts[0], int):
+        print_header(fits_file, exts[0], keys, catalog)
+      elif None in exts:
+        print_headers(fits_file, None, keys, catalog)
+      else:
+        print_headers(fits_file, exts, keys, catalog)
+  finally:
+    if catalog is not None:
+      catalog.close()
 
 
 if __name__ == '__main__':
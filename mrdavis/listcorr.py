@@ -6,35 +6,85 @@ fits files.
 CRCORR = PERFORM for CR-SPLIT images, OMIT otherwise.
 RPTCORR = PERFORM for REPEAT-OBS images, OMIT otherwise.
 
-Usage: listcorr.py <fits files>
+Other keywords can be listed instead with -k, which takes exact keywords,
+globs or regular expressions after re:, so -k '*CORR' lists every calibration
+switch.
+
+Headers are read with fitsheader, so gzipped files are only decompressed as
+far as the end of the primary header. With --catalog the headers are looked
+up in a headercat.py catalog, for the files it has up to date.
+
+Usage: listcorr.py [--catalog CATALOG] [-k KEY] <fits files>
 """
 
-import sys
+import argparse
 
-import pyfits
+import fitsheader
+import headercat
 
-def list_corr(fitsFiles):
+def list_corr(fitsFiles,catalog=None,selector=None):
   for fits in fitsFiles:
-    head = pyfits.getheader(fits)
-    
-    crcorr = head['CRCORR']
-    
-    rptcorr = head['RPTCORR']
+    if catalog is not None:
+      head = catalog.header(fits)
+    else:
+      head = fitsheader.read_header(fits)
+
+    if selector is not None:
+      print_keys(fits,selector.select(head))
+      continue
+
+    crcorr = head['CRCORR'].value
+
+    rptcorr = head['RPTCORR'].value
     
     print_corr(fits,crcorr,rptcorr)
     
+def print_keys(fits,cards):
+  print('')
+  print(fits)
+  for card in cards:
+    print(card.key.ljust(11) + str(card.value))
+
 def print_corr(fits,crcorr,rptcorr):
   print('')
   print(fits)
   print('CRCORR     ' + crcorr)
   print('RPTCORR    ' + rptcorr)
 
-def usage():
-  print('Usage: listcorr.py <fits files>')
+def parse_args():
+  parser = argparse.ArgumentParser(description=
+                                   'Show CRCORR and RPTCORR of fits files.')
+
+  parser.add_argument('fits_files', nargs='+', type=str,
+                      help='Name of fits files.')
+
+  parser.add_argument('--catalog', type=str, default=None,
+                      help='headercat.py catalog to look headers up in.')
+
+  parser.add_argument('-k', '--key', type=str, action='append',
+                      help='Keyword, glob or re: regular expression to list '
+                           'instead of CRCORR and RPTCORR. May be repeated.')
+
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+
+  if args.catalog is not None:
+    catalog = headercat.HeaderCatalog(args.catalog)
+  else:
+    catalog = None
+
+  if args.key:
+    selector = fitsheader.KeywordSelector(args.key)
+  else:
+    selector = None
+
+  try:
+    list_corr(args.fits_files,catalog,selector)
+  finally:
+    if catalog is not None:
+      catalog.close()
   
 if __name__ == '__main__':
-  if len(sys.argv) < 2:
-    usage()
-    exit()
-	
-  list_corr(sys.argv[1:])
+  raise SystemExit(main())
@@ -0,0 +1,46 @@
+"""
+Tests for checkimpht.py. Run with py.test from this directory.
+
+"""
+
+import numpy as np
+import pyfits
+
+import checkimpht
+
+
+def test_stream_array_info(tmpdir):
+  lengths = [3,0,5,1,0,2]
+  cells = np.array([np.arange(n) + n * 1.5 for n in lengths],dtype=object)
+  column = pyfits.Column(name='VALS',format='PD()',array=cells)
+
+  path = str(tmpdir.join('vla.fits'))
+  pyfits.HDUList([pyfits.PrimaryHDU(),
+                  pyfits.BinTableHDU.from_columns([column])]).writeto(path)
+
+  fits = pyfits.open(path)
+  stream = checkimpht.TableStream(path,1)
+  try:
+    kind,all_lengths,all_firsts = checkimpht.ExtColumns(fits[1]).array_info('vals')
+
+    for start,chunk in stream.chunks(4):
+      stop = start + chunk.nrows
+      info = chunk.array_info('vals')
+      assert info[0] == kind == 'array'
+      assert list(info[1]) == list(all_lengths[start:stop]) == \
+             lengths[start:stop]
+      assert list(info[2]) == list(all_firsts[start:stop])
+  finally:
+    stream.close()
+    fits.close()
+
+
+def test_obsmode_index_bytes():
+  index = checkimpht.ObsmodeIndex([(1,np.array(['ACS, WFC1,F555W ','acs,wfc12',
+                                                'acs,wfc1','wfc3,uvis']))])
+
+  assert index.keys.dtype.kind == 'S'
+  assert index.obsmodes.dtype.kind == 'S'
+  assert index.obsmode(1,0) == 'ACS, WFC1,F555W'
+  assert index.prefix('acs,wfc1') == [(1,0),(1,2)]
+  assert index.exact('ACS,WFC12') == [(1,1)]
@@ -0,0 +1,43 @@
+"""
+Tests for compfits.py. Run with py.test from this directory.
+
+"""
+
+import numpy as np
+import pyfits
+import pytest
+
+import compfits
+
+
+def write_comp_image(path,data):
+  pyfits.HDUList([pyfits.PrimaryHDU(),
+                  pyfits.CompImageHDU(data,name='SCI')]).writeto(str(path))
+
+
+def test_comp_image_pixel_difference(tmpdir):
+  data1 = np.arange(100 * 120,dtype='i4').reshape(100,120)
+  data2 = data1.copy()
+  data2[57,3] = -5
+  # noise compresses poorly, so the compressed tables have different sizes
+  data2[90:] = np.random.RandomState(1).randint(0,1 << 30,(10,120))
+
+  fits1 = tmpdir.join('one.fits')
+  fits2 = tmpdir.join('two.fits')
+  write_comp_image(fits1,data1)
+  write_comp_image(fits2,data2)
+
+  comp = compfits.CompareFits(str(fits1),str(fits1))
+  try:
+    assert comp.run_all_comps() is True
+  finally:
+    comp.close_fits()
+
+  comp = compfits.CompareFits(str(fits1),str(fits2))
+  try:
+    with pytest.raises(compfits.FitsDataError) as info:
+      comp.run_all_comps()
+  finally:
+    comp.close_fits()
+
+  assert 'First differing pixel (zero based): (57, 3)' in info.value.msg
@@ -0,0 +1,41 @@
+"""
+Tests for fitsheader.py. Run with py.test from this directory.
+
+"""
+
+import fitsheader
+
+
+def cards(*images):
+  return ''.join(image.ljust(fitsheader.CARD_SIZE) for image in images)
+
+
+def test_continue_joined():
+  header = fitsheader.CardMap.from_string(cards(
+           "SIMPLE  =                    T",
+           "LONGSTR = 'abc&'",
+           "CONTINUE  'def&'",
+           "CONTINUE  'ghi'",
+           "NEXT    = 'x&'",
+           "EXTNAME = 'SCI'"))
+
+  assert header.get('LONGSTR') == 'abcdefghi'
+  assert header.getall('CONTINUE') == ['def&','ghi']
+  assert header.get('NEXT') == 'x&'
+  assert header.get('EXTNAME') == 'SCI'
+
+
+def test_continue_tail_differs():
+  header1 = fitsheader.CardMap.from_string(cards(
+            "SIMPLE  =                    T",
+            "LONGSTR = '" + 'x' * 67 + "&'",
+            "CONTINUE  'tail one'"))
+  header2 = fitsheader.CardMap.from_string(cards(
+            "SIMPLE  =                    T",
+            "LONGSTR = '" + 'x' * 67 + "&'",
+            "CONTINUE  'tail two'"))
+
+  only1,only2,diff = fitsheader.diff_cards(header1,header2)
+
+  assert only1 == [] and only2 == []
+  assert diff == ['LONGSTR','CONTINUE']
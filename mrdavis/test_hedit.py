@@ -0,0 +1,56 @@
+"""
+Tests for hedit.py. Run with py.test from this directory.
+
+"""
+
+import os
+
+import numpy as np
+import pyfits
+import pytest
+
+import fitsheader
+import hedit
+
+
+@pytest.mark.parametrize('in_place', [False, True])
+def test_header_shrinks_a_block(tmpdir, in_place):
+  path = str(tmpdir.join('shrink.fits'))
+
+  hdu = pyfits.PrimaryHDU(np.arange(10,dtype='i4'))
+  for i in range(25):
+    hdu.header['KEY{}'.format(i)] = i
+  # a long string in CONTINUE cards takes the header into a second block
+  hdu.header['LONGSTR'] = 'x' * 800
+  hdu.writeto(path)
+
+  assert fitsheader.read_header(path).data_offset == 2 * 2880
+
+  hedit.setvals(path, [('LONGSTR', 'short', 0)], verbose=False,
+                in_place=in_place)
+
+  assert fitsheader.read_header(path).data_offset == 2880
+
+  fits = pyfits.open(path)
+  try:
+    assert fits[0].header['LONGSTR'] == 'short'
+    assert fits[0].data.tolist() == list(range(10))
+  finally:
+    fits.close()
+
+
+@pytest.mark.parametrize('in_place', [False, True])
+def test_rewrite_unless_in_place(tmpdir, in_place):
+  path = str(tmpdir.join('edit.fits'))
+  pyfits.PrimaryHDU(np.arange(10,dtype='i4')).writeto(path)
+
+  # keep the old file open so its inode isn't reused by the rewrite
+  with open(path, 'rb') as old:
+    inode = os.fstat(old.fileno()).st_ino
+    hedit.setvals(path, [('FLATCORR', 'PERFORM', 0)], verbose=False,
+                  in_place=in_place)
+
+    assert (os.stat(path).st_ino == inode) == in_place
+
+  assert pyfits.getheader(path)['FLATCORR'] == 'PERFORM'
+  assert os.listdir(str(tmpdir)) == ['edit.fits']